@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark.py: offline throughput benchmark of split_elex_rolls.py and
+google_vision_ocr_gcs.py.
+
+Synthetic roll-like PDFs (a grid of 3 x 10 voter cards per page) are split
+into tiles and the tiles are run through the OCR pipeline against the
+local backend (see ocr_backend.py), for every combination of --resolutions,
+--batches, --processes and --pipelines. Each configuration runs in its own
+child process and reports:
+
+    pages/sec        pages split or OCRed per second of wall time
+    stage latency    p50/p90/p99 of every stage (split job, and the
+                     ocr_metrics events: convert, upload, submit, wait,
+                     download, parse, save, render, tile)
+    peak RSS         of the largest process of the run
+    bytes moved      PNG bytes written by the split, TIFF bytes uploaded
+                     and downloaded, and output bytes written by the OCR
+
+so that a change or a tuning decision can be measured before a paid run.
+"""
+
+import os
+import json
+import time
+import glob
+import random
+import shutil
+import logging
+import argparse
+import itertools
+import resource
+import tempfile
+import contextlib
+
+from functools import partial
+from multiprocessing import Pool, Process, Queue
+
+import numpy as np
+import fitz
+
+from logutils.queue import QueueListener
+
+import ocr_backend
+import ocr_metrics
+import ocr_pages
+import ocr_pipeline
+import ocr_retry
+import split_elex_rolls
+import google_vision_ocr_gcs as gcs
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def make_roll_pdf(pdf_fn, pages, rnd):
+    """Writes a PDF of pages looking like an electoral roll: a header and
+    a grid of 3 x 10 voter cards per page."""
+    doc = fitz.open()
+    serial = 0
+    for pno in range(pages):
+        page = doc.newPage(width=595, height=842)
+        page.insertText(fitz.Point(30, 40), 'ELECTORAL ROLL - PAGE {:d}'.format(pno + 1),
+                        fontsize=10)
+        for row in range(10):
+            for col in range(3):
+                serial += 1
+                x, y = 30 + col * 180, 70 + row * 75
+                page.drawRect(fitz.Rect(x - 5, y - 12, x + 170, y + 58))
+                name = ' '.join(''.join(rnd.choice('ABCDEFGHIJKLMNOPRSTUVY')
+                                        for _ in range(rnd.randint(3, 8)))
+                                for _ in range(2))
+                lines = ['{:d}    KLA{:07d}'.format(serial, rnd.randint(0, 9999999)),
+                         'Name : {:s}'.format(name),
+                         "Father's Name : {:s}".format(name.split()[-1]),
+                         'House Number : {:d}'.format(rnd.randint(1, 999)),
+                         'Age : {:d}  Gender : {:s}'.format(
+                             rnd.randint(18, 90), rnd.choice(['Male', 'Female']))]
+                for k, line in enumerate(lines):
+                    page.insertText(fitz.Point(x, y + k * 11), line, fontsize=7)
+    doc.save(pdf_fn)
+    doc.close()
+
+
+def record_event(events_dir, stage, duration, nbytes=0):
+    """Appends a stage timing to the events file of this process, in the
+    format of the ocr_metrics events."""
+    fn = os.path.join(events_dir, 'events-{:d}.jsonl'.format(os.getpid()))
+    with open(fn, 'a') as f:
+        f.write(json.dumps({'stage': stage, 'duration': duration, 'bytes': nbytes}) + '\n')
+
+
+def load_events(events_dir):
+    events = []
+    for fn in glob.glob(os.path.join(events_dir, '*.jsonl')):
+        with open(fn) as f:
+            events.extend(json.loads(line) for line in f)
+    return events
+
+
+def dir_bytes(path, pattern='*'):
+    return sum(os.path.getsize(fn) for fn in glob.glob(os.path.join(path, pattern)))
+
+
+def tile_pages(png_files):
+    pages = 0
+    for fn in png_files:
+        _, _, from_pno, to_pno = ocr_pages.parse_tile_name(gcs.tile_name(fn))
+        pages += to_pno - from_pno + 1
+    return pages
+
+
+def run_split(argv, pdf_files, events_dir):
+    args = split_elex_rolls.make_parser().parse_args(argv)
+    os.makedirs(args.output)
+    start = time.time()
+    summary, durations = split_elex_rolls.run(args, pdf_files)
+    duration = time.time() - start
+    for d in durations:
+        record_event(events_dir, 'split', d)
+    return {'pages': sum(v[0] for v in summary.values()),
+            'tiles': sum(v[1] for v in summary.values()),
+            'seconds': duration,
+            'bytes': dir_bytes(args.output, '*.png')}
+
+
+def run_ocr(argv, events_dir):
+    args = gcs.make_parser().parse_args(
+        argv + ['--metrics', os.path.join(events_dir, 'metrics.jsonl')])
+    backend = ocr_backend.backend_from_args(args)
+    ocr_backend.set_backend(backend)
+    retrier = ocr_retry.retrier_from_args(args)
+    ocr_retry.set_retrier(retrier)
+    handlers = ocr_metrics.handlers_from_args(args)
+    ocr_metrics.set_metrics(True)
+    os.makedirs(args.output)
+    input_files = sorted(glob.glob(os.path.join(args.directory, '*.png')))
+
+    args.bucket_name = gcs.get_bucket_name()
+    gcs.create_bucket(args.bucket_name)
+    # events of the workers come through q, those of this process (the
+    # threads of the async pipeline) straight to the handlers
+    q = Queue()
+    listener = QueueListener(q, *handlers)
+    listener.start()
+    for h in handlers:
+        logging.getLogger().addHandler(h)
+    start = time.time()
+    try:
+        if args.pipeline == 'async':
+            ocr_pipeline.run(args, input_files, q)
+        else:
+            pool = Pool(args.processes, gcs.worker_init,
+                        [q, args.log_level, backend, None, None, retrier,
+                         (args.npz, args.page_text), True])
+            if args.files_per_operation > 1:
+                n = args.files_per_operation
+                groups = [input_files[i:i + n] for i in range(0, len(input_files), n)]
+                pool.map(partial(gcs.ocr_batch_worker, args), groups)
+            else:
+                pool.map(partial(gcs.ocr_worker, args), input_files)
+            pool.close()
+            pool.join()
+        duration = time.time() - start
+    finally:
+        gcs.delete_bucket(args.bucket_name)
+        listener.stop()
+        for h in handlers:
+            h.close()
+    moved = sum(e['bytes'] for e in load_events(events_dir)
+                if e['stage'] in ('upload', 'download'))
+    return {'pages': tile_pages(input_files),
+            'tiles': len(input_files),
+            'seconds': duration,
+            'bytes': moved + dir_bytes(args.output)}
+
+
+def _child(q, fn, args):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            result = fn(*args)
+        except Exception as e:
+            result = {'error': '{!s}: {!s}'.format(type(e).__name__, e)}
+    # ru_maxrss (KB) of the process itself and of its largest reaped child
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result['peak_rss_mb'] = rss / 1024.0
+    q.put(result)
+
+
+def measure(fn, *args):
+    """Runs fn(*args) in a child process, returns its result dict with the
+    peak RSS of the run."""
+    q = Queue()
+    p = Process(target=_child, args=(q, fn, args))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+
+def stage_latencies(events):
+    stages = {}
+    for event in events:
+        stages.setdefault(event['stage'], []).append(event['duration'])
+    return dict((stage, [float(v) for v in np.percentile(durations, PERCENTILES)])
+                for stage, durations in stages.items())
+
+
+def report(result):
+    if 'error' in result:
+        print("{:<6s} {:s} ERROR {:s}".format(result['phase'], result['config'],
+                                              result['error']))
+        return
+    print("{:<6s} {:<36s} pages={:<5d} tiles={:<4d} {:7.1f}s {:7.2f} pages/s "
+          "rss={:7.1f}MB moved={:8.1f}MB".format(
+              result['phase'], result['config'], result['pages'], result['tiles'],
+              result['seconds'], result['pages_per_sec'], result['peak_rss_mb'],
+              result['bytes'] / (1024.0 * 1024)))
+    for stage, values in sorted(result['latency'].items()):
+        print("       {:<10s} ".format(stage) + ' '.join(
+            'p{:d}={:0.3f}s'.format(p, v) for p, v in zip(PERCENTILES, values)))
+
+
+def run_config(phase, config, fn, events_dir, *args):
+    shutil.rmtree(events_dir, ignore_errors=True)
+    os.makedirs(events_dir)
+    result = measure(fn, *(args + (events_dir,)))
+    result['phase'] = phase
+    result['config'] = config
+    if 'error' not in result:
+        result['pages_per_sec'] = result['pages'] / max(result['seconds'], 1e-6)
+        result['latency'] = stage_latencies(load_events(events_dir))
+    report(result)
+    return result
+
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+
+if __name__ == "__main__":
+    title = 'Benchmark split_elex_rolls.py and google_vision_ocr_gcs.py offline'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('--pdfs', type=int, default=2,
+                        help='Number of synthetic PDFs (Default: 2)')
+    parser.add_argument('--pages', type=int, default=20,
+                        help='Pages per synthetic PDF (Default: 20)')
+    parser.add_argument('--resolutions', type=int_list, default=[150, 300],
+                        help='Comma separated --resolution values (Default: 150,300)')
+    parser.add_argument('--batches', type=int_list, default=[5, 10],
+                        help='Comma separated --batch values (Default: 5,10)')
+    parser.add_argument('--processes', type=int_list, default=[2, 4],
+                        help='Comma separated --processes values (Default: 2,4)')
+    parser.add_argument('--pipelines', default='pool,async',
+                        help='Comma separated OCR --pipeline values (Default: pool,async)')
+    parser.add_argument('--local-latency', type=float, default=0.5,
+                        help='Seconds each local OCR operation takes (Default: 0.5)')
+    parser.add_argument('--local-jitter', type=float, default=0.2,
+                        help='Random +/- seconds added to the latency (Default: 0.2)')
+    parser.add_argument('--poll-interval', type=float, default=0.2,
+                        help='Async pipeline poll interval (Default: 0.2)')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory for PDFs, tiles and outputs '
+                             '(Default: a temporary directory, removed at the end)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON lines file for the results')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic PDFs (Default: 0)')
+    args = parser.parse_args()
+
+    work = args.work_dir or tempfile.mkdtemp(prefix='ocr-bench-')
+    events_dir = os.path.join(work, 'events')
+    pdf_dir = os.path.join(work, 'pdfs')
+    if not os.path.exists(pdf_dir):
+        os.makedirs(pdf_dir)
+    rnd = random.Random(args.seed)
+    for i in range(args.pdfs):
+        make_roll_pdf(os.path.join(pdf_dir, 'roll{:03d}.pdf'.format(i)), args.pages, rnd)
+    pdf_files = sorted(glob.glob(os.path.join(pdf_dir, '*.pdf')))
+
+    results = []
+    try:
+        tiles = {}
+        for resolution, batch, processes in itertools.product(
+                args.resolutions, args.batches, args.processes):
+            config = 'r={:d} b={:d} p={:d}'.format(resolution, batch, processes)
+            png_dir = os.path.join(work, 'png-r{:d}-b{:d}-p{:d}'.format(
+                resolution, batch, processes))
+            argv = [pdf_dir, '-r', str(resolution), '-b', str(batch),
+                    '-p', str(processes), '-o', png_dir]
+            results.append(run_config('split', config, run_split, events_dir,
+                                      argv, pdf_files))
+            tiles.setdefault((resolution, batch), png_dir)
+
+        for (resolution, batch), png_dir in sorted(tiles.items()):
+            for processes, pipeline in itertools.product(
+                    args.processes, args.pipelines.split(',')):
+                config = 'r={:d} b={:d} p={:d} {:s}'.format(
+                    resolution, batch, processes, pipeline)
+                out_dir = os.path.join(work, 'out-r{:d}-b{:d}-p{:d}-{:s}'.format(
+                    resolution, batch, processes, pipeline))
+                argv = [png_dir, '--backend', 'local',
+                        '--local-root', os.path.join(work, 'backend'),
+                        '--local-latency', str(args.local_latency),
+                        '--local-jitter', str(args.local_jitter),
+                        '--poll-interval', str(args.poll_interval),
+                        '-p', str(processes), '--pipeline', pipeline,
+                        '-o', out_dir, '--log-level', 'WARNING']
+                results.append(run_config('ocr', config, run_ocr, events_dir, argv))
+    finally:
+        if args.output:
+            with open(args.output, 'w') as f:
+                for result in results:
+                    f.write(json.dumps(result) + '\n')
+        if args.work_dir is None:
+            shutil.rmtree(work, ignore_errors=True)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+extract_voters.py: goes through the saved OCR results of a directory of
+tiles (.npz, else .json or .pb, see ocr_results.py) and writes one CSV
+row per voter card found by ocr_layout.py, with the tile, PDF page, grid
+row and column and the card fields.
+"""
+
+import csv
+import time
+import argparse
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import ocr_layout
+import ocr_results
+
+
+CSV_FIELDS = ('tile', 'page', 'row', 'col') + ocr_layout.FIELDS
+
+
+def voter_worker(args, name):
+    start = time.time()
+    columns = ocr_results.load_columns(ocr_results.find_result(args.directory, name))
+    records = ocr_layout.extract_voters(columns, name)
+    for record in records:
+        record['tile'] = name
+    return name, records, time.time() - start
+
+
+if __name__ == "__main__":
+    title = 'Extract voter records from saved OCR results'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains NPZ or result files')
+    parser.add_argument('-o', '--output', default='voters.csv',
+                        help='CSV output file (Default: voters.csv)')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    print(args)
+
+    names = ocr_results.result_names(args.directory)
+
+    start = time.time()
+    nvoter = 0
+    pool = Pool(args.processes)
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, CSV_FIELDS)
+        writer.writeheader()
+        for name, records, duration in pool.imap_unordered(
+                partial(voter_worker, args), names, chunksize=8):
+            writer.writerows(records)
+            nvoter += len(records)
+            print("Done: {:s} voters={:d} duration={:0.2f}s".format(
+                name, len(records), duration))
+    pool.close()
+    pool.join()
+
+    duration = time.time() - start
+    print("Total: tiles={:d} voters={:d} duration={:0.1f}s ({:0.0f} tiles/min)".format(
+        len(names), nvoter, duration, 60 * len(names) / max(duration, 1e-6)))
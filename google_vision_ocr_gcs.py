@@ -18,12 +18,11 @@ import tempfile
 import json
 import logging
 
-from enum import Enum
 from glob import glob
 from multiprocessing import Pool, Queue
 from functools import partial
 
-from google.cloud import storage
+from google.api_core import exceptions
 from google.cloud import vision
 from google.cloud.vision import types
 from google.protobuf import json_format
@@ -32,21 +31,54 @@ from PIL import Image, ImageDraw
 
 from logutils.queue import QueueHandler, QueueListener
 
+import ocr_backend
+import ocr_bounds
+import ocr_cache
+import ocr_columns
+import ocr_encode
+import ocr_limits
+import ocr_manifest
+import ocr_metrics
+import ocr_pages
+import ocr_results
+import ocr_retry
+
 
 MAX_RETRY = 10
 GOOGLE_OPERATION_TIMEOUT = 600
+# Uploads bigger than this are sent as a resumable upload in chunks of
+# UPLOAD_CHUNK_SIZE (must be a multiple of 256KB).
+RESUMABLE_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+FEATURE_TYPE = vision.enums.Feature.Type.DOCUMENT_TEXT_DETECTION
+LANGUAGE_HINTS = ['en']
 LOG_FILE = 'mplog.log'
+TITLE = 'OCR PNG files in the directory using Google Vision API'
 
 
-def worker_init(q, level=logging.INFO):
+def worker_init(q, level=logging.INFO, backend=None, cache=None, manifest=None,
+                retrier=None, columns=(False, False), metrics=False, limiter=None,
+                encoding=None, result_format=None):
     # all records from worker processes go to qh and then into q
     qh = QueueHandler(q)
     logger = logging.getLogger()
     logger.setLevel(level)
     logger.addHandler(qh)
-
-
-def logger_init(level=logging.INFO):
+    if backend is not None:
+        ocr_backend.set_backend(backend)
+    ocr_cache.set_cache(cache)
+    ocr_manifest.set_manifest(manifest)
+    ocr_retry.set_retrier(retrier)
+    ocr_columns.set_columns(*columns)
+    ocr_metrics.set_metrics(metrics)
+    ocr_limits.set_limiter(limiter)
+    ocr_encode.set_encoding(encoding)
+    ocr_results.set_format(result_format)
+    # build the storage/vision clients once, every tile of this worker reuses them
+    ocr_backend.get_backend().init_clients()
+
+
+def logger_init(level=logging.INFO, metrics_handlers=()):
     q = Queue()
 
     # this is the handler for all log records
@@ -58,40 +90,24 @@ def logger_init(level=logging.INFO):
     f = logging.Formatter('%(asctime)s %(processName)-10s %(name)s %(levelname)-8s %(message)s')
     file_handler.setFormatter(f)
 
+    # stage timing events only go to the metrics handlers
+    handler.addFilter(ocr_metrics.SkipEvents())
+    file_handler.addFilter(ocr_metrics.SkipEvents())
+    handlers = [handler, file_handler] + list(metrics_handlers)
+
     # ql gets records from the queue and sends them to the handler
-    ql = QueueListener(q, handler, file_handler)
+    ql = QueueListener(q, *handlers)
     ql.start()
 
     logger = logging.getLogger()
     logger.setLevel(level)
     # add the handler to the logger so records from this process are handled
-    logger.addHandler(handler)
-    logger.addHandler(file_handler)
+    for h in handlers:
+        logger.addHandler(h)
 
     return ql, q
 
 
-class FeatureType(Enum):
-    PAGE = 1
-    BLOCK = 2
-    PARA = 3
-    WORD = 4
-    SYMBOL = 5
-
-
-def draw_boxes(image, bounds, color):
-    """Draw a border around the image using the hints in the vector list."""
-    draw = ImageDraw.Draw(image)
-
-    for bound in bounds:
-        draw.polygon([
-            bound.vertices[0].x, bound.vertices[0].y,
-            bound.vertices[1].x, bound.vertices[1].y,
-            bound.vertices[2].x, bound.vertices[2].y,
-            bound.vertices[3].x, bound.vertices[3].y], None, color)
-    return image
-
-
 def draw_norm_boxes(image, bounds, color):
     """Draw a border around the image using the hints in the vector list."""
     draw = ImageDraw.Draw(image)
@@ -108,25 +124,53 @@ def draw_norm_boxes(image, bounds, color):
 
 def download_blob(bucket_name, src_blob_name, dst_file_name):
     """Downloads a blob from the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = ocr_backend.get_backend().get_bucket(bucket_name)
     blob = bucket.blob(src_blob_name)
     blob.download_to_filename(dst_file_name)
 
 
 def upload_blob(bucket_name, source_file_name, destination_blob_name):
     """Uploads a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = ocr_backend.get_backend().get_bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
     blob.upload_from_filename(source_file_name)
 
 
+def upload_blob_from_file(bucket_name, file_obj, destination_blob_name,
+                          content_type=None):
+    """Streams a file-like object (e.g. BytesIO) to the bucket."""
+    bucket = ocr_backend.get_backend().get_bucket(bucket_name)
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    chunk_size = UPLOAD_CHUNK_SIZE if size > RESUMABLE_UPLOAD_THRESHOLD else None
+    blob = bucket.blob(destination_blob_name, chunk_size=chunk_size)
+
+    blob.upload_from_file(file_obj, rewind=True, size=size,
+                          content_type=content_type)
+
+
+def download_blob_data(blob):
+    """Streams a blob into memory, returns its bytes."""
+    buf = io.BytesIO()
+    blob.download_to_file(buf)
+    data = buf.getvalue()
+    buf.close()
+    return data
+
+
+def download_blob_json(blob):
+    """Streams a JSON blob into memory and parses it."""
+    # json.loads takes the bytes directly, so no extra decoded copy of the
+    # string is kept.
+    data = download_blob_data(blob)
+    logging.debug('JSON len={:d}'.format(len(data)))
+    return json.loads(data)
+
+
 def delete_blob(bucket_name, blob_name):
     """Deletes a blob from the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = ocr_backend.get_backend().get_bucket(bucket_name)
     blob = bucket.blob(blob_name)
 
     blob.delete()
@@ -134,15 +178,52 @@ def delete_blob(bucket_name, blob_name):
 
 def delete_bucket(bucket_name):
     """Deletes a bucket. The bucket must be empty."""
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    backend = ocr_backend.get_backend()
+    bucket = backend.get_bucket(bucket_name)
     bucket.delete()
+    backend.forget_bucket(bucket_name)
 
 
 def create_bucket(bucket_name):
     """Creates a new bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.create_bucket(bucket_name)
+    ocr_backend.get_backend().create_bucket(bucket_name)
+
+
+def work_bucket(args, manifest=None):
+    """Sets args.bucket_name (and args.auto_bucket) when no --bucket-name is
+    given: the bucket of the interrupted run recorded in the manifest if it
+    is still there, else a new one, recorded for the next run."""
+    args.auto_bucket = False
+    if args.bucket_name is not None:
+        return
+    if manifest is not None:
+        # resume in the bucket of the interrupted run if it is still there
+        bucket_name = manifest.get_meta('bucket_name')
+        if bucket_name and ocr_backend.get_backend().bucket_exists(bucket_name):
+            args.bucket_name = bucket_name
+            args.auto_bucket = True
+            return
+    while True:
+        try:
+            args.bucket_name = get_bucket_name()
+            create_bucket(args.bucket_name)
+            args.auto_bucket = True
+            if manifest is not None:
+                manifest.set_meta('bucket_name', args.bucket_name)
+            break
+        except Exception as e:
+            print(e)
+
+
+def release_bucket(bucket_name, manifest=None):
+    """Deletes a bucket made by work_bucket, unless the manifest still has
+    tiles to resume from it."""
+    unfinished = manifest.unfinished(bucket_name) if manifest is not None else 0
+    if unfinished:
+        logging.warn('Keeping bucket {!s} for the {:d} unfinished tiles of the '
+                     'manifest'.format(bucket_name, unfinished))
+        return
+    delete_bucket(bucket_name)
 
 
 def get_bucket_name():
@@ -150,37 +231,61 @@ def get_bucket_name():
     return temp_name
 
 
-def async_detect_document_text(bucket_name, image_file, textfile, jsonfile):
-    # Supported mime_types are: 'application/pdf' and 'image/tiff'
-    mime_type = 'image/tiff'
+def tile_name(image_file):
+    png_fn = os.path.basename(image_file)
+    return os.path.splitext(png_fn)[0]
 
-    tmp_dir = tempfile._get_default_tempdir()
 
-    png_fn = os.path.basename(image_file)
-    fn = os.path.splitext(png_fn)[0]
-    tif_fn = fn + '.tif'
-    prefix_fn = fn + '-'
-    tif_path = os.path.join(tmp_dir, tif_fn)
+def tiff_blob_name(image_file):
+    return tile_name(image_file) + '.tif'
 
-    gcs_src_uri = 'gs://{}/{}'.format(bucket_name, tif_fn)
-    gcs_dst_uri = 'gs://{}/{}'.format(bucket_name, prefix_fn)
 
-    logging.info('Converting... {!s}'.format(png_fn))
-    with Image.open(image_file) as im:
-        im.save(tif_path, compression='tiff_lzw', tiffinfo={317: 2, 278: 1})
+def encode_tiff(im):
+    """Encodes an image as TIFF in memory with the --tiff-profile encoding,
+    returns the TIFF bytes."""
+    data, label = ocr_encode.get_encoding().encode(im)
+    logging.debug('TIFF {!s} len={:d}'.format(label, len(data)))
+    return data
+
+
+def convert_to_tiff(image_file):
+    logging.info('Converting... {!s}'.format(os.path.basename(image_file)))
+    with ocr_metrics.timed('convert', tile_name(image_file)) as event:
+        with Image.open(image_file) as im:
+            tif_data = encode_tiff(im)
+        event['bytes'] = len(tif_data)
+    return tif_data
+
+
+def upload_tiff(bucket_name, tif_data, tif_fn):
     logging.info('Uploading... {!s}'.format(tif_fn))
-    upload_blob(bucket_name, tif_path, tif_fn)
+    with ocr_metrics.timed('upload', os.path.splitext(tif_fn)[0], bytes=len(tif_data)):
+        upload_blob_from_file(bucket_name, io.BytesIO(tif_data), tif_fn,
+                              content_type='image/tiff')
 
-    os.unlink(tif_path)
 
-    # How many pages should be grouped into each json output file.
-    # With a file of 1 pages
-    batch_size = 1
+def convert_and_upload(bucket_name, image_file):
+    """Converts a PNG file to TIFF and uploads it, returns the blob name."""
+    name = tile_name(image_file)
+    tif_fn = tiff_blob_name(image_file)
+    retrier = ocr_retry.get_retrier()
+    tif_data = retrier.call('convert', convert_to_tiff, image_file)
+    ocr_manifest.checkpoint(name, ocr_manifest.CONVERTED, bucket=bucket_name)
+    retrier.call('upload', upload_tiff, bucket_name, tif_data, tif_fn)
+    ocr_manifest.checkpoint(name, ocr_manifest.UPLOADED, tif_blob=tif_fn)
+    return tif_fn
 
-    client = vision.ImageAnnotatorClient()
 
-    feature = types.Feature(
-        type=vision.enums.Feature.Type.DOCUMENT_TEXT_DETECTION)
+def make_async_request(bucket_name, src_blob_name, dst_prefix,
+                       mime_type='image/tiff', batch_size=1):
+    # Supported mime_types are: 'application/pdf' and 'image/tiff'
+    # batch_size: how many pages should be grouped into each json output
+    # file, a tile is a file of 1 page
+
+    gcs_src_uri = 'gs://{}/{}'.format(bucket_name, src_blob_name)
+    gcs_dst_uri = 'gs://{}/{}'.format(bucket_name, dst_prefix)
+
+    feature = types.Feature(type=FEATURE_TYPE)
 
     gcs_src = types.GcsSource(uri=gcs_src_uri)
     input_config = types.InputConfig(gcs_source=gcs_src,
@@ -190,33 +295,33 @@ def async_detect_document_text(bucket_name, image_file, textfile, jsonfile):
     output_config = types.OutputConfig(gcs_destination=gcs_dst,
                                     batch_size=batch_size)
 
-    image_context = types.ImageContext(language_hints=['en'])
+    image_context = types.ImageContext(language_hints=LANGUAGE_HINTS)
 
-    async_request = types.AsyncAnnotateFileRequest(
+    return types.AsyncAnnotateFileRequest(
         features=[feature], input_config=input_config,
         output_config=output_config, image_context=image_context)
 
-    operation = client.async_batch_annotate_files(
-        requests=[async_request])
-
-    logging.info('Waiting... {!s}'.format(gcs_src_uri))
-    result = operation.result(timeout=GOOGLE_OPERATION_TIMEOUT)
-    logging.debug('{!s}'.format(result))
-
-    delete_blob(bucket_name, tif_fn)
 
+def list_outputs(gcs_dst_uri):
+    """Lists the output blobs of a request."""
     # Once the request has completed and the output has been
     # written to GCS, we can list all the output files.
-    storage_client = storage.Client()
-
     match = re.match(r'gs://([^/]+)/(.+)', gcs_dst_uri)
     bucket_name = match.group(1)
     prefix = match.group(2)
 
-    bucket = storage_client.get_bucket(bucket_name=bucket_name)
+    bucket = ocr_backend.get_backend().get_bucket(bucket_name)
 
     # List objects with the given prefix.
-    blob_list = list(bucket.list_blobs(prefix=prefix))
+    return list(bucket.list_blobs(prefix=prefix))
+
+
+def fetch_document(gcs_dst_uri, textfile, jsonfile):
+    """Downloads the first output file of a finished request and saves it."""
+    blob_list = list_outputs(gcs_dst_uri)
+    if not blob_list:
+        # listings can lag behind the end of the operation
+        raise exceptions.NotFound('No output at {!s}'.format(gcs_dst_uri))
 
     # Process the first output file from GCS.
     # Since we specified batch_size=1, the first response contains
@@ -225,36 +330,272 @@ def async_detect_document_text(bucket_name, image_file, textfile, jsonfile):
 
     logging.info('Downloading... {!s}'.format(output.name))
 
-    json_string = output.download_as_string()
+    name = os.path.basename(gcs_dst_uri)[:-1]
+    with ocr_metrics.timed('download', name) as event:
+        data = download_blob_data(output)
+        event['bytes'] = len(data)
+    logging.debug('JSON len={:d}'.format(len(data)))
 
-    logging.debug('JSON len={:d}'.format(len(json_string)))
-
-    response = json_format.Parse(
-        json_string, types.AnnotateFileResponse())
+    with ocr_metrics.timed('parse', name, bytes=len(data)):
+        response = json_format.ParseDict(json.loads(data), types.AnnotateFileResponse())
+    del data
 
     error = response.responses[0].error
     if error.code != 0:
-        logging.error("Vision API code: {!s}, msg: {!s}".format(error.code, error.message))
-        return None
+        output.delete()
+        raise ocr_retry.VisionError(error.code, error.message)
 
     # The actual response for the first page of the input file.
     document = response.responses[0].full_text_annotation
 
-    if textfile is not 0:
-        logging.info('Saving... {!s}'.format(textfile))
-        with io.open(textfile, 'wb') as f:
-            f.write(document.text.encode('utf-8'))
-
-    if jsonfile is not 0:
-        logging.info('Saving... {!s}'.format(jsonfile))
-        with io.open(jsonfile, 'wb') as f:
-            f.write(json_format.MessageToJson(document))
+    save_document(document, textfile, jsonfile)
 
     output.delete()
 
     return document
 
 
+def save_document(document, textfile, jsonfile):
+    outfile = jsonfile or textfile
+    with ocr_metrics.timed('save', tile_name(outfile) if outfile else None, bytes=0) as event:
+        if textfile is not 0:
+            logging.info('Saving... {!s}'.format(textfile))
+            data = document.text.encode('utf-8')
+            with io.open(textfile, 'wb') as f:
+                f.write(data)
+            event['bytes'] += len(data)
+
+        if jsonfile is not 0:
+            event['bytes'] += ocr_results.save_document(document, jsonfile)
+            ocr_columns.save_document_columns(document, jsonfile)
+
+
+def tile_cache_key(image_file=None, data=None):
+    """Returns the OCR cache key of a tile given as a file or as bytes and
+    of the TIFF encoding it is uploaded in, None when the cache is off."""
+    if ocr_cache.get_cache() is None:
+        return None
+    if data is None:
+        with io.open(image_file, 'rb') as f:
+            data = f.read()
+    return ocr_cache.cache_key(data, FEATURE_TYPE, LANGUAGE_HINTS,
+                               ocr_encode.get_encoding().key())
+
+
+def lookup_document(key, textfile, jsonfile):
+    """Returns the cached document of a tile (and saves its text and JSON
+    files), None on a cache miss."""
+    if key is None:
+        return None
+    document = ocr_cache.get_cache().get(key)
+    if document is not None:
+        save_document(document, textfile, jsonfile)
+    return document
+
+
+def store_document(key, document):
+    if key is not None and document:
+        ocr_cache.get_cache().put(key, document)
+
+
+def resume_stage(bucket_name, name):
+    """Returns (stage, row): the manifest stage a tile can resume from, None
+    to start from scratch. A stage is only trusted if its blobs are still
+    in the bucket."""
+    row = ocr_manifest.lookup(name)
+    if row is None or row['bucket'] != bucket_name:
+        return None, row
+    stage = row['stage']
+    if stage in (ocr_manifest.SUBMITTED, ocr_manifest.DONE) and \
+            list_outputs('gs://{}/{}-'.format(bucket_name, name)):
+        return ocr_manifest.DONE, row
+    if stage in (ocr_manifest.UPLOADED, ocr_manifest.SUBMITTED):
+        bucket = ocr_backend.get_backend().get_bucket(bucket_name)
+        if bucket.blob(name + '.tif').exists():
+            return stage, row
+    return None, row
+
+
+def reattach_operation(operation_name):
+    """Returns the operation of a previous run, None if it is gone."""
+    try:
+        operation = ocr_backend.get_backend().get_operation(operation_name)
+        logging.info('Re-attached... {!s}'.format(operation_name))
+        return operation
+    except Exception as e:
+        logging.warn('Cannot re-attach {!s}: {!s}'.format(operation_name, e))
+        return None
+
+
+def submit_request(name, async_request, operation_name=None, take_token=True):
+    """Starts the OCR operation of a tile, or re-attaches to the operation
+    of a previous run when its name is known. A new request first takes a
+    token of the rate limiter unless the caller took it already."""
+    if operation_name:
+        operation = reattach_operation(operation_name)
+        if operation is not None:
+            return operation
+
+    if take_token:
+        ocr_limits.take_token()
+    client = ocr_backend.get_backend().vision_client()
+    with ocr_metrics.timed('submit', name):
+        operation = client.async_batch_annotate_files(
+            requests=[async_request])
+    ocr_manifest.checkpoint(
+        name, ocr_manifest.SUBMITTED, operation=operation.operation.name,
+        output_prefix=async_request.output_config.gcs_destination.uri)
+    return operation
+
+
+def submit_batch(names, requests):
+    """Starts one OCR operation for the requests of a group of tiles."""
+    ocr_limits.take_token(len(requests))
+    client = ocr_backend.get_backend().vision_client()
+    with ocr_metrics.timed('submit', ','.join(names), tiles=len(names)):
+        return client.async_batch_annotate_files(requests=requests)
+
+
+def wait_operation(name, operation):
+    """Blocks until the OCR operation of a tile (or of the comma separated
+    tiles of a group) is done, returns its result."""
+    with ocr_metrics.timed('wait', name, tiles=name.count(',') + 1):
+        return operation.result(timeout=GOOGLE_OPERATION_TIMEOUT)
+
+
+def delete_input_blob(bucket_name, tif_fn):
+    # a resumed tile may have lost its input blob already, and a blob left
+    # behind is not worth failing the tile
+    try:
+        delete_blob(bucket_name, tif_fn)
+    except exceptions.NotFound:
+        pass
+    except Exception as e:
+        logging.warn('Cannot delete {!s}: {!s}'.format(tif_fn, e))
+
+
+def forget_tile(name):
+    """Drops the manifest row of a tile whose result was a Vision error, so
+    the next attempt starts over."""
+    manifest = ocr_manifest.get_manifest()
+    if manifest is not None:
+        manifest.reset(name)
+
+
+def async_detect_document_text_batch(bucket_name, image_files, textfiles, jsonfiles):
+    """OCR a group of PNG files with a single async_batch_annotate_files
+    operation, one AsyncAnnotateFileRequest per file. Files found in the
+    OCR cache are not sent, files with a resumable manifest stage are
+    resumed one by one.
+
+    Returns the documents in input order, None for a file that failed.
+    """
+    documents = [None] * len(image_files)
+    todo = []
+    for i, image_file in enumerate(image_files):
+        key = tile_cache_key(image_file)
+        documents[i] = lookup_document(key, textfiles[i], jsonfiles[i])
+        if documents[i] is not None:
+            continue
+        if resume_stage(bucket_name, tile_name(image_file))[0] is not None:
+            try:
+                documents[i] = async_detect_document_text(
+                    bucket_name, image_file, textfiles[i], jsonfiles[i])
+            except Exception as e:
+                logging.error('{!s}: {!s}'.format(image_file, e))
+            continue
+        todo.append((i, key))
+    if not todo:
+        return documents
+
+    retrier = ocr_retry.get_retrier()
+    names = [tile_name(image_files[i]) for i, _ in todo]
+
+    tif_fns = []
+    requests = []
+    try:
+        # in the try, the blobs uploaded before a failed upload are deleted
+        for i, key in todo:
+            tif_fn = convert_and_upload(bucket_name, image_files[i])
+            prefix_fn = os.path.splitext(tif_fn)[0] + '-'
+            tif_fns.append(tif_fn)
+            requests.append(make_async_request(bucket_name, tif_fn, prefix_fn))
+
+        with ocr_limits.operation_slot():
+            operation = retrier.call('submit', submit_batch, names, requests)
+            for (i, key), request in zip(todo, requests):
+                ocr_manifest.checkpoint(
+                    tile_name(image_files[i]), ocr_manifest.SUBMITTED,
+                    operation=operation.operation.name,
+                    output_prefix=request.output_config.gcs_destination.uri)
+
+            logging.info('Waiting... {!s}'.format(', '.join(tif_fns)))
+            result = retrier.call('wait', wait_operation, ','.join(names), operation)
+        logging.debug('{!s}'.format(result))
+        for i, key in todo:
+            ocr_manifest.checkpoint(tile_name(image_files[i]), ocr_manifest.DONE)
+    finally:
+        for tif_fn in tif_fns:
+            delete_input_blob(bucket_name, tif_fn)
+
+    for (i, key), request in zip(todo, requests):
+        gcs_dst_uri = request.output_config.gcs_destination.uri
+        try:
+            documents[i] = retrier.call('download', fetch_document, gcs_dst_uri,
+                                        textfiles[i], jsonfiles[i])
+            store_document(key, documents[i])
+        except Exception as e:
+            logging.error('{!s}: {!s}'.format(gcs_dst_uri, e))
+            if isinstance(e, ocr_retry.VisionError):
+                ocr_limits.report_error(e)
+                forget_tile(tile_name(image_files[i]))
+    return documents
+
+
+def async_detect_document_text(bucket_name, image_file, textfile, jsonfile):
+    key = tile_cache_key(image_file)
+    document = lookup_document(key, textfile, jsonfile)
+    if document is not None:
+        return document
+
+    name = tile_name(image_file)
+    stage, row = resume_stage(bucket_name, name)
+    if stage is not None:
+        logging.info('Resuming {!s} from stage {!s}'.format(name, stage))
+
+    tif_fn = tiff_blob_name(image_file)
+    prefix_fn = os.path.splitext(tif_fn)[0] + '-'
+    async_request = make_async_request(bucket_name, tif_fn, prefix_fn)
+
+    if stage is None:
+        convert_and_upload(bucket_name, image_file)
+
+    if stage != ocr_manifest.DONE:
+        operation_name = row['operation'] if stage == ocr_manifest.SUBMITTED else None
+        with ocr_limits.operation_slot():
+            operation = ocr_retry.get_retrier().call(
+                'submit', submit_request, name, async_request, operation_name)
+
+            gcs_src_uri = async_request.input_config.gcs_source.uri
+            logging.info('Waiting... {!s}'.format(gcs_src_uri))
+            result = ocr_retry.get_retrier().call('wait', wait_operation, name, operation)
+        logging.debug('{!s}'.format(result))
+        ocr_manifest.checkpoint(name, ocr_manifest.DONE)
+
+    delete_input_blob(bucket_name, tif_fn)
+
+    gcs_dst_uri = async_request.output_config.gcs_destination.uri
+    try:
+        document = ocr_retry.get_retrier().call(
+            'download', fetch_document, gcs_dst_uri, textfile, jsonfile)
+    except ocr_retry.VisionError as e:
+        ocr_limits.report_error(e)
+        forget_tile(name)
+        raise
+    store_document(key, document)
+    return document
+
+
 def denorm_bbox(page, bbox):
     bb  = types.BoundingPoly()
     vertices = []
@@ -267,72 +608,102 @@ def denorm_bbox(page, bbox):
     return bb
 
 
-def get_document_bounds(document, feature):
-    # [START vision_document_text_tutorial_detect_bounds]
-    bounds = []
-
-    # Collect specified feature bounds by enumerating all document features
-    for page in document.pages:
-        for block in page.blocks:
-            for paragraph in block.paragraphs:
-                for word in paragraph.words:
-                    for symbol in word.symbols:
-                        if (feature == FeatureType.SYMBOL):
-                            bounds.append(symbol.bounding_box)
-
-                    if (feature == FeatureType.WORD):
-                        bounds.append(word.bounding_box)
-
-                if (feature == FeatureType.PARA):
-                    bounds.append(paragraph.bounding_box)
+def render_overlay(doc, filein, fileout, name=None):
+    """Draws the bounding boxes over the input image (a file name or a
+    file object), returns the mean block confidence. Nothing is drawn
+    when fileout is None."""
+    if fileout is None:
+        return ocr_bounds.extract_bounds(doc, levels=()).confidence
+    with ocr_metrics.timed('render', name or (tile_name(fileout) if fileout else None)):
+        bounds = ocr_bounds.extract_bounds(doc)
+        image = Image.open(filein)
+        if image.mode != 'RGB':
+            # a streamed tile is the uploaded TIFF, e.g. bilevel
+            image = image.convert('RGB')
+        ocr_bounds.draw_bounds(image, bounds)
+
+        if fileout is not 0:
+            image.save(fileout)
+        else:
+            image.show()
 
-            if (feature == FeatureType.BLOCK):
-                bounds.append(block.bounding_box)
+    return bounds.confidence
 
-        if (feature == FeatureType.PAGE):
-            bounds.append(block.bounding_box)
 
-    # The list `bounds` contains the coordinates of the bounding boxes.
-    # [END vision_document_text_tutorial_detect_bounds]
-    return bounds
+def render_overlay_saved(doc, filein, fileout):
+    """Renders the overlay with retries and marks the tile as saved."""
+    conf = ocr_retry.get_retrier().call('render', render_overlay, doc, filein, fileout)
+    ocr_manifest.checkpoint(tile_name(filein), ocr_manifest.SAVED)
+    return conf
 
 
 def render_doc_text(bucket_name, filein, fileout, textfile, jsonfile):
+    """OCR a tile and renders its overlay. Stages retry on their own; only
+    an error answered by the Vision API sends a new request, up to
+    MAX_RETRY times. A tile that gives up goes to the dead-letter list."""
+    retrier = ocr_retry.get_retrier()
     retry = 0
     while True:
         try:
             doc = async_detect_document_text(bucket_name, filein, textfile, jsonfile)
-            if doc:
-                image = Image.open(filein)
-                bounds = get_document_bounds(doc, FeatureType.BLOCK)
-                draw_boxes(image, bounds, 'blue')
-                bounds = get_document_bounds(doc, FeatureType.PARA)
-                draw_boxes(image, bounds, 'red')
-                bounds = get_document_bounds(doc, FeatureType.WORD)
-                draw_boxes(image, bounds, 'green')
-
-                if fileout is not 0:
-                    image.save(fileout)
-                else:
-                    image.show()
-
-                n = 0
-                sum = 0
-                for p in doc.pages:
-                    for b in p.blocks:
-                        sum += b.confidence
-                        n += 1.0
-                conf = (sum / n)
-                break
+            return render_overlay_saved(doc, filein, fileout)
         except Exception as e:
             logging.error('{!s}'.format(e))
-        logging.warn('retry={:d}'.format(retry))
-        retry += 1
-        if retry > MAX_RETRY:
-            logging.error('Max retry, stoppped!!!')
-            conf = 0
-            break
-    return conf
+            retry += 1
+            stage = getattr(e, 'stage', 'ocr')
+            if ocr_retry.classify(e) != ocr_retry.REQUEST:
+                retrier.dead_letter(tile_name(filein), stage, e)
+                return 0
+            if retry > MAX_RETRY:
+                logging.error('Max retry, stoppped!!!')
+                retrier.dead_letter(tile_name(filein), stage, e)
+                return 0
+        delay = retrier.delay('request', retry)
+        logging.warn('retry={:d} in {:0.1f}s'.format(retry, delay))
+        time.sleep(delay)
+
+
+def render_doc_text_batch(bucket_name, fileins, fileouts, textfiles, jsonfiles):
+    """Same as render_doc_text for a group of files sharing one operation.
+    Files that fail in the batch are retried one by one."""
+    try:
+        docs = async_detect_document_text_batch(bucket_name, fileins, textfiles, jsonfiles)
+    except Exception as e:
+        logging.error('{!s}'.format(e))
+        docs = [None] * len(fileins)
+
+    confs = []
+    for doc, filein, fileout, textfile, jsonfile in zip(docs, fileins, fileouts, textfiles, jsonfiles):
+        if doc:
+            # the OCR result is there, a failed overlay is not a reason to pay again
+            try:
+                conf = render_overlay_saved(doc, filein, fileout)
+            except Exception as e:
+                ocr_retry.get_retrier().dead_letter(tile_name(filein), 'render', e)
+                conf = 0
+        else:
+            logging.warn('Batch failed, retry alone... {!s}'.format(filein))
+            conf = render_doc_text(bucket_name, filein, fileout, textfile, jsonfile)
+        confs.append(conf)
+    return confs
+
+
+def is_done(args, name, fileout):
+    """True when the tile needs no OCR: saved according to the manifest,
+    or without a manifest, when its output (the result file if overlays
+    are off) exists."""
+    if args.overwritten:
+        return False
+    if ocr_manifest.get_manifest() is not None:
+        row = ocr_manifest.lookup(name)
+        return row is not None and row['stage'] == ocr_manifest.SAVED
+    jsonfile = os.path.join(os.path.dirname(fileout), name + '.json')
+    return ocr_results.is_saved(jsonfile, None if args.no_overlay else fileout)
+
+
+def overlay_file(args, fileout):
+    """The overlay PNG to write, None when overlays are off."""
+    return None if args.no_overlay else fileout
 
 
 def ocr_worker(args, filein):
@@ -340,20 +711,54 @@ def ocr_worker(args, filein):
     base_fn = os.path.basename(filein)
     fn = os.path.splitext(base_fn)[0]
     fileout = os.path.join(args.output, fn + '.png')
-    if os.path.exists(fileout) and not args.overwritten:
+    if is_done(args, fn, fileout):
         logging.info(" - Output exists, skip...")
         return None
     textfile = os.path.join(args.output, fn + '.txt')
     jsonfile = os.path.join(args.output, fn + '.json')
     start = time.time()
     conf = 0
-    conf = render_doc_text(args.bucket_name, filein, fileout, textfile, jsonfile)
+    conf = render_doc_text(args.bucket_name, filein, overlay_file(args, fileout),
+                           textfile, jsonfile)
     duration = time.time() - start
     logging.info(" - Duration: %0.1f" % (duration))
     logging.info(" - Confidence: %0.4f" % (conf))
+    ocr_metrics.emit('tile', fn, duration, confidence=conf)
     return (fileout, duration, conf)
 
 
+def ocr_batch_worker(args, fileins):
+    results = [None] * len(fileins)
+    todo = []
+    for i, filein in enumerate(fileins):
+        logging.info('Processing...{:s}'.format(filein))
+        base_fn = os.path.basename(filein)
+        fn = os.path.splitext(base_fn)[0]
+        fileout = os.path.join(args.output, fn + '.png')
+        if is_done(args, fn, fileout):
+            logging.info(" - Output exists, skip...")
+            continue
+        textfile = os.path.join(args.output, fn + '.txt')
+        jsonfile = os.path.join(args.output, fn + '.json')
+        todo.append((i, filein, fileout, textfile, jsonfile))
+    if not todo:
+        return results
+
+    start = time.time()
+    idx, fileins, fileouts, textfiles, jsonfiles = zip(*todo)
+    confs = render_doc_text_batch(args.bucket_name, fileins,
+                                  [overlay_file(args, fn) for fn in fileouts],
+                                  textfiles, jsonfiles)
+    # The whole group shares one operation, so its duration is per tile.
+    duration = (time.time() - start) / len(todo)
+    for i, filein, fileout, conf in zip(idx, fileins, fileouts, confs):
+        logging.info(" - Duration: %0.1f" % (duration))
+        logging.info(" - Confidence: %0.4f" % (conf))
+        ocr_metrics.emit('tile', tile_name(filein), duration, confidence=conf)
+        results[i] = (fileout, duration, conf)
+    return results
+
+
 _LOG_LEVEL_STRINGS = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
 
 def _log_level_string_to_int(log_level_string):
@@ -368,30 +773,89 @@ def _log_level_string_to_int(log_level_string):
     return log_level_int
 
 
-if __name__ == "__main__":
-
-    title = 'OCR PNG files in the directory using Google Vision API'
-    parser = argparse.ArgumentParser(description=title)
-    parser.add_argument('directory', default=None,
-                        help='Directory contains PNG files')
+def add_bucket_arguments(parser):
     parser.add_argument('-b', '--bucket-name', default=None,
                         help='Working bucket name on Google Cloud Storage')
     parser.add_argument('-c', '--credentials', default=None,
                         help='Google Applicaiton Credentials file')
+
+
+def make_parser():
+    import ocr_pdf
+    import ocr_pipeline
+
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains PNG files (PDF files with --input pdf)')
+    add_bucket_arguments(parser)
     parser.add_argument('--overwritten',
                         help='Overwrite if output file exists',
                         action='store_true')
     parser.add_argument('-o', '--output', default='output',
                         help='Directory for output files')
     parser.add_argument('-p', '--processes', type=int, default=10,
-                        help='Number of worker process to run (Default: 10)')
+                        help='Number of worker process to run, CPU workers '
+                             'of the async pipeline (Default: 10)')
+    parser.add_argument('-f', '--files-per-operation', type=int, default=1,
+                        help='Number of PNG files sent in a single async '
+                             'OCR operation (Default: 1)')
+    parser.add_argument('--pipeline', default='pool', choices=['pool', 'async'],
+                        help='"pool" runs each tile in a worker process, '
+                             '"async" runs staged asyncio pipeline (Default: pool)')
+    ocr_pipeline.add_pipeline_arguments(parser)
+    ocr_pdf.add_pdf_arguments(parser)
+    ocr_bounds.add_overlay_arguments(parser)
+    ocr_columns.add_columns_arguments(parser)
+    ocr_pages.add_page_arguments(parser)
     parser.add_argument('--log-level', default='INFO', nargs='?',
                         type=_log_level_string_to_int,
                         help='Set the logging output level. {0}'
                             .format(_LOG_LEVEL_STRINGS))
-    args = parser.parse_args()
+    ocr_backend.add_backend_arguments(parser)
+    ocr_cache.add_cache_arguments(parser)
+    ocr_manifest.add_manifest_arguments(parser)
+    ocr_retry.add_retry_arguments(parser)
+    ocr_metrics.add_metrics_arguments(parser)
+    ocr_limits.add_limit_arguments(parser)
+    ocr_encode.add_encoding_arguments(parser)
+    ocr_results.add_result_arguments(parser)
+    return parser
 
-    if 'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
+
+if __name__ == "__main__":
+    import ocr_pdf
+    import ocr_pipeline
+
+    parser = make_parser()
+    args = parser.parse_args()
+    if args.input == 'pdf':
+        if args.pipeline == 'async':
+            parser.error('--input pdf runs with --pipeline pool')
+        if not 1 <= args.pdf_batch_size <= ocr_pdf.MAX_BATCH_SIZE:
+            parser.error('--pdf-batch-size must be between 1 and {:d}'.format(
+                ocr_pdf.MAX_BATCH_SIZE))
+        # no page images to draw on
+        args.no_overlay = True
+
+    backend = ocr_backend.backend_from_args(args)
+    ocr_backend.set_backend(backend)
+    cache = ocr_cache.cache_from_args(args)
+    ocr_cache.set_cache(cache)
+    manifest = ocr_manifest.manifest_from_args(args)
+    ocr_manifest.set_manifest(manifest)
+    retrier = ocr_retry.retrier_from_args(args)
+    ocr_retry.set_retrier(retrier)
+    ocr_columns.set_columns(args.npz, args.page_text)
+    metrics_handlers = ocr_metrics.handlers_from_args(args)
+    ocr_metrics.set_metrics(bool(metrics_handlers))
+    limiter = ocr_limits.limiter_from_args(
+        args, args.in_flight if args.pipeline == 'async' else args.processes)
+    ocr_limits.set_limiter(limiter)
+    encoding = ocr_encode.encoding_from_args(args)
+    ocr_encode.set_encoding(encoding)
+    ocr_results.set_format(args.result_format)
+
+    if backend.name == 'gcs' and 'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
         if args.credentials is None:
             print("ERROR: Please make sure have a Google credentials file.\n"
                   "See https://cloud.google.com/docs/authentication/getting-started")
@@ -402,33 +866,46 @@ if __name__ == "__main__":
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    input_files = sorted(glob(os.path.join(args.directory, '*.png')))
+    input_files = sorted(glob(os.path.join(args.directory, '*.' + args.input)))
+    if manifest is not None and not args.overwritten and args.input == 'png':
+        # one query instead of a lookup per tile in the workers
+        saved = manifest.saved_names()
+        input_files = [fn for fn in input_files if tile_name(fn) not in saved]
 
-    if args.bucket_name is None:
-        while True:
-            try:
-                args.bucket_name = get_bucket_name()
-                create_bucket(args.bucket_name)
-                args.auto_bucket = True
-                break
-            except Exception as e:
-                print(e)
-    else:
-        args.auto_bucket = False
+    work_bucket(args, manifest)
 
-    lq_listener, lq = logger_init(args.log_level)
+    lq_listener, lq = logger_init(args.log_level, metrics_handlers)
 
-    logging.info(title)
+    logging.info(TITLE)
     logging.info("Args: {!s}".format(args))
     logging.info("Working bucket name on the GCS: {!s}".format(args.bucket_name))
 
     try:
-        pool = Pool(args.processes, worker_init, [lq, args.log_level])
-
-        results = pool.map(partial(ocr_worker, args), input_files)
-
-        pool.close()
-        pool.join()
+        if args.pipeline == 'async':
+            results = ocr_pipeline.run(args, input_files, lq)
+        else:
+            pool = Pool(args.processes, worker_init,
+                        [lq, args.log_level, backend, cache, manifest, retrier,
+                         (args.npz, args.page_text), ocr_metrics.get_metrics(),
+                         limiter, encoding, args.result_format])
+
+            if args.input == 'pdf':
+                jobs = ocr_pdf.make_jobs(args, input_files)
+                pages = pool.map(partial(ocr_pdf.pdf_worker, args), jobs)
+                pages = [page for pdf_pages in pages for page in pdf_pages]
+                # one result per page, logged under the page name
+                input_files = [name for name, _ in pages]
+                results = [r for _, r in pages]
+            elif args.files_per_operation > 1:
+                n = args.files_per_operation
+                groups = [input_files[i:i + n] for i in range(0, len(input_files), n)]
+                results = pool.map(partial(ocr_batch_worker, args), groups)
+                results = [r for group in results for r in group]
+            else:
+                results = pool.map(partial(ocr_worker, args), input_files)
+
+            pool.close()
+            pool.join()
 
         for i, r in enumerate(results):
             logging.info('{!s}: {!s}'.format(input_files[i], r))
@@ -436,6 +913,8 @@ if __name__ == "__main__":
         logging.error(e)
     finally:
         if args.auto_bucket:
-            delete_bucket(args.bucket_name)
+            release_bucket(args.bucket_name, manifest)
 
     lq_listener.stop()
+    for h in metrics_handlers:
+        h.close()
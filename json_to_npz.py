@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+json_to_npz.py: converts the .json (or .pb, .pb.gz, .pb.zst, see
+ocr_results.py) outputs of earlier runs into the columnar .npz format of
+--npz (see ocr_columns.py), so that abc_1_15.json produces abc_1_15.npz in
+the same directory.
+"""
+
+import os
+import time
+import argparse
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import ocr_columns
+import ocr_results
+
+
+def convert_worker(args, name):
+    resultfile = ocr_results.find_result(args.directory, name, ocr_results.FORMATS)
+    npzfile = os.path.join(args.directory, name + '.npz')
+    if os.path.exists(npzfile) and not args.overwritten:
+        return resultfile, None, 0
+    start = time.time()
+    columns = ocr_results.load_columns(resultfile)
+    ocr_columns.save_columns(npzfile, columns)
+    return resultfile, len(columns['word_conf']), time.time() - start
+
+
+if __name__ == "__main__":
+    title = 'Convert JSON OCR results into columnar NPZ files'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains JSON (or protobuf) result files')
+    parser.add_argument('--overwritten',
+                        help='Overwrite if output file exists',
+                        action='store_true')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    print(args)
+
+    names = ocr_results.result_names(args.directory, ocr_results.FORMATS)
+
+    start = time.time()
+    n = 0
+    pool = Pool(args.processes)
+    for resultfile, nword, duration in pool.imap_unordered(
+            partial(convert_worker, args), names, chunksize=4):
+        if nword is None:
+            continue
+        n += 1
+        print("Done: {:s} words={:d} convert={:0.1f}s".format(resultfile, nword, duration))
+    pool.close()
+    pool.join()
+
+    print("Total: files={:d} duration={:0.1f}s".format(n, time.time() - start))
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_backend.py: storage and OCR backends used by google_vision_ocr_gcs.py.
+
+GCSBackend talks to Google Cloud Storage and the Google Vision API. The
+LocalBackend is a stand-in for both: a directory on the local filesystem acts
+as the bucket and a fake annotator writes AnnotateFileResponse JSON files
+after a configurable latency, failing a configurable fraction of requests.
+It lets us load-test the pipeline (worker counts, retries, throughput)
+without paying for real calls.
+"""
+
+import os
+import io
+import re
+import json
+import time
+import uuid
+import random
+import shutil
+import logging
+import threading
+
+from google.api_core import exceptions
+from google.cloud import vision
+from google.cloud.vision import types
+from google.protobuf import json_format
+
+from PIL import Image
+
+
+class Backend(object):
+    """Interface to the storage bucket and the Vision annotator.
+
+    Clients and bucket handles are created once per process and shared by
+    every stage, so a worker pays for credentials, connections and bucket
+    metadata only once. Subclasses implement the `new_*` factories.
+    """
+
+    name = None
+
+    def __init__(self):
+        self._clients = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Clients hold sockets and locks, a new process builds its own.
+        state = self.__dict__.copy()
+        state['_clients'] = {}
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _cached(self, key, factory, *args):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked from a parent that already had clients.
+                self._clients = {}
+                self._pid = os.getpid()
+            if key not in self._clients:
+                self._clients[key] = factory(*args)
+            return self._clients[key]
+
+    def new_storage_client(self):
+        raise NotImplementedError
+
+    def new_vision_client(self):
+        raise NotImplementedError
+
+    def storage_client(self):
+        return self._cached('storage', self.new_storage_client)
+
+    def vision_client(self):
+        return self._cached('vision', self.new_vision_client)
+
+    def get_bucket(self, bucket_name):
+        return self._cached(('bucket', bucket_name),
+                            self.storage_client().get_bucket, bucket_name)
+
+    def create_bucket(self, bucket_name):
+        return self.storage_client().create_bucket(bucket_name)
+
+    def bucket_exists(self, bucket_name):
+        try:
+            self.get_bucket(bucket_name)
+            return True
+        except exceptions.NotFound:
+            return False
+
+    def get_operation(self, name):
+        """Re-attaches to a long-running operation by name, e.g. one
+        submitted by a previous run."""
+        raise NotImplementedError
+
+    def forget_bucket(self, bucket_name):
+        with self._lock:
+            self._clients.pop(('bucket', bucket_name), None)
+
+    def init_clients(self):
+        """Creates the clients up front, e.g. from a pool initializer."""
+        self.storage_client()
+        self.vision_client()
+
+
+class GCSBackend(Backend):
+    """Google Cloud Storage and Google Vision API.
+
+    `pool_size` is the number of pooled HTTP connections of the storage
+    session; all Vision calls of a process go through one gRPC channel.
+    """
+
+    name = 'gcs'
+
+    def __init__(self, pool_size=32):
+        super(GCSBackend, self).__init__()
+        self.pool_size = pool_size
+
+    def new_storage_client(self):
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import storage
+        from requests.adapters import HTTPAdapter
+
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        return storage.Client(project=project, _http=session)
+
+    def new_vision_client(self):
+        from google.cloud.vision_v1.gapic.transports import \
+            image_annotator_grpc_transport
+
+        transport = image_annotator_grpc_transport.ImageAnnotatorGrpcTransport
+        channel = transport.create_channel()
+        return vision.ImageAnnotatorClient(transport=transport(channel=channel))
+
+    def get_operation(self, name):
+        from google.api_core import operation
+
+        operations_client = self.vision_client().transport._operations_client
+        return operation.from_gapic(
+            operations_client.get_operation(name), operations_client,
+            types.AsyncBatchAnnotateFilesResponse,
+            metadata_type=types.OperationMetadata)
+
+
+class LocalBackend(Backend):
+    """Local filesystem bucket and a fake Vision annotator.
+
+    `latency` and `jitter` (seconds) control how long each async operation
+    takes, `failure_rate` is the fraction of files answered with a Vision
+    error and `storage_failure_rate` the fraction of blob transfers that
+    raise a transient error.
+    """
+
+    name = 'local'
+
+    def __init__(self, root, latency=1.0, jitter=0.0, failure_rate=0.0,
+                 storage_failure_rate=0.0, seed=None):
+        super(LocalBackend, self).__init__()
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.storage_failure_rate = storage_failure_rate
+        self.seed = seed
+        self._rng = None
+        self._rng_pid = None
+
+    def new_storage_client(self):
+        return LocalStorageClient(self)
+
+    def new_vision_client(self):
+        return LocalAnnotatorClient(self)
+
+    @property
+    def rng(self):
+        # Forked workers must not share the parent's random sequence.
+        if self._rng_pid != os.getpid():
+            seed = self.seed
+            if seed is not None:
+                seed = '{!s}-{:d}'.format(seed, os.getpid())
+            self._rng = random.Random(seed)
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    def bucket_dir(self, bucket_name):
+        return os.path.join(self.root, 'buckets', bucket_name)
+
+    def operation_file(self, name):
+        return os.path.join(self.root, name + '.json')
+
+    def get_operation(self, name):
+        try:
+            with io.open(self.operation_file(name), 'rb') as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError):
+            raise exceptions.NotFound('Operation {!s} not found'.format(name))
+        requests = [json_format.ParseDict(r, types.AsyncAnnotateFileRequest())
+                    for r in state['requests']]
+        return LocalOperation(self, name, requests, state['deadline'], state['done'])
+
+
+class LocalStorageClient(object):
+    """Subset of `google.cloud.storage.Client` backed by a directory."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self.backend, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        bucket = self.bucket(bucket_name)
+        if not bucket.exists():
+            raise exceptions.NotFound('Bucket {!s} not found'.format(bucket_name))
+        return bucket
+
+    def create_bucket(self, bucket_name):
+        bucket = self.bucket(bucket_name)
+        if bucket.exists():
+            raise exceptions.Conflict('Bucket {!s} already exists'.format(bucket_name))
+        os.makedirs(bucket.path)
+        return bucket
+
+
+class LocalBucket(object):
+    """Subset of `google.cloud.storage.Bucket` backed by a directory."""
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.path = backend.bucket_dir(name)
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def blob(self, blob_name, chunk_size=None):
+        return LocalBlob(self, blob_name, chunk_size)
+
+    def list_blobs(self, prefix=None):
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for fn in filenames:
+                if fn.endswith('.part'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                name = os.path.relpath(path, self.path).replace(os.sep, '/')
+                if prefix is None or name.startswith(prefix):
+                    blobs.append(LocalBlob(self, name))
+        return iter(sorted(blobs, key=lambda b: b.name))
+
+    def delete(self):
+        if any(True for _ in self.list_blobs()):
+            raise exceptions.Conflict('Bucket {!s} is not empty'.format(self.name))
+        shutil.rmtree(self.path)
+
+
+class LocalBlob(object):
+    """Subset of `google.cloud.storage.Blob` backed by a file."""
+
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.path = os.path.join(bucket.path, *name.split('/'))
+
+    def _maybe_fail(self, action):
+        backend = self.bucket.backend
+        if backend.storage_failure_rate > 0 and \
+                backend.rng.random() < backend.storage_failure_rate:
+            raise exceptions.ServiceUnavailable(
+                'Simulated {!s} failure: {!s}'.format(action, self.name))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def upload_from_file(self, file_obj, rewind=False, size=None,
+                         content_type=None):
+        self._maybe_fail('upload')
+        if rewind:
+            file_obj.seek(0)
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Write next to the final name then rename, like an atomic GCS write.
+        part = self.path + '.part'
+        with io.open(part, 'wb') as f:
+            shutil.copyfileobj(file_obj, f, self.chunk_size or 1024 * 1024)
+        os.rename(part, self.path)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with io.open(filename, 'rb') as f:
+            self.upload_from_file(f, content_type=content_type)
+
+    def upload_from_string(self, data, content_type='text/plain'):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.upload_from_file(io.BytesIO(data), content_type=content_type)
+
+    def download_to_file(self, file_obj):
+        self._maybe_fail('download')
+        if not self.exists():
+            raise exceptions.NotFound('Blob {!s} not found'.format(self.name))
+        with io.open(self.path, 'rb') as f:
+            shutil.copyfileobj(f, file_obj, self.chunk_size or 1024 * 1024)
+
+    def download_to_filename(self, filename):
+        with io.open(filename, 'wb') as f:
+            self.download_to_file(f)
+
+    def download_as_string(self):
+        buf = io.BytesIO()
+        self.download_to_file(buf)
+        return buf.getvalue()
+
+    def delete(self):
+        if not self.exists():
+            raise exceptions.NotFound('Blob {!s} not found'.format(self.name))
+        os.unlink(self.path)
+
+
+class LocalAnnotatorClient(object):
+    """Fake `vision.ImageAnnotatorClient` for the async file API."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def async_batch_annotate_files(self, requests):
+        backend = self.backend
+        rnd = backend.rng
+        latency = max(0.0, backend.latency + rnd.uniform(-1, 1) * backend.jitter)
+        name = 'operations/local-{!s}'.format(uuid.uuid4().hex)
+        operation = LocalOperation(backend, name, list(requests), time.time() + latency)
+        operation.save()
+        return operation
+
+    def document_text_detection(self, image, image_context=None, timeout=None):
+        backend = self.backend
+        latency = max(0.0, backend.latency + backend.rng.uniform(-1, 1) * backend.jitter)
+        time.sleep(latency)
+        if backend.failure_rate > 0 and backend.rng.random() < backend.failure_rate:
+            raise exceptions.DeadlineExceeded('Backend deadline exceeded. '
+                                              'Error processing features.')
+        with Image.open(io.BytesIO(image.content)) as im:
+            w, h = im.size
+        rnd = random.Random(len(image.content))
+        response = {'fullTextAnnotation': fake_document(w, h, rnd)}
+        return json_format.ParseDict(response, types.AnnotateImageResponse())
+
+    def batch_annotate_images(self, requests, timeout=None):
+        backend = self.backend
+        latency = max(0.0, backend.latency + backend.rng.uniform(-1, 1) * backend.jitter)
+        time.sleep(latency)
+        if backend.failure_rate > 0 and backend.rng.random() < backend.failure_rate:
+            raise exceptions.DeadlineExceeded('Backend deadline exceeded. '
+                                              'Error processing features.')
+        responses = []
+        for request in requests:
+            content = request.image.content
+            with Image.open(io.BytesIO(content)) as im:
+                w, h = im.size
+            rnd = random.Random(len(content))
+            responses.append({'fullTextAnnotation': fake_document(w, h, rnd)})
+        return json_format.ParseDict({'responses': responses},
+                                     types.BatchAnnotateImagesResponse())
+
+
+class LocalOperation(object):
+    """Fake long-running operation finishing at a given wall clock time."""
+
+    def __init__(self, backend, name, requests, deadline, annotated=False):
+        self.backend = backend
+        self.name = name
+        self.requests = requests
+        self.deadline = deadline
+        self.annotated = annotated
+        self._result = None
+
+    @property
+    def operation(self):
+        # api_core operations expose their name as `operation.name`
+        return self
+
+    def save(self, done=False):
+        """Persists the operation so that get_operation can find it."""
+        fn = self.backend.operation_file(self.name)
+        dirname = os.path.dirname(fn)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        state = {'deadline': self.deadline, 'done': done,
+                 'requests': [json_format.MessageToDict(r) for r in self.requests]}
+        with io.open(fn, 'wb') as f:
+            f.write(json.dumps(state).encode('utf-8'))
+
+    def done(self):
+        if self._result is None and time.time() >= self.deadline:
+            self._result = self._annotate()
+            if not self.annotated:
+                self.annotated = True
+                self.save(done=True)
+        return self._result is not None
+
+    def result(self, timeout=None):
+        wait = self.deadline - time.time()
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            raise exceptions.DeadlineExceeded(
+                'Operation {!s} did not complete within {!s}s'.format(self.name, timeout))
+        if wait > 0:
+            time.sleep(wait)
+        self.done()
+        return self._result
+
+    def _annotate(self):
+        responses = []
+        for request in self.requests:
+            if self.annotated:
+                output_uri = request.output_config.gcs_destination.uri
+            else:
+                output_uri = annotate_file(self.backend, request)
+            output_config = types.OutputConfig(
+                gcs_destination=types.GcsDestination(uri=output_uri),
+                batch_size=request.output_config.batch_size)
+            responses.append(types.AsyncAnnotateFileResponse(
+                output_config=output_config))
+        return types.AsyncBatchAnnotateFilesResponse(responses=responses)
+
+
+def split_gcs_uri(uri):
+    match = re.match(r'gs://([^/]+)/(.*)', uri)
+    return match.group(1), match.group(2)
+
+
+def annotate_file(backend, request):
+    """Writes fake AnnotateFileResponse JSON files for an async request."""
+    src_bucket, src_name = split_gcs_uri(request.input_config.gcs_source.uri)
+    dst_bucket, dst_prefix = split_gcs_uri(request.output_config.gcs_destination.uri)
+    batch_size = request.output_config.batch_size or 20
+    storage_client = backend.storage_client()
+
+    src_path = storage_client.bucket(src_bucket).blob(src_name).path
+    sizes = []
+    if request.input_config.mime_type == 'application/pdf':
+        import fitz
+        doc = fitz.open(src_path)
+        # page sizes of a PDF result are in points
+        sizes = [(int(page.rect.width), int(page.rect.height)) for page in doc]
+        doc.close()
+    else:
+        with Image.open(src_path) as im:
+            for i in range(getattr(im, 'n_frames', 1)):
+                im.seek(i)
+                sizes.append(im.size)
+
+    rnd = random.Random(request.input_config.gcs_source.uri)
+    input_config = {
+        'gcsSource': {'uri': request.input_config.gcs_source.uri},
+        'mimeType': request.input_config.mime_type,
+    }
+    for start in range(0, len(sizes), batch_size):
+        end = min(start + batch_size, len(sizes))
+        responses = []
+        for pno in range(start, end):
+            context = {'uri': request.input_config.gcs_source.uri,
+                       'pageNumber': pno + 1}
+            if backend.failure_rate > 0 and \
+                    backend.rng.random() < backend.failure_rate:
+                responses.append({
+                    'error': {'code': 4, 'message': 'Backend deadline exceeded. '
+                                                    'Error processing features.'},
+                    'context': context})
+            else:
+                w, h = sizes[pno]
+                responses.append({
+                    'fullTextAnnotation': fake_document(w, h, rnd),
+                    'context': context})
+        output = {'inputConfig': input_config, 'responses': responses}
+        blob_name = '{!s}output-{:d}-to-{:d}.json'.format(dst_prefix, start + 1, end)
+        blob = storage_client.bucket(dst_bucket).blob(blob_name)
+        blob.upload_from_string(json.dumps(output), content_type='application/json')
+
+    return request.output_config.gcs_destination.uri
+
+
+def _box(x0, y0, x1, y1):
+    return {'vertices': [{'x': x0, 'y': y0}, {'x': x1, 'y': y0},
+                         {'x': x1, 'y': y1}, {'x': x0, 'y': y1}]}
+
+
+def fake_document(width, height, rnd, cols=3, card_height=300):
+    """Returns a synthetic `full_text_annotation` dict laid out as a grid of
+    voter cards, roughly the shape of an electoral roll page."""
+    card_width = width // cols
+    blocks = []
+    text = []
+    for row in range(max(1, height // card_height)):
+        for col in range(cols):
+            x0, y0 = col * card_width + 10, row * card_height + 10
+            words = []
+            line = []
+            for k in range(3):
+                word_text = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+                                    for _ in range(rnd.randint(3, 8)))
+                wx0 = x0 + k * (card_width // 3)
+                wy0 = y0 + 20
+                symbols = []
+                for j, c in enumerate(word_text):
+                    sx0 = wx0 + j * 20
+                    symbols.append({'text': c, 'confidence': 0.99,
+                                    'boundingBox': _box(sx0, wy0, sx0 + 18, wy0 + 30)})
+                words.append({'symbols': symbols, 'confidence': 0.98,
+                              'boundingBox': _box(wx0, wy0, wx0 + 20 * len(word_text), wy0 + 30)})
+                line.append(word_text)
+            conf = round(rnd.uniform(0.8, 1.0), 2)
+            box = _box(x0, y0, x0 + card_width - 20, y0 + card_height - 20)
+            blocks.append({'paragraphs': [{'words': words, 'boundingBox': box,
+                                           'confidence': conf}],
+                           'boundingBox': box, 'blockType': 'TEXT',
+                           'confidence': conf})
+            text.append(' '.join(line))
+    return {'pages': [{'width': width, 'height': height, 'blocks': blocks,
+                       'confidence': 0.95}],
+            'text': '\n'.join(text) + '\n'}
+
+
+_backend = None
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = GCSBackend()
+    return _backend
+
+
+def backend_from_args(args):
+    """Builds the backend selected on the command line."""
+    if args.backend == 'local':
+        logging.info('Using local backend at {!s}'.format(args.local_root))
+        return LocalBackend(args.local_root, latency=args.local_latency,
+                            jitter=args.local_jitter,
+                            failure_rate=args.local_failure_rate,
+                            storage_failure_rate=args.local_storage_failure_rate)
+    return GCSBackend()
+
+
+def add_backend_arguments(parser):
+    parser.add_argument('--backend', default='gcs', choices=['gcs', 'local'],
+                        help='Storage/OCR backend; "local" is an offline '
+                             'stand-in for load testing (Default: gcs)')
+    parser.add_argument('--local-root', default='local_backend',
+                        help='Root directory of the local backend')
+    parser.add_argument('--local-latency', type=float, default=1.0,
+                        help='Seconds each local OCR operation takes')
+    parser.add_argument('--local-jitter', type=float, default=0.0,
+                        help='Random +/- seconds added to the local latency')
+    parser.add_argument('--local-failure-rate', type=float, default=0.0,
+                        help='Fraction of local OCR requests answered with an error')
+    parser.add_argument('--local-storage-failure-rate', type=float, default=0.0,
+                        help='Fraction of local blob transfers that fail')
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_bounds.py: bounding boxes of an OCR result for the overlay PNGs of
+google_vision_ocr.py, google_vision_ocr_gcs.py and render_overlays.py.
+
+The get_document_bounds of the scripts walked the whole page -> block ->
+paragraph -> word -> symbol tree once per feature and their draw_boxes drew
+one protobuf polygon at a time. extract_bounds walks the tree once, stops above the symbols unless
+they are asked for, and returns the boxes of every level as a NumPy array
+of shape (n, 4, 2) in pixels, together with the block confidences.
+Results saved as JSON are read from the parsed dicts, without building the
+protobuf message again.
+"""
+
+import io
+import json
+
+import numpy as np
+from PIL import ImageDraw
+
+
+BLOCK = 'block'
+PARA = 'para'
+WORD = 'word'
+SYMBOL = 'symbol'
+LEVELS = (BLOCK, PARA, WORD, SYMBOL)
+
+# levels drawn on the overlay, outermost first
+OVERLAY_COLORS = ((BLOCK, 'blue'), (PARA, 'red'), (WORD, 'green'))
+OVERLAY_LEVELS = tuple(level for level, _ in OVERLAY_COLORS)
+
+
+class DocumentBounds(object):
+    """Boxes of the extracted levels, float32 arrays of shape (n, 4, 2),
+    the confidence of every block and the (width, height) of the first
+    page, the pixels the boxes are in."""
+
+    def __init__(self, boxes, confidences, size=None):
+        self.boxes = boxes
+        self.confidences = confidences
+        self.size = size
+
+    def scale_to(self, size):
+        """(sx, sy) from the pixels of the boxes to an image of size, e.g.
+        the PNG of a tile sent as a downscaled TIFF."""
+        if not self.size or not self.size[0] or not self.size[1]:
+            return 1.0, 1.0
+        return float(size[0]) / self.size[0], float(size[1]) / self.size[1]
+
+    def __getitem__(self, level):
+        return self.boxes[level]
+
+    @property
+    def confidence(self):
+        """Mean block confidence, 0 for a document without blocks."""
+        if not len(self.confidences):
+            return 0.0
+        return float(self.confidences.mean())
+
+
+def append_poly(box, width, height, out):
+    """Appends the 4 (x, y) vertices of a BoundingPoly to out. Results of
+    files (TIFF, PDF) only have normalized vertices."""
+    vertices = box.vertices
+    if vertices:
+        xy = [c for v in vertices for c in (v.x, v.y)]
+    else:
+        xy = [c for v in box.normalized_vertices for c in (v.x * width, v.y * height)]
+    if len(xy) != 8:
+        xy = (xy + [0] * 8)[:8]
+    out.extend(xy)
+
+
+def append_poly_json(box, width, height, out):
+    """Same as append_poly for the dict of a BoundingPoly parsed from JSON,
+    where zero coordinates are left out."""
+    vertices = box.get('vertices')
+    if vertices:
+        xy = [c for v in vertices for c in (v.get('x', 0), v.get('y', 0))]
+    else:
+        xy = [c for v in box.get('normalizedVertices', ())
+              for c in (v.get('x', 0) * width, v.get('y', 0) * height)]
+    if len(xy) != 8:
+        xy = (xy + [0] * 8)[:8]
+    out.extend(xy)
+
+
+def _bounds(coords, levels, confidences, sizes):
+    boxes = dict((level, np.array(coords[level], dtype=np.float32).reshape(-1, 4, 2))
+                 for level in levels)
+    return DocumentBounds(boxes, np.array(confidences, dtype=np.float32),
+                          sizes[0] if sizes else None)
+
+
+def extract_bounds(document, levels=OVERLAY_LEVELS):
+    """Returns the DocumentBounds of the given levels of a TextAnnotation
+    in a single walk of the tree."""
+    coords = dict((level, []) for level in LEVELS)
+    confidences = []
+    sizes = []
+    symbols = SYMBOL in levels
+    words = symbols or WORD in levels
+    paras = words or PARA in levels
+    for page in document.pages:
+        w, h = page.width, page.height
+        sizes.append((w, h))
+        for block in page.blocks:
+            confidences.append(block.confidence)
+            if BLOCK in levels:
+                append_poly(block.bounding_box, w, h, coords[BLOCK])
+            if not paras:
+                continue
+            for paragraph in block.paragraphs:
+                if PARA in levels:
+                    append_poly(paragraph.bounding_box, w, h, coords[PARA])
+                if not words:
+                    continue
+                for word in paragraph.words:
+                    if WORD in levels:
+                        append_poly(word.bounding_box, w, h, coords[WORD])
+                    if not symbols:
+                        continue
+                    for symbol in word.symbols:
+                        append_poly(symbol.bounding_box, w, h, coords[SYMBOL])
+    return _bounds(coords, levels, confidences, sizes)
+
+
+def extract_bounds_json(data, levels=OVERLAY_LEVELS):
+    """Same as extract_bounds for a TextAnnotation parsed from its JSON
+    (json_format.MessageToJson) into dicts."""
+    coords = dict((level, []) for level in LEVELS)
+    confidences = []
+    symbols = SYMBOL in levels
+    words = symbols or WORD in levels
+    paras = words or PARA in levels
+    sizes = []
+    empty = {}
+    for page in data.get('pages', ()):
+        w, h = page.get('width', 0), page.get('height', 0)
+        sizes.append((w, h))
+        for block in page.get('blocks', ()):
+            confidences.append(block.get('confidence', 0))
+            if BLOCK in levels:
+                append_poly_json(block.get('boundingBox', empty), w, h, coords[BLOCK])
+            if not paras:
+                continue
+            for paragraph in block.get('paragraphs', ()):
+                if PARA in levels:
+                    append_poly_json(paragraph.get('boundingBox', empty), w, h, coords[PARA])
+                if not words:
+                    continue
+                for word in paragraph.get('words', ()):
+                    if WORD in levels:
+                        append_poly_json(word.get('boundingBox', empty), w, h, coords[WORD])
+                    if not symbols:
+                        continue
+                    for symbol in word.get('symbols', ()):
+                        append_poly_json(symbol.get('boundingBox', empty), w, h, coords[SYMBOL])
+    return _bounds(coords, levels, confidences, sizes)
+
+
+def load_bounds(jsonfile, levels=OVERLAY_LEVELS):
+    """Returns the DocumentBounds of a JSON file saved by
+    google_vision_ocr_gcs.py."""
+    with io.open(jsonfile, 'rb') as f:
+        data = json.loads(f.read().decode('utf-8'))
+    return extract_bounds_json(data, levels)
+
+
+def draw_bounds(image, bounds, colors=OVERLAY_COLORS):
+    """Draws the boxes of every (level, color) over the image."""
+    draw = ImageDraw.Draw(image)
+    scale = np.array(bounds.scale_to(image.size), dtype=np.float32)
+    for level, color in colors:
+        boxes = bounds[level]
+        if not len(boxes):
+            continue
+        if (scale != 1).any():
+            boxes = boxes * scale
+        # one conversion per level, then a flat coordinate list per polygon
+        for xy in np.rint(boxes).astype(np.int32).reshape(-1, 8).tolist():
+            draw.polygon(xy, None, color)
+    return image
+
+
+def add_overlay_arguments(parser):
+    parser.add_argument('--no-overlay', action='store_true',
+                        help='Do not draw the bounding box PNGs (render them '
+                             'later from the JSON files with render_overlays.py)')
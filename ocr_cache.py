@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_cache.py: local OCR result cache shared by google_vision_ocr.py and
+google_vision_ocr_gcs.py.
+
+Results are keyed by the SHA-256 of the tile bytes plus the request
+parameters (feature type, language hints, the TIFF encoding of
+--tiff-profile), so a retry or a re-run with
+--overwritten does not send (and pay for) the same image twice. Each entry
+is the `full_text_annotation` serialized as protobuf binary in
+<cache dir>/<key[:2]>/<key>.pb; an SQLite index keeps the size and last
+access time of every entry and the least recently used entries are evicted
+once the cache grows over its size limit.
+"""
+
+import os
+import io
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from google.cloud.vision import types
+
+
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+
+def cache_key(data, feature, language_hints, encoding=None):
+    """Returns the key of a tile (bytes) for the given request parameters
+    and the encoding the tile is sent in (the rgb TIFF and the image sent
+    as it is keep the keys they had before the encodings)."""
+    h = hashlib.sha256()
+    h.update(data)
+    params = [int(feature), list(language_hints)]
+    if encoding not in (None, 'rgb'):
+        params.append(encoding)
+    h.update(json.dumps(params).encode('utf-8'))
+    return h.hexdigest()
+
+
+class OCRCache(object):
+    """Size bounded, content addressed store of `full_text_annotation`s.
+
+    Safe to share between threads; every process opens its own SQLite
+    connection to the index.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._pid != os.getpid():
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                   timeout=60, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, size INTEGER, atime REAL)')
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.pb')
+
+    def get(self, key):
+        """Returns the cached document or None."""
+        fn = self._file(key)
+        try:
+            with io.open(fn, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        with self._lock:
+            db = self._db()
+            db.execute('UPDATE entries SET atime=? WHERE key=?', (time.time(), key))
+            db.commit()
+        logging.info('Cache hit... {!s}'.format(key))
+        return types.TextAnnotation.FromString(data)
+
+    def put(self, key, document):
+        data = document.SerializeToString()
+        fn = self._file(key)
+        dirname = os.path.dirname(fn)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_fn = '{!s}.{:d}.tmp'.format(fn, os.getpid())
+        with io.open(tmp_fn, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_fn, fn)
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                       (key, len(data), time.time()))
+            db.commit()
+            self._evict(db)
+
+    def _evict(self, db):
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM entries ORDER BY atime'):
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        for key in evicted:
+            try:
+                os.unlink(self._file(key))
+            except OSError:
+                pass
+        db.executemany('DELETE FROM entries WHERE key=?', [(k,) for k in evicted])
+        db.commit()
+        logging.info('Cache evicted {:d} entries'.format(len(evicted)))
+
+
+_cache = None
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    """Returns the cache of this process, None when caching is off."""
+    return _cache
+
+
+def cache_from_args(args):
+    if args.cache_dir is None:
+        return None
+    return OCRCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory of the local OCR result cache (Default: no cache)')
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE / (1024 * 1024),
+                        help='Max size of the OCR result cache in MB '
+                             '(Default: {:d})'.format(DEFAULT_CACHE_SIZE // (1024 * 1024)))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_columns.py: columnar OCR output (.npz) next to the .json of a tile.
+
+The JSON of a TextAnnotation is large and every analysis has to parse it
+and walk the tree again. With --npz the result is also saved as flat
+NumPy arrays, one row per element of a level (block, para, word, symbol):
+
+    <level>_box     float32 (n, 4, 2)  vertices in pixels
+    <level>_conf    float32 (n,)       confidence
+    <level>_parent  int32 (n,)         row of the parent (page for blocks)
+    <level>_text    int32 (n, 2)       [start, end) byte offsets in text
+    page_size       float32 (pages, 2) width, height
+    text            uint8              UTF-8 text rebuilt from the symbols
+                                       and their detected breaks
+
+The arrays are stored uncompressed, so load_columns maps them straight
+from the file without reading or copying it. json_to_npz.py converts the
+.json files of earlier runs. The per-page text of --page-text (see
+ocr_pages.py) is built from the same arrays.
+"""
+
+import io
+import os
+import json
+import mmap
+import struct
+import zipfile
+
+import numpy as np
+
+import ocr_bounds
+import ocr_pages
+from ocr_bounds import BLOCK, PARA, WORD, SYMBOL, LEVELS
+
+
+# text appended after a symbol for its detected break (TextAnnotation.
+# DetectedBreak.BreakType), by value and by name in JSON
+BREAKS = {1: ' ', 2: ' ', 3: '\n', 4: '-\n', 5: '\n'}
+BREAK_NAMES = {'SPACE': ' ', 'SURE_SPACE': ' ', 'EOL_SURE_SPACE': '\n',
+               'HYPHEN': '-\n', 'LINE_BREAK': '\n'}
+
+# the level below each level, for the end offsets of the parents
+CHILD = {BLOCK: PARA, PARA: WORD, WORD: SYMBOL, SYMBOL: None}
+
+
+class _Builder(object):
+    """Rows of every level appended during a walk of the tree."""
+
+    def __init__(self):
+        self.sizes = []
+        self.coords = dict((level, []) for level in LEVELS)
+        self.conf = dict((level, []) for level in LEVELS)
+        self.parent = dict((level, []) for level in LEVELS)
+        self.offsets = dict((level, []) for level in LEVELS)
+        self.text = []
+        self.size = 0
+
+    def open(self, level, parent, conf):
+        """Starts a row, returns its index and the child count so far."""
+        i = len(self.conf[level])
+        self.conf[level].append(conf)
+        self.parent[level].append(parent)
+        self.offsets[level].append([self.size, self.size])
+        child = CHILD[level]
+        return i, len(self.conf[child]) if child else 0
+
+    def close(self, level, i, nchild):
+        """Ends a row where its last child ends (before the child's break),
+        or at the current text position when it has no child."""
+        child = CHILD[level]
+        if child and len(self.conf[child]) > nchild:
+            self.offsets[level][i][1] = self.offsets[child][-1][1]
+        else:
+            self.offsets[level][i][1] = self.size
+
+    def add_text(self, s):
+        if s:
+            data = s.encode('utf-8')
+            self.text.append(data)
+            self.size += len(data)
+
+    def columns(self):
+        columns = {
+            'page_size': np.array(self.sizes, dtype=np.float32).reshape(-1, 2),
+            'text': np.frombuffer(b''.join(self.text), dtype=np.uint8),
+        }
+        for level in LEVELS:
+            columns[level + '_box'] = np.array(
+                self.coords[level], dtype=np.float32).reshape(-1, 4, 2)
+            columns[level + '_conf'] = np.array(self.conf[level], dtype=np.float32)
+            columns[level + '_parent'] = np.array(self.parent[level], dtype=np.int32)
+            columns[level + '_text'] = np.array(
+                self.offsets[level], dtype=np.int32).reshape(-1, 2)
+        return columns
+
+
+def extract_columns(document):
+    """Returns the columns (dict of arrays) of a TextAnnotation."""
+    b = _Builder()
+    for p, page in enumerate(document.pages):
+        w, h = page.width, page.height
+        b.sizes.append((w, h))
+        for block in page.blocks:
+            bi, bn = b.open(BLOCK, p, block.confidence)
+            ocr_bounds.append_poly(block.bounding_box, w, h, b.coords[BLOCK])
+            for paragraph in block.paragraphs:
+                pi, pn = b.open(PARA, bi, paragraph.confidence)
+                ocr_bounds.append_poly(paragraph.bounding_box, w, h, b.coords[PARA])
+                for word in paragraph.words:
+                    wi, wn = b.open(WORD, pi, word.confidence)
+                    ocr_bounds.append_poly(word.bounding_box, w, h, b.coords[WORD])
+                    for symbol in word.symbols:
+                        si, _ = b.open(SYMBOL, wi, symbol.confidence)
+                        ocr_bounds.append_poly(symbol.bounding_box, w, h, b.coords[SYMBOL])
+                        b.add_text(symbol.text)
+                        b.close(SYMBOL, si, 0)
+                        b.add_text(BREAKS.get(symbol.property.detected_break.type))
+                    b.close(WORD, wi, wn)
+                b.close(PARA, pi, pn)
+            b.close(BLOCK, bi, bn)
+    return b.columns()
+
+
+def extract_columns_json(data):
+    """Same as extract_columns for a TextAnnotation parsed from its JSON
+    into dicts."""
+    b = _Builder()
+    empty = {}
+    for p, page in enumerate(data.get('pages', ())):
+        w, h = page.get('width', 0), page.get('height', 0)
+        b.sizes.append((w, h))
+        for block in page.get('blocks', ()):
+            bi, bn = b.open(BLOCK, p, block.get('confidence', 0))
+            ocr_bounds.append_poly_json(block.get('boundingBox', empty), w, h, b.coords[BLOCK])
+            for paragraph in block.get('paragraphs', ()):
+                pi, pn = b.open(PARA, bi, paragraph.get('confidence', 0))
+                ocr_bounds.append_poly_json(paragraph.get('boundingBox', empty), w, h,
+                                            b.coords[PARA])
+                for word in paragraph.get('words', ()):
+                    wi, wn = b.open(WORD, pi, word.get('confidence', 0))
+                    ocr_bounds.append_poly_json(word.get('boundingBox', empty), w, h,
+                                                b.coords[WORD])
+                    for symbol in word.get('symbols', ()):
+                        si, _ = b.open(SYMBOL, wi, symbol.get('confidence', 0))
+                        ocr_bounds.append_poly_json(symbol.get('boundingBox', empty), w, h,
+                                                    b.coords[SYMBOL])
+                        b.add_text(symbol.get('text'))
+                        b.close(SYMBOL, si, 0)
+                        kind = symbol.get('property', empty).get('detectedBreak', empty).get('type')
+                        b.add_text(BREAK_NAMES.get(kind))
+                    b.close(WORD, wi, wn)
+                b.close(PARA, pi, pn)
+            b.close(BLOCK, bi, bn)
+    return b.columns()
+
+
+def save_columns(npzfile, columns):
+    """Writes the columns uncompressed (so they can be memory-mapped)."""
+    tmp_fn = '{!s}.{:d}.tmp'.format(npzfile, os.getpid())
+    with io.open(tmp_fn, 'wb') as f:
+        np.savez(f, **columns)
+    os.rename(tmp_fn, npzfile)
+
+
+def load_columns(npzfile, mmap_mode='r'):
+    """Returns the columns of a .npz file. With mmap_mode 'r' the arrays
+    are read-only views of the memory-mapped file; np.load ignores
+    mmap_mode for .npz files, so the members are located by hand."""
+    if mmap_mode is None:
+        with np.load(npzfile) as z:
+            return dict((name, z[name]) for name in z.files)
+    with io.open(npzfile, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    columns = {}
+    with zipfile.ZipFile(npzfile) as z:
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{!s}: compressed member {!s} cannot be '
+                                 'memory-mapped'.format(npzfile, info.filename))
+            # local file header: 30 bytes, the name and the extra field
+            offset = info.header_offset
+            name_len, extra_len = struct.unpack('<HH', mm[offset + 26:offset + 30])
+            offset += 30 + name_len + extra_len
+            header = io.BytesIO(mm[offset:offset + min(info.file_size, 65536 + 10)])
+            version = np.lib.format.read_magic(header)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(header)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(header)
+            count = int(np.prod(shape))
+            array = np.frombuffer(mm, dtype=dtype, count=count, offset=offset + header.tell())
+            columns[info.filename[:-4]] = array.reshape(shape, order='F' if fortran else 'C')
+    return columns
+
+
+def load_columns_json(jsonfile):
+    """Returns the columns of a JSON file saved by google_vision_ocr_gcs.py."""
+    with io.open(jsonfile, 'rb') as f:
+        data = json.loads(f.read().decode('utf-8'))
+    return extract_columns_json(data)
+
+
+def element_text(columns, level, i):
+    """Returns the text of row i of a level."""
+    start, end = columns[level + '_text'][i]
+    return columns['text'][start:end].tobytes().decode('utf-8')
+
+
+def to_bounds(columns, levels=ocr_bounds.OVERLAY_LEVELS):
+    """Returns the ocr_bounds.DocumentBounds of the columns."""
+    boxes = dict((level, columns[level + '_box']) for level in levels)
+    sizes = columns['page_size']
+    return ocr_bounds.DocumentBounds(boxes, columns[BLOCK + '_conf'],
+                                     tuple(sizes[0].tolist()) if len(sizes) else None)
+
+
+def npz_file(jsonfile):
+    return os.path.splitext(jsonfile)[0] + '.npz'
+
+
+_npz = False
+_page_text = False
+
+
+def set_columns(npz, page_text=False):
+    global _npz, _page_text
+    _npz = npz
+    _page_text = page_text
+
+
+def save_document_columns(document, jsonfile):
+    """Saves the .npz of a document next to its .json when --npz is on and
+    the text of its pages when --page-text is on, extracting the columns
+    once for both."""
+    if not (_npz or _page_text):
+        return
+    columns = extract_columns(document)
+    if _npz:
+        save_columns(npz_file(jsonfile), columns)
+    if _page_text:
+        name = os.path.splitext(os.path.basename(jsonfile))[0]
+        ocr_pages.save_page_texts(columns, name, os.path.dirname(jsonfile))
+
+
+def add_columns_arguments(parser):
+    parser.add_argument('--npz', action='store_true',
+                        help='Also save each result as memory-mappable columnar '
+                             'arrays (.npz) next to the .json')
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_encode.py: TIFF encoding profiles of the tiles sent to the async OCR.
+
+Roll pages are black text on white, yet the tiles are uploaded as RGB LZW
+TIFFs, three bytes a pixel before compression, which at 300 dpi and 10-15
+pages makes large uploads that can hit the 20MB limit of the async API.
+--tiff-profile picks the encoding:
+
+    rgb    the tile as it is, LZW (the default, as before)
+    gray   8-bit grayscale, LZW
+    g4     bilevel (Otsu threshold), CCITT Group 4, typically 10-30x
+           smaller than rgb
+    auto   the first of gray, g4 and g4 downscaled by SCALES (down to
+           --tiff-min-scale) that fits in --tiff-target-bytes, else the
+           smallest of them
+
+Vision returns the boxes of a downscaled tile in its own pixels, the
+overlay scales them back to the PNG (see render_overlay).
+tiff_profiles.py measures upload bytes against OCR confidence for the
+profiles on a sample of tiles.
+"""
+
+import io
+import logging
+
+import numpy as np
+from PIL import Image
+
+
+PROFILES = ('rgb', 'gray', 'g4', 'auto')
+# downscale steps of auto, tried after g4 at full size
+SCALES = (0.85, 0.7, 0.6, 0.5)
+TARGET_BYTES = 20 * 1024 * 1024
+# LZW with horizontal differencing (predictor), one row per strip
+LZW_INFO = {317: 2, 278: 1}
+
+
+def otsu_threshold(gray):
+    """Returns the Otsu threshold of an 'L' image from its histogram."""
+    hist = np.array(gray.histogram()[:256], dtype=np.float64)
+    total = hist.sum()
+    if total == 0:
+        return 128
+    p = hist / total
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    sigma_b[~np.isfinite(sigma_b)] = 0
+    return int(np.argmax(sigma_b))
+
+
+def binarize(gray, threshold=None):
+    if threshold is None:
+        threshold = otsu_threshold(gray)
+    table = [255 if v > threshold else 0 for v in range(256)]
+    return gray.point(table, mode='1')
+
+
+def scale_image(im, scale):
+    if scale >= 1:
+        return im
+    size = (max(1, int(round(im.width * scale))), max(1, int(round(im.height * scale))))
+    return im.resize(size, Image.LANCZOS)
+
+
+def save_tiff(im, compression, tiffinfo=None):
+    buf = io.BytesIO()
+    im.save(buf, format='TIFF', compression=compression, tiffinfo=tiffinfo or {})
+    return buf.getvalue()
+
+
+def encode_rgb(im):
+    return save_tiff(im, 'tiff_lzw', LZW_INFO)
+
+
+def encode_gray(im, scale=1.0):
+    return save_tiff(scale_image(im.convert('L'), scale), 'tiff_lzw', LZW_INFO)
+
+
+def encode_g4(im, scale=1.0, threshold=None):
+    gray = scale_image(im.convert('L'), scale)
+    # one strip, Group 4 restarts at every strip
+    return save_tiff(binarize(gray, threshold), 'group4')
+
+
+class Encoding(object):
+    """A profile with its target size and smallest downscale."""
+
+    def __init__(self, profile='rgb', target_bytes=TARGET_BYTES, min_scale=0.5):
+        if profile not in PROFILES:
+            raise ValueError('Unknown TIFF profile: {!s}'.format(profile))
+        self.profile = profile
+        self.target_bytes = target_bytes
+        self.min_scale = min_scale
+
+    def key(self):
+        """Identifies the TIFFs of this encoding in the OCR cache keys: the
+        auto profile picks its scale from the target and the smallest
+        downscale."""
+        if self.profile == 'auto':
+            return 'auto:{:d}:{:g}'.format(self.target_bytes, self.min_scale)
+        return self.profile
+
+    def encode(self, im):
+        """Returns the TIFF bytes of an image and the label of the
+        encoding used, e.g. 'g4@0.85'."""
+        if self.profile == 'rgb':
+            return encode_rgb(im), 'rgb'
+        if self.profile == 'gray':
+            return encode_gray(im), 'gray'
+        gray = im.convert('L')
+        threshold = otsu_threshold(gray)
+        if self.profile == 'g4':
+            return encode_g4(gray, threshold=threshold), 'g4'
+        candidates = [(lambda: encode_gray(gray), 'gray'),
+                      (lambda: encode_g4(gray, threshold=threshold), 'g4')]
+        for scale in SCALES:
+            if scale >= self.min_scale:
+                candidates.append((lambda s=scale: encode_g4(gray, s, threshold),
+                                   'g4@{:g}'.format(scale)))
+        best = None
+        for encode, label in candidates:
+            data = encode()
+            if len(data) <= self.target_bytes:
+                return data, label
+            if best is None or len(data) < len(best[0]):
+                best = (data, label)
+        logging.warn('No TIFF encoding under {:d} bytes, {!s} is {:d}'.format(
+            self.target_bytes, best[1], len(best[0])))
+        return best
+
+
+_encoding = Encoding()
+
+
+def set_encoding(encoding):
+    global _encoding
+    _encoding = encoding if encoding is not None else Encoding()
+
+
+def get_encoding():
+    return _encoding
+
+
+def encoding_from_args(args):
+    return Encoding(args.tiff_profile, args.tiff_target_bytes, args.tiff_min_scale)
+
+
+def add_encoding_arguments(parser):
+    parser.add_argument('--tiff-profile', default='rgb', choices=PROFILES,
+                        help='TIFF encoding of the uploaded tiles: rgb (LZW), gray '
+                             '(LZW), g4 (bilevel Group 4) or auto (smallest change '
+                             'fitting --tiff-target-bytes) (Default: rgb)')
+    parser.add_argument('--tiff-target-bytes', type=int, default=TARGET_BYTES,
+                        help='Target size of a TIFF for --tiff-profile auto '
+                             '(Default: {:d})'.format(TARGET_BYTES))
+    parser.add_argument('--tiff-min-scale', type=float, default=0.5,
+                        help='Smallest downscale --tiff-profile auto may use (Default: 0.5)')
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_layout.py: voter records from the word boxes of a tile.
+
+A page of an electoral roll is a grid of voter cards (typically 3 columns
+by 10 rows), each with a serial number, an EPIC number and the fields
+"Name", "Father's/Husband's Name", "House Number", "Age" and "Gender".
+The plain text of Vision mixes the cards up; here the grid is found from
+the positions of the words instead:
+
+1. the "Name" labels that start a card (without Father's, Husband's, ...
+   just left of them) are the anchors; their x and y are clustered by
+   splitting the sorted values at large gaps, which gives the columns and
+   rows of the grid,
+2. every word is put in a cell with a binary search on the column and row
+   edges, and the words of a cell are grouped into lines by sorting on
+   (cell, y) and splitting where y jumps,
+3. the lines of a card are parsed into a record.
+
+Steps 1 and 2, and the decoding and lower-casing of the words before,
+are array operations over all the words of a page; only the few lines of
+each card are handled one by one.
+"""
+
+import re
+
+import numpy as np
+
+import ocr_pages
+
+
+FIELDS = ('serial', 'epic', 'name', 'relation', 'relation_name', 'house',
+          'age', 'gender')
+
+FIELD_LABELS = re.compile(
+    r"(?P<relation_name>\b(?P<relation>Father|Husband|Mother|Wife|Other)s?\s*'?\s*s?\s*Name)"
+    r"|(?P<name>\bName)"
+    r"|(?P<house>\bHouse\s*(?:No\b\.?|Number))"
+    r"|(?P<age>\bAge)"
+    r"|(?P<gender>\b(?:Gender|Sex))", re.I)
+EPIC = re.compile(r'\b[A-Z]{2,4}/?[0-9][0-9/]{5,}\b')
+SERIAL = re.compile(r'\b(\d+)\b')
+AGE = re.compile(r'\d+')
+
+# words that make the following "Name" a relation's name, not a card anchor
+RELATION_WORDS = np.array(["father", "father's", "husband", "husband's", "mother",
+                           "mother's", "wife", "wife's", "others", "other's",
+                           "'s", "s", "'"])
+
+
+def gather(codes, starts, lengths):
+    """Copies the runs codes[start:start + length] into the rows of a
+    zero-padded (n, max length) array."""
+    width = int(lengths.max()) if len(lengths) else 0
+    if not len(codes) or width <= 0:
+        return np.zeros((len(starts), 1), dtype=codes.dtype)
+    pos = np.arange(width)
+    idx = np.minimum(starts[:, None] + pos, len(codes) - 1)
+    return np.where(pos < lengths[:, None], codes[idx], 0).astype(codes.dtype)
+
+
+def word_texts(columns):
+    """Returns the text of every word as an array of str. The text is
+    decoded once, the byte offsets of the words are turned into character
+    offsets (the count of UTF-8 lead bytes before them) and the code points
+    of the words are gathered into a fixed-width 'U' array."""
+    data = columns['text']
+    offsets = np.asarray(columns['word_text'], dtype=np.int64).reshape(-1, 2)
+    leads = np.concatenate(([0], np.cumsum((data & 0xC0) != 0x80)))
+    codes = np.frombuffer(data.tobytes().decode('utf-8', 'replace').encode('utf-32-le'),
+                          dtype=np.uint32)
+    starts = leads[offsets[:, 0]]
+    chars = gather(codes, starts, leads[offsets[:, 1]] - starts)
+    return chars.view('U{:d}'.format(chars.shape[1])).ravel()
+
+
+def word_labels(texts):
+    """Words lower-cased (ASCII, the labels are English) without the
+    surrounding spaces and colons, to match labels."""
+    texts = np.ascontiguousarray(texts, dtype='U')
+    n = len(texts)
+    codes = texts.view(np.uint32).reshape(n, max(texts.itemsize // 4, 1))
+    codes = np.where((codes >= 65) & (codes <= 90), codes + 32, codes)
+    # the zero padding is stripped along with ' ' and ':'
+    strip = (codes == 0) | (codes == 32) | (codes == 58)
+    lead = np.logical_and.accumulate(strip, axis=1).sum(axis=1)
+    trail = np.logical_and.accumulate(strip[:, ::-1], axis=1).sum(axis=1)
+    lengths = np.maximum(codes.shape[1] - lead - trail, 0)
+    starts = np.arange(n) * codes.shape[1] + lead
+    chars = gather(codes.ravel(), starts, lengths)
+    return chars.view('U{:d}'.format(chars.shape[1])).ravel()
+
+
+def split_clusters(values, gap):
+    """Sorts values and splits them where two neighbours are more than gap
+    apart, returns the median of every cluster."""
+    if not len(values):
+        return np.zeros(0)
+    v = np.sort(values)
+    breaks = np.flatnonzero(np.diff(v) > gap) + 1
+    return np.array([np.median(c) for c in np.split(v, breaks)])
+
+
+class Grid(object):
+    """Column and row edges of the cards of a page: a word at (x, y) is in
+    column searchsorted(col_edges, x) - 1, same for rows."""
+
+    def __init__(self, col_edges, row_edges):
+        self.col_edges = col_edges
+        self.row_edges = row_edges
+
+    @property
+    def ncols(self):
+        return max(len(self.col_edges) - 1, 0)
+
+    @property
+    def nrows(self):
+        return max(len(self.row_edges) - 1, 0)
+
+    def cells(self, x, y):
+        """Returns (row, col) of points, -1 outside the grid."""
+        col = np.searchsorted(self.col_edges, x, side='right') - 1
+        row = np.searchsorted(self.row_edges, y, side='right') - 1
+        outside = (col < 0) | (col >= self.ncols) | (row < 0) | (row >= self.nrows)
+        col[outside] = -1
+        row[outside] = -1
+        return row, col
+
+
+def detect_grid(x0, x1, y0, height, labels, page_width):
+    """Returns the Grid of the cards of a page from the boxes of its words
+    and their labels (see word_labels), None without any card anchor."""
+    names = np.flatnonzero(labels == 'name')
+    if not len(names):
+        return None
+    line = float(np.median(height))
+    # a "Name" with a relation word just left of it on its line is the
+    # relation's name; candidates x relation words, both a few per card
+    relations = np.flatnonzero(np.isin(labels, RELATION_WORDS))
+    dx = x0[names][:, None] - x1[relations][None, :]
+    dy = np.abs(y0[names][:, None] - y0[relations][None, :])
+    after = ((dx >= -0.5 * line) & (dx < 6 * line) & (dy < 0.5 * line)).any(axis=1)
+    anchors = names[~after]
+    if not len(anchors):
+        return None
+    xs = split_clusters(x0[anchors], 0.1 * page_width)
+    ys = split_clusters(y0[anchors], 2 * line)
+    # the serial/EPIC line sits above "Name", the margin absorbs ragged lefts
+    lead = 2 * line
+    margin = line
+    if len(ys) > 1:
+        pitch = float(np.median(np.diff(ys)))
+    else:
+        pitch = 8 * line
+    col_edges = np.append(xs - margin, np.inf)
+    row_edges = np.append(ys - lead, ys[-1] - lead + pitch)
+    return Grid(col_edges, row_edges)
+
+
+def card_lines(row, col, cx, cy, height, texts):
+    """Groups the words of the cells into lines. Returns (row, col, line
+    text) for every line, in card order and top to bottom."""
+    inside = np.flatnonzero(col >= 0)
+    if not len(inside):
+        return []
+    ncols = col.max() + 1
+    order = inside[np.lexsort((cy[inside], row[inside] * ncols + col[inside]))]
+    cell = row[order] * ncols + col[order]
+    gap = 0.5 * float(np.median(height[order]))
+    new_line = np.ones(len(order), dtype=bool)
+    new_line[1:] = (np.diff(cell) != 0) | (np.diff(cy[order]) > gap)
+    line_id = np.cumsum(new_line) - 1
+    # left to right within a line
+    order2 = np.lexsort((cx[order], line_id))
+    order = order[order2]
+    line_id = line_id[order2]
+    starts = np.flatnonzero(np.append([True], np.diff(line_id) != 0))
+    lines = []
+    for words, first in zip(np.split(texts[order], starts[1:]), order[starts]):
+        lines.append((int(row[first]), int(col[first]), ' '.join(words)))
+    return lines
+
+
+def parse_card(text):
+    """Returns the record (dict of FIELDS) of the text of one card."""
+    record = dict((field, '') for field in FIELDS)
+    matches = list(FIELD_LABELS.finditer(text))
+    head = text[:matches[0].start()] if matches else text
+    serial = SERIAL.search(head)
+    if serial:
+        record['serial'] = serial.group(1)
+    epic = EPIC.search(text)
+    if epic:
+        record['epic'] = epic.group(0)
+    for m, next_m in zip(matches, matches[1:] + [None]):
+        field = m.lastgroup
+        if record[field]:
+            continue
+        value = text[m.end():next_m.start() if next_m else len(text)]
+        if epic:
+            value = value.replace(epic.group(0), ' ')
+        value = ' '.join(value.replace(':', ' ').split())
+        if field == 'relation_name':
+            record['relation'] = m.group('relation').lower()
+        elif field == 'age':
+            age = AGE.search(value)
+            value = age.group(0) if age else ''
+        elif field == 'gender':
+            value = value.split()[0] if value else ''
+        record[field] = value
+    return record
+
+
+def page_records(index, rows, texts, labels):
+    """Records of the cards of the words rows of a page of a TileIndex."""
+    if not len(rows):
+        return []
+    sizes = index.columns['page_size']
+    page_width = float(sizes[0][0]) if len(sizes) else 0.0
+    x0, y0 = index.x0[rows], index.y0[rows]
+    height = index.y1[rows] - y0
+    grid = detect_grid(x0, index.x1[rows], y0, height, labels[rows], page_width)
+    if grid is None:
+        return []
+    cx, cy = index.cx[rows], index.cy[rows]
+    row, col = grid.cells(cx, cy)
+    cards = []
+    for r, c, line in card_lines(row, col, cx, cy, height, texts[rows]):
+        if not cards or cards[-1][:2] != (r, c):
+            cards.append((r, c, []))
+        cards[-1][2].append(line)
+    records = []
+    for r, c, lines in cards:
+        record = parse_card('\n'.join(lines))
+        record['row'] = r + 1
+        record['col'] = c + 1
+        records.append(record)
+    return records
+
+
+def extract_voters(columns, name=None, heights=None):
+    """Returns the voter records of a tile (ocr_columns arrays), each with
+    its PDF page (see ocr_pages), row and column. A name that is not a
+    {fn}-{dpi}-{from}-{to} tile name is taken as a single page 1."""
+    if name is not None and ocr_pages.TILE_NAME.match(name):
+        index = ocr_pages.TileIndex.from_tile(columns, name, heights)
+    else:
+        index = ocr_pages.TileIndex(columns)
+    texts = word_texts(columns)
+    labels = word_labels(texts)
+    records = []
+    for pno in index.pages:
+        for record in page_records(index, index.words_in_page(pno), texts, labels):
+            record['page'] = pno
+            records.append(record)
+    return records
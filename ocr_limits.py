@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_limits.py: quota-aware rate limiting and adaptive concurrency of the
+OCR requests of google_vision_ocr_gcs.py.
+
+A fixed -p runs either below the Vision API quota or into it, and every
+"Backend deadline exceeded" answer is a failed request that is still
+billed. Limiter keeps, in shared memory so that all the worker processes
+of a run draw from it:
+
+    a token bucket  --rpm requests (files) per minute, with a burst of a
+                    couple of seconds; every new OCR request takes a token
+                    per file (page of a PDF), a burst at a time
+    a window        of OCR operations in flight (submitted, not done yet)
+
+With --adaptive the window is driven by an AIMD controller, between 1 and
+--max-in-flight (default: -p, or --in-flight of the async pipeline):
+
+    additive increase        +1 per window of operations that finish
+                             while the mean latency is under
+                             --target-latency
+    multiplicative decrease  halved on a deadline or quota error
+                             (DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, 429,
+                             503) or a mean latency over the target, at
+                             most once per COOLDOWN seconds; a quota
+                             error also empties the token bucket
+
+so a run settles just below the point where the API starts failing.
+"""
+
+import time
+import logging
+import multiprocessing
+
+from contextlib import contextmanager
+
+from google.api_core import exceptions
+
+import ocr_retry
+
+
+# Vision API status codes of an overloaded backend and of a quota
+DEADLINE_EXCEEDED = 4
+RESOURCE_EXHAUSTED = 8
+
+QUOTA_ERRORS = (exceptions.TooManyRequests, exceptions.ResourceExhausted)
+CONGESTION_ERRORS = QUOTA_ERRORS + (exceptions.DeadlineExceeded,
+                                    exceptions.ServiceUnavailable)
+
+BURST_SECONDS = 2.0
+COOLDOWN = 10.0
+DECREASE = 0.5
+# weight of the latest latency in the moving average
+LATENCY_WEIGHT = 0.2
+# seconds between two tries for a free slot
+SLOT_POLL = 0.5
+
+# layout of the shared state
+TOKENS, STAMP, IN_FLIGHT, LIMIT, LATENCY, DECREASED = range(6)
+
+
+def is_quota(e):
+    if isinstance(e, ocr_retry.VisionError):
+        return e.code == RESOURCE_EXHAUSTED
+    return isinstance(e, QUOTA_ERRORS)
+
+
+def is_congestion(e):
+    """True for the errors of an API running over its capacity or quota."""
+    if isinstance(e, ocr_retry.VisionError):
+        return e.code in (DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED)
+    return isinstance(e, CONGESTION_ERRORS)
+
+
+class Limiter(object):
+    """Token bucket of requests per minute and AIMD window of operations
+    in flight, shared by the processes it is passed to at their start."""
+
+    def __init__(self, rpm=None, max_in_flight=1, adaptive=False,
+                 target_latency=120.0, min_in_flight=1):
+        self.rpm = rpm
+        self.burst = max(1.0, rpm / 60.0 * BURST_SECONDS) if rpm else 0.0
+        self.max_in_flight = max(max_in_flight, min_in_flight)
+        self.min_in_flight = min_in_flight
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.lock = multiprocessing.Lock()
+        self.state = multiprocessing.RawArray('d', 6)
+        self.state[TOKENS] = self.burst
+        self.state[STAMP] = time.time()
+        # an adaptive window starts low and ramps up
+        self.state[LIMIT] = min_in_flight if adaptive else self.max_in_flight
+
+    @property
+    def limit(self):
+        return self.state[LIMIT]
+
+    @property
+    def in_flight(self):
+        return int(self.state[IN_FLIGHT])
+
+    def try_token(self, n=1):
+        """Takes n tokens (one per file of a request) if the bucket has
+        them. Returns 0 then, else the seconds until it will. More tokens
+        than the burst never fit, see take_token."""
+        if not self.rpm:
+            return 0
+        if n > self.burst:
+            raise ValueError('{:g} tokens over the burst of {:g}'.format(n, self.burst))
+        with self.lock:
+            now = time.time()
+            s = self.state
+            s[TOKENS] = min(self.burst, s[TOKENS] + (now - s[STAMP]) * self.rpm / 60.0)
+            s[STAMP] = now
+            if s[TOKENS] >= n:
+                s[TOKENS] -= n
+                return 0
+            return (n - s[TOKENS]) * 60.0 / self.rpm
+
+    def try_slot(self):
+        """Takes a slot of the window if one is free. Returns 0 then, else
+        the seconds to wait before trying again."""
+        with self.lock:
+            if self.state[IN_FLIGHT] < max(1, int(self.state[LIMIT])):
+                self.state[IN_FLIGHT] += 1
+                return 0
+        return SLOT_POLL
+
+    def take_token(self, n=1):
+        """Blocks until n tokens are taken, a burst at a time for a request
+        of more files (e.g. the pages of a PDF) than the burst."""
+        while n > 0:
+            k = min(n, self.burst) if self.rpm else n
+            while True:
+                wait = self.try_token(k)
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+            n -= k
+
+    def acquire_slot(self):
+        while True:
+            wait = self.try_slot()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def release_slot(self, latency=None, error=None):
+        """Gives a slot back with the outcome of its operation: the
+        seconds from submit to done, or the error it ended with."""
+        with self.lock:
+            s = self.state
+            s[IN_FLIGHT] = max(0, s[IN_FLIGHT] - 1)
+            if error is not None:
+                self._congestion(error)
+            elif latency is not None:
+                if s[LATENCY] == 0:
+                    s[LATENCY] = latency
+                else:
+                    s[LATENCY] += LATENCY_WEIGHT * (latency - s[LATENCY])
+                if not self.adaptive:
+                    return
+                if s[LATENCY] > self.target_latency:
+                    self._decrease('latency {:0.1f}s'.format(s[LATENCY]))
+                else:
+                    s[LIMIT] = min(self.max_in_flight, s[LIMIT] + 1.0 / s[LIMIT])
+
+    def report_error(self, e):
+        """Feeds an error seen outside of a slot (e.g. answered with the
+        result of an operation) to the controller."""
+        with self.lock:
+            self._congestion(e)
+
+    def _congestion(self, e):
+        if not is_congestion(e):
+            return
+        if is_quota(e):
+            self.state[TOKENS] = 0
+        self._decrease(type(e).__name__)
+
+    def _decrease(self, reason):
+        s = self.state
+        now = time.time()
+        if not self.adaptive or now - s[DECREASED] < COOLDOWN:
+            return
+        limit = max(self.min_in_flight, s[LIMIT] * DECREASE)
+        logging.warn('In-flight limit {:0.1f} -> {:0.1f} ({!s})'.format(
+            s[LIMIT], limit, reason))
+        s[LIMIT] = limit
+        s[DECREASED] = now
+
+
+_limiter = None
+
+
+def set_limiter(limiter):
+    global _limiter
+    _limiter = limiter
+
+
+def get_limiter():
+    return _limiter
+
+
+def take_token(n=1):
+    if _limiter is not None:
+        _limiter.take_token(n)
+
+
+def report_error(e):
+    if _limiter is not None:
+        _limiter.report_error(e)
+
+
+@contextmanager
+def operation_slot():
+    """Holds a slot of the window from submit to done."""
+    limiter = _limiter
+    if limiter is None:
+        yield
+        return
+    limiter.acquire_slot()
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        limiter.release_slot(error=e)
+        raise
+    limiter.release_slot(time.time() - start)
+
+
+def limiter_from_args(args, concurrency):
+    """Returns the Limiter of the options, None when they are off.
+    concurrency is the max number of operations the run can have."""
+    if not (args.rpm or args.adaptive):
+        return None
+    return Limiter(args.rpm, args.max_in_flight or concurrency, args.adaptive,
+                   args.target_latency)
+
+
+def add_limit_arguments(parser):
+    parser.add_argument('--rpm', type=float, default=None,
+                        help='Max OCR requests (files) per minute across all '
+                             'workers, e.g. the Vision API quota (Default: no limit)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of OCR operations in flight: back '
+                             'off on deadline/quota errors, ramp up while the '
+                             'latency is under --target-latency')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Max OCR operations in flight (Default: -p, or '
+                             '--in-flight of the async pipeline)')
+    parser.add_argument('--target-latency', type=float, default=120.0,
+                        help='Operation latency (seconds) above which --adaptive '
+                             'backs off (Default: 120)')
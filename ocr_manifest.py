@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_manifest.py: durable job manifest of google_vision_ocr_gcs.py.
+
+An SQLite file records the stage every tile has reached:
+
+    converted -> uploaded (tif blob) -> submitted (operation name,
+    output prefix) -> done (result JSON in the bucket) -> saved
+
+or failed, without a bucket, once the tile is dead-lettered.
+
+A restarted run (same --manifest) skips saved tiles with one lookup,
+re-attaches to operations that were still running, downloads results that
+are already in the bucket and re-submits uploaded blobs without converting
+and uploading them again.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+
+CONVERTED = 'converted'
+UPLOADED = 'uploaded'
+SUBMITTED = 'submitted'
+DONE = 'done'
+SAVED = 'saved'
+FAILED = 'failed'
+# stages with blobs or an operation a run can resume from
+RESUMABLE = (UPLOADED, SUBMITTED, DONE)
+
+
+class Manifest(object):
+    """Tile stages stored in SQLite, shared by threads and processes."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'name TEXT PRIMARY KEY, stage TEXT, bucket TEXT, '
+                         'tif_blob TEXT, operation TEXT, output_prefix TEXT, '
+                         'updated REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                         'key TEXT PRIMARY KEY, value TEXT)')
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, name):
+        """Returns the row of a tile as a dict, None if never seen."""
+        with self._lock:
+            row = self._db().execute('SELECT * FROM tiles WHERE name=?',
+                                     (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def saved_names(self):
+        with self._lock:
+            rows = self._db().execute('SELECT name FROM tiles WHERE stage=?', (SAVED,))
+            return set(r[0] for r in rows)
+
+    def unfinished(self, bucket):
+        """Number of tiles a run can still resume from bucket."""
+        with self._lock:
+            row = self._db().execute(
+                'SELECT COUNT(*) FROM tiles WHERE bucket=? AND stage IN ({!s})'.format(
+                    ', '.join('?' * len(RESUMABLE))), (bucket,) + RESUMABLE).fetchone()
+        return row[0]
+
+    def fail(self, name):
+        """Marks a tile that gave up, if it has a row: failed and out of its
+        bucket."""
+        with self._lock:
+            db = self._db()
+            db.execute('UPDATE tiles SET stage=?, bucket=NULL, updated=? WHERE name=?',
+                       (FAILED, time.time(), name))
+            db.commit()
+
+    def update(self, name, stage, **fields):
+        """Moves a tile to stage; fields (bucket, tif_blob, operation,
+        output_prefix) not given keep their value."""
+        fields['stage'] = stage
+        fields['updated'] = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR IGNORE INTO tiles (name) VALUES (?)', (name,))
+            db.execute('UPDATE tiles SET {!s} WHERE name=?'.format(
+                ', '.join('{!s}=?'.format(k) for k in sorted(fields))),
+                [fields[k] for k in sorted(fields)] + [name])
+            db.commit()
+
+    def reset(self, name):
+        with self._lock:
+            db = self._db()
+            db.execute('DELETE FROM tiles WHERE name=?', (name,))
+            db.commit()
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db().execute('SELECT value FROM meta WHERE key=?',
+                                     (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+            db.commit()
+
+
+_manifest = None
+
+
+def set_manifest(manifest):
+    global _manifest
+    _manifest = manifest
+
+
+def get_manifest():
+    """Returns the manifest of this process, None when not enabled."""
+    return _manifest
+
+
+def checkpoint(name, stage, **fields):
+    """Records that a tile reached stage, if a manifest is enabled."""
+    if _manifest is not None:
+        _manifest.update(name, stage, **fields)
+
+
+def fail(name):
+    if _manifest is not None:
+        _manifest.fail(name)
+
+
+def lookup(name):
+    return _manifest.get(name) if _manifest is not None else None
+
+
+def manifest_from_args(args):
+    if args.manifest is None:
+        return None
+    return Manifest(args.manifest)
+
+
+def add_manifest_arguments(parser):
+    parser.add_argument('--manifest', default=None,
+                        help='SQLite job manifest; re-running with the same '
+                             'manifest resumes where the last run stopped')
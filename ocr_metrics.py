@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_metrics.py: per-stage timing events of google_vision_ocr_gcs.py.
+
+The log only has the total Duration and Confidence of a tile. With
+--metrics, --metrics-summary or --prometheus every stage of a tile
+(convert, upload, submit, wait, download, parse, save, render, and the
+whole tile) emits an event
+
+    {"time": ..., "pid": ..., "tile": "abc-300-1-10", "stage": "upload",
+     "duration": 1.82, "bytes": 5242880, "error": null}
+
+with the error class (see ocr_retry.classify) and type of a failed
+attempt. Events are records of the 'ocr.metrics' logger, so the workers
+send them through the same QueueHandler as their log lines; in the main
+process they are kept out of the console and mplog.log (SkipEvents) and go
+to:
+
+    EventFile      one JSON line per event (--metrics)
+    StageSummary   count, errors, busy seconds, p50/p90/p99 latency and
+                   bytes of every stage, logged every --metrics-summary
+                   seconds and written as Prometheus text (--prometheus,
+                   e.g. for the node_exporter textfile collector)
+
+The busy seconds of the stages tell whether a run is bound by the upload,
+the API latency (wait) or the CPU (convert, parse, render).
+"""
+
+import io
+import os
+import json
+import time
+import logging
+import collections
+
+from contextlib import contextmanager
+
+import numpy as np
+
+import ocr_retry
+
+
+LOGGER_NAME = 'ocr.metrics'
+# latencies kept per stage for the percentiles
+WINDOW = 10000
+QUANTILES = (50, 90, 99)
+
+_enabled = False
+
+
+def set_metrics(enabled):
+    global _enabled
+    _enabled = enabled
+    # events are INFO records, keep them whatever --log-level says
+    logging.getLogger(LOGGER_NAME).setLevel(logging.INFO if enabled else logging.WARNING)
+
+
+def get_metrics():
+    return _enabled
+
+
+def emit(stage, tile, duration, error=None, **fields):
+    """Sends the event of one stage (or attempt of a stage) of a tile.
+    fields (bytes, ...) are added to the event."""
+    if not _enabled:
+        return
+    event = {'time': time.time(), 'pid': os.getpid(), 'tile': tile,
+             'stage': stage, 'duration': duration, 'bytes': 0, 'error': None}
+    event.update(fields)
+    if error is not None:
+        event['error'] = ocr_retry.classify(error)
+        event['error_type'] = type(error).__name__
+    logging.getLogger(LOGGER_NAME).info(json.dumps(event), extra={'ocr_event': event})
+
+
+@contextmanager
+def timed(stage, tile, **fields):
+    """Times the block as an event of stage. The block may set the bytes
+    (or other fields) in the dict it gets. An exception is recorded with
+    its class and raised again."""
+    start = time.time()
+    try:
+        yield fields
+    except Exception as e:
+        emit(stage, tile, time.time() - start, e, **fields)
+        raise
+    emit(stage, tile, time.time() - start, **fields)
+
+
+class SkipEvents(logging.Filter):
+    """Keeps the events out of the log handlers."""
+
+    def filter(self, record):
+        return record.name != LOGGER_NAME
+
+
+class EventFile(logging.FileHandler):
+    """Appends every event to a JSON lines file."""
+
+    def __init__(self, filename):
+        super(EventFile, self).__init__(filename, 'a')
+        self.addFilter(logging.Filter(LOGGER_NAME))
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.errors = collections.Counter()
+        self.durations = collections.deque(maxlen=WINDOW)
+
+    def add(self, event):
+        self.count += 1
+        self.seconds += event['duration']
+        self.bytes += event['bytes']
+        self.durations.append(event['duration'])
+        if event['error']:
+            self.errors[(event['error'], event.get('error_type', ''))] += 1
+
+    def quantiles(self):
+        if not self.durations:
+            return [0.0] * len(QUANTILES)
+        return [float(q) for q in np.percentile(self.durations, QUANTILES)]
+
+
+class StageSummary(logging.Handler):
+    """Aggregates the events by stage. Every interval seconds (on the next
+    event) the summary is logged if log is set and written to the
+    Prometheus text file if prometheus is set; once more on close."""
+
+    def __init__(self, interval=60, log=True, prometheus=None):
+        super(StageSummary, self).__init__()
+        self.addFilter(logging.Filter(LOGGER_NAME))
+        self.interval = interval
+        self.log = log
+        self.prometheus = prometheus
+        self.stats = collections.OrderedDict()
+        self.start = self.last = time.time()
+        self.pending = False
+
+    def emit(self, record):
+        event = getattr(record, 'ocr_event', None)
+        if event is None:
+            return
+        stats = self.stats.get(event['stage'])
+        if stats is None:
+            stats = self.stats[event['stage']] = StageStats()
+        stats.add(event)
+        self.pending = True
+        if time.time() - self.last >= self.interval:
+            self.export()
+
+    def export(self):
+        self.last = time.time()
+        self.pending = False
+        if self.log:
+            for line in self.summary():
+                logging.info(line)
+        if self.prometheus:
+            write_prometheus(self.prometheus, self.stats)
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        lines = ['Metrics after {:0.0f}s (busy = stage seconds / elapsed):'.format(elapsed)]
+        for stage, s in self.stats.items():
+            q = s.quantiles()
+            lines.append(' - {:<8s} n={:d} errors={:d} busy={:0.2f} p50={:0.2f}s '
+                         'p90={:0.2f}s p99={:0.2f}s {:0.1f}MB'.format(
+                             stage, s.count, sum(s.errors.values()), s.seconds / elapsed,
+                             q[0], q[1], q[2], s.bytes / 1e6))
+        return lines
+
+    def close(self):
+        # also called again by logging.shutdown at exit
+        if self.pending:
+            self.export()
+        super(StageSummary, self).close()
+
+
+def prometheus_text(stats):
+    """Returns the stats in the Prometheus text exposition format."""
+    lines = ['# HELP ocr_stage_latency_seconds Duration of the stages of a tile.',
+             '# TYPE ocr_stage_latency_seconds summary']
+    for stage, s in stats.items():
+        for q, v in zip(QUANTILES, s.quantiles()):
+            lines.append('ocr_stage_latency_seconds{{stage="{:s}",quantile="{:g}"}} {:f}'.format(
+                stage, q / 100.0, v))
+        lines.append('ocr_stage_latency_seconds_sum{{stage="{:s}"}} {:f}'.format(stage, s.seconds))
+        lines.append('ocr_stage_latency_seconds_count{{stage="{:s}"}} {:d}'.format(stage, s.count))
+    lines += ['# HELP ocr_stage_bytes_total Bytes moved by the stages.',
+              '# TYPE ocr_stage_bytes_total counter']
+    for stage, s in stats.items():
+        lines.append('ocr_stage_bytes_total{{stage="{:s}"}} {:d}'.format(stage, s.bytes))
+    lines += ['# HELP ocr_stage_errors_total Failed stage attempts by error class.',
+              '# TYPE ocr_stage_errors_total counter']
+    for stage, s in stats.items():
+        for (kind, error_type), n in sorted(s.errors.items()):
+            lines.append('ocr_stage_errors_total{{stage="{:s}",class="{:s}",type="{:s}"}} '
+                         '{:d}'.format(stage, kind, error_type, n))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename, stats):
+    # rename, so a collector never reads a half written file
+    tmp_fn = '{!s}.{:d}.tmp'.format(filename, os.getpid())
+    with io.open(tmp_fn, 'w') as f:
+        f.write(prometheus_text(stats))
+    os.rename(tmp_fn, filename)
+
+
+def handlers_from_args(args):
+    """Returns the event handlers of the main process, [] when all the
+    metrics options are off."""
+    handlers = []
+    if args.metrics:
+        handlers.append(EventFile(args.metrics))
+    if args.metrics_summary or args.prometheus:
+        handlers.append(StageSummary(args.metrics_summary or 60,
+                                     log=bool(args.metrics_summary),
+                                     prometheus=args.prometheus))
+    return handlers
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', default=None,
+                        help='JSON lines file of per-stage timing events '
+                             '(Default: off)')
+    parser.add_argument('--metrics-summary', type=float, default=None,
+                        help='Log a per-stage summary every N seconds (Default: off)')
+    parser.add_argument('--prometheus', default=None,
+                        help='Prometheus text file with the per-stage summary, '
+                             'rewritten every --metrics-summary (or 60) seconds')
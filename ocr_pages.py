@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_pages.py: maps the words of a tile back to the PDF pages it stacks.
+
+split_elex_rolls.py pastes pages from..to of a PDF one below the other into
+the tile {fn}-{dpi}-{from}-{to}, so the OCR result of the tile has tile
+coordinates. TileIndex sorts the words of a tile (ocr_columns arrays) once
+by the y of their centers; the words of a page or of a box are then a
+binary search on y and an array filter on x instead of a walk of the whole
+tree. Page boundaries are the page heights of the PDF when known, else the
+tile height split evenly.
+
+With --page-text the text of every page is saved as {fn}-{dpi}-p{page}.txt
+next to the tile outputs; page_text.py does the same for saved results.
+"""
+
+import io
+import os
+import re
+import logging
+
+import numpy as np
+
+
+TILE_NAME = re.compile(r'^(?P<base>.+)-(?P<dpi>\d+)-(?P<from>\d+)-(?P<to>\d+)$')
+
+
+def parse_tile_name(name):
+    """Returns (base, dpi, from page, to page) of a tile name."""
+    match = TILE_NAME.match(name)
+    if match is None:
+        raise ValueError('Not a tile name: {!s}'.format(name))
+    return (match.group('base'), int(match.group('dpi')),
+            int(match.group('from')), int(match.group('to')))
+
+
+def page_text_name(base, dpi, pno):
+    return '{:s}-{:d}-p{:d}'.format(base, dpi, pno)
+
+
+def page_offsets(tile_height, npages, heights=None):
+    """Returns the npages + 1 y coordinates where the pages of a tile start
+    and the tile ends. heights (pixels at any scale) are fitted to the
+    tile height; without them the pages are taken as equally tall."""
+    if heights is None:
+        return np.linspace(0, tile_height, npages + 1)
+    offsets = np.concatenate([[0], np.cumsum(heights, dtype=np.float64)])
+    if offsets[-1] > 0:
+        offsets *= tile_height / offsets[-1]
+    return offsets
+
+
+class TileIndex(object):
+    """Sorted interval index on y over the word boxes of a tile."""
+
+    def __init__(self, columns, from_pno=1, npages=1, heights=None):
+        self.columns = columns
+        boxes = columns['word_box']
+        self.x0 = boxes[:, :, 0].min(axis=1)
+        self.x1 = boxes[:, :, 0].max(axis=1)
+        self.y0 = boxes[:, :, 1].min(axis=1)
+        self.y1 = boxes[:, :, 1].max(axis=1)
+        self.cx = (self.x0 + self.x1) / 2
+        self.cy = (self.y0 + self.y1) / 2
+        self.order = np.argsort(self.cy, kind='mergesort')
+        self.sorted_cy = self.cy[self.order]
+        self.offsets = page_offsets(self.tile_height, npages, heights)
+        self.from_pno = from_pno
+        self.to_pno = from_pno + npages - 1
+
+    @classmethod
+    def from_tile(cls, columns, name, heights=None):
+        """Index of the tile with the given {fn}-{dpi}-{from}-{to} name."""
+        _, _, from_pno, to_pno = parse_tile_name(name)
+        return cls(columns, from_pno, to_pno - from_pno + 1, heights)
+
+    @property
+    def tile_height(self):
+        sizes = self.columns['page_size']
+        return float(sizes[0][1]) if len(sizes) else 0.0
+
+    @property
+    def pages(self):
+        return range(self.from_pno, self.to_pno + 1)
+
+    def word_pages(self):
+        """PDF page number of every word."""
+        k = np.searchsorted(self.offsets, self.cy, side='right') - 1
+        return self.from_pno + np.clip(k, 0, len(self.offsets) - 2)
+
+    def _range(self, y0, y1):
+        lo, hi = np.searchsorted(self.sorted_cy, [y0, y1])
+        return self.order[lo:hi]
+
+    def words_in_page(self, pno):
+        """Rows of the words of PDF page pno, in document order."""
+        k = pno - self.from_pno
+        if k < 0 or k >= len(self.offsets) - 1:
+            return np.zeros(0, dtype=np.intp)
+        y0, y1 = self.offsets[k], self.offsets[k + 1]
+        if k == 0:
+            y0 = -np.inf
+        if k == len(self.offsets) - 2:
+            y1 = np.inf
+        return np.sort(self._range(y0, y1))
+
+    def words_in_box(self, x0, y0, x1, y1):
+        """Rows of the words centered in the box, in document order."""
+        rows = self._range(y0, y1)
+        cx = self.cx[rows]
+        return np.sort(rows[(cx >= x0) & (cx < x1)])
+
+    def text(self, rows):
+        """Text of the given word rows, each with the break that follows it."""
+        offsets = self.columns['word_text']
+        if not len(rows):
+            return u''
+        data = self.columns['text'].tobytes()
+        # a word runs up to the start of the next word, break included
+        ends = np.append(offsets[1:, 0], len(data))
+        text = b''.join(data[s:e] for s, e in zip(offsets[rows, 0].tolist(),
+                                                     ends[rows].tolist()))
+        text = text.decode('utf-8', 'replace')
+        return text if text.endswith('\n') else text + '\n'
+
+    def page_text(self, pno):
+        return self.text(self.words_in_page(pno))
+
+
+def save_page_texts(columns, name, output, heights=None):
+    """Writes the text of every page of a tile, returns the files."""
+    try:
+        base, dpi, _, _ = parse_tile_name(name)
+    except ValueError as e:
+        logging.warn('No page text: {!s}'.format(e))
+        return []
+    index = TileIndex.from_tile(columns, name, heights)
+    outputs = []
+    for pno in index.pages:
+        textfile = os.path.join(output, page_text_name(base, dpi, pno) + '.txt')
+        with io.open(textfile, 'wb') as f:
+            f.write(index.page_text(pno).encode('utf-8'))
+        outputs.append(textfile)
+    return outputs
+
+
+def add_page_arguments(parser):
+    parser.add_argument('--page-text', action='store_true',
+                        help='Also save the text of every PDF page of a tile '
+                             'as {fn}-{dpi}-p{page}.txt')
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_pdf.py: OCR of the source PDFs through the async file API, without
+rasterizing them (google_vision_ocr_gcs.py --input pdf).
+
+The PNG path renders every page (split_elex_rolls.py), encodes the tiles
+as PNG, then decodes them and encodes them again as TIFF for the upload.
+The async API takes application/pdf as well, so here the PDF itself is
+uploaded, straight from the disk, and Vision renders the pages. A PDF over
+--pdf-pages pages or MAX_BYTES is sent as slices of its pages, copied with
+fitz. The results come back as JSON files of --pdf-batch-size pages, one
+response per page, and every page is saved as a one-page tile of the
+usual naming scheme:
+
+    page 7 of abc.pdf  ->  abc-72-7-7.txt, abc-72-7-7.json (.npz, ...)
+
+72 dpi being the PDF points the page sizes of the results are in, so
+page_text.py, extract_voters.py, etc. work on them as they are. Pages that
+fail are sent again as slices of the failed pages only. There is no image
+to draw the boxes over, so no overlay PNG is written, and the OCR cache
+(keyed by tile images) is not used.
+"""
+
+import io
+import os
+import time
+import json
+import logging
+
+import fitz
+
+from google.api_core import exceptions
+from google.cloud.vision import types
+from google.protobuf import json_format
+
+import ocr_limits
+import ocr_manifest
+import ocr_metrics
+import ocr_retry
+import split_elex_rolls
+import google_vision_ocr_gcs as gcs
+
+
+# the page sizes of a PDF result are in points
+PDF_DPI = 72
+# async API limits of a file
+MAX_PAGES = 2000
+MAX_BYTES = 20 * 1024 * 1024
+MAX_BATCH_SIZE = 100
+MIME_TYPE = 'application/pdf'
+
+
+class PageTooLarge(ocr_retry.PermanentError):
+    """A page over MAX_BYTES on its own, no request can take it."""
+
+    stage = 'slice'
+
+    def __init__(self, pno, size):
+        super(PageTooLarge, self).__init__(
+            'Page {:d} is {:d} bytes, over the {:d} of a request'.format(
+                pno, size, MAX_BYTES))
+        self.pno = pno
+        self.size = size
+
+
+def page_name(base_fn, pno):
+    return split_elex_rolls.tile_name(base_fn, PDF_DPI, pno, pno)
+
+
+def page_runs(pnos):
+    """Returns the (from, to) runs of consecutive page numbers."""
+    runs = []
+    for pno in sorted(pnos):
+        if runs and runs[-1][1] == pno - 1:
+            runs[-1] = (runs[-1][0], pno)
+        else:
+            runs.append((pno, pno))
+    return runs
+
+
+def make_jobs(args, pdf_files):
+    """Returns a (pdf, page count, pages per request) job per PDF: the
+    pages per request are --pdf-pages, less for a PDF whose pages would
+    make a slice over MAX_BYTES on average (ocr_slice splits the slices
+    still over it)."""
+    jobs = []
+    for pdf_fn in pdf_files:
+        doc = fitz.open(pdf_fn)
+        page_count = doc.pageCount
+        doc.close()
+        size = os.path.getsize(pdf_fn)
+        pages = args.pdf_pages
+        if size > MAX_BYTES:
+            # 10% below the limit for the pages larger than the average
+            pages = min(pages, max(1, int(page_count * MAX_BYTES * 0.9 / size)))
+        jobs.append((pdf_fn, page_count, pages))
+    return jobs
+
+
+def slice_pdf(pdf_fn, from_pno, to_pno):
+    """Returns the bytes of a PDF of the pages from_pno..to_pno."""
+    name = split_elex_rolls.tile_name(
+        os.path.splitext(os.path.basename(pdf_fn))[0], PDF_DPI, from_pno, to_pno)
+    with ocr_metrics.timed('convert', name) as event:
+        doc = fitz.open(pdf_fn)
+        out = fitz.open()
+        out.insertPDF(doc, from_page=from_pno - 1, to_page=to_pno - 1)
+        data = out.write(garbage=3, deflate=1)
+        out.close()
+        doc.close()
+        event['bytes'] = len(data)
+    return data
+
+
+def upload_pdf(bucket_name, pdf_fn, blob_name, data=None):
+    """Uploads a slice (data) or the whole PDF file."""
+    logging.info('Uploading... {!s}'.format(blob_name))
+    size = len(data) if data is not None else os.path.getsize(pdf_fn)
+    with ocr_metrics.timed('upload', os.path.splitext(blob_name)[0], bytes=size):
+        if data is not None:
+            gcs.upload_blob_from_file(bucket_name, io.BytesIO(data), blob_name,
+                                      content_type=MIME_TYPE)
+        else:
+            with io.open(pdf_fn, 'rb') as f:
+                gcs.upload_blob_from_file(bucket_name, f, blob_name,
+                                          content_type=MIME_TYPE)
+
+
+def fetch_pages(gcs_dst_uri, from_pno):
+    """Downloads the output files of a PDF request. Returns {page number:
+    document, or the VisionError of the page}."""
+    blob_list = gcs.list_outputs(gcs_dst_uri)
+    if not blob_list:
+        # listings can lag behind the end of the operation
+        raise exceptions.NotFound('No output at {!s}'.format(gcs_dst_uri))
+
+    name = os.path.basename(gcs_dst_uri)[:-1]
+    pages = {}
+    for output in blob_list:
+        logging.info('Downloading... {!s}'.format(output.name))
+        with ocr_metrics.timed('download', name) as event:
+            data = gcs.download_blob_data(output)
+            event['bytes'] = len(data)
+        with ocr_metrics.timed('parse', name, bytes=len(data)):
+            response = json_format.ParseDict(json.loads(data), types.AnnotateFileResponse())
+        del data
+        for r in response.responses:
+            pno = from_pno + r.context.page_number - 1
+            if r.error.code != 0:
+                pages[pno] = ocr_retry.VisionError(r.error.code, r.error.message)
+            else:
+                pages[pno] = r.full_text_annotation
+
+    for output in blob_list:
+        output.delete()
+    return pages
+
+
+def ocr_slice(args, pdf_fn, page_count, from_pno, to_pno):
+    """OCR of the pages from_pno..to_pno of a PDF with one request, or
+    with one per half of them when the slice comes out over MAX_BYTES.
+    Returns {page number: document or exception}."""
+    base_fn = os.path.splitext(os.path.basename(pdf_fn))[0]
+    name = split_elex_rolls.tile_name(base_fn, PDF_DPI, from_pno, to_pno)
+    blob_name = name + '.pdf'
+    request = gcs.make_async_request(args.bucket_name, blob_name, name + '-',
+                                     MIME_TYPE, args.pdf_batch_size)
+    retrier = ocr_retry.get_retrier()
+    npages = to_pno - from_pno + 1
+    try:
+        data = None
+        if npages < page_count:
+            data = retrier.call('convert', slice_pdf, pdf_fn, from_pno, to_pno)
+        size = len(data) if data is not None else os.path.getsize(pdf_fn)
+        if size > MAX_BYTES and npages == 1:
+            raise PageTooLarge(from_pno, size)
+    except Exception as e:
+        logging.error('{!s}: {!s}'.format(name, e))
+        return dict((pno, e) for pno in range(from_pno, to_pno + 1))
+
+    if size > MAX_BYTES:
+        # make_jobs went by the mean page size, these pages are larger
+        del data
+        mid = (from_pno + to_pno) // 2
+        logging.warn('{!s}: {:d} bytes, split at page {:d}'.format(name, size, mid))
+        pages = ocr_slice(args, pdf_fn, page_count, from_pno, mid)
+        pages.update(ocr_slice(args, pdf_fn, page_count, mid + 1, to_pno))
+        return pages
+
+    try:
+        retrier.call('upload', upload_pdf, args.bucket_name, pdf_fn, blob_name, data)
+        del data
+        try:
+            # the quota counts pages
+            ocr_limits.take_token(npages)
+            with ocr_limits.operation_slot():
+                operation = retrier.call('submit', gcs.submit_request, name, request,
+                                         None, False)
+                logging.info('Waiting... {!s}'.format(blob_name))
+                retrier.call('wait', gcs.wait_operation, name, operation)
+            ocr_manifest.checkpoint(name, ocr_manifest.DONE)
+        finally:
+            gcs.delete_input_blob(args.bucket_name, blob_name)
+        pages = retrier.call('download', fetch_pages,
+                             request.output_config.gcs_destination.uri, from_pno)
+    except Exception as e:
+        logging.error('{!s}: {!s}'.format(name, e))
+        return dict((pno, e) for pno in range(from_pno, to_pno + 1))
+
+    for pno in range(from_pno, to_pno + 1):
+        if pno not in pages:
+            pages[pno] = exceptions.NotFound('No result for page {:d}'.format(pno))
+    return pages
+
+
+def save_page(args, name, doc, duration):
+    textfile = os.path.join(args.output, name + '.txt')
+    jsonfile = os.path.join(args.output, name + '.json')
+    gcs.save_document(doc, textfile, jsonfile)
+    conf = gcs.render_overlay(doc, None, None)
+    ocr_manifest.checkpoint(name, ocr_manifest.SAVED)
+    logging.info(" - {:s} Confidence: {:0.4f}".format(name, conf))
+    ocr_metrics.emit('tile', name, duration, confidence=conf)
+    return conf
+
+
+def pdf_worker(args, job):
+    """OCR of the pages of a PDF not done yet, --pdf-pages per request.
+    Returns (page name, (jsonfile, duration, confidence) or None) per page."""
+    pdf_fn, page_count, pages = job
+    base_fn = os.path.splitext(os.path.basename(pdf_fn))[0]
+    todo = [pno for pno in range(1, page_count + 1) if not gcs.is_done(
+        args, page_name(base_fn, pno), os.path.join(args.output, page_name(base_fn, pno) + '.png'))]
+    attempted = list(todo)
+    if not todo:
+        logging.info('Output exists, skip...{:s}'.format(pdf_fn))
+        return []
+    logging.info('Processing...{:s} ({:d} pages)'.format(pdf_fn, len(todo)))
+
+    retrier = ocr_retry.get_retrier()
+    results = {}
+    retry = 0
+    while todo:
+        failed = {}
+        for from_pno, to_pno in page_runs(todo):
+            for start in range(from_pno, to_pno + 1, pages):
+                end = min(start + pages - 1, to_pno)
+                t = time.time()
+                docs = ocr_slice(args, pdf_fn, page_count, start, end)
+                duration = (time.time() - t) / (end - start + 1)
+                for pno, doc in sorted(docs.items()):
+                    name = page_name(base_fn, pno)
+                    if isinstance(doc, Exception):
+                        failed[pno] = doc
+                        continue
+                    jsonfile = os.path.join(args.output, name + '.json')
+                    results[pno] = (jsonfile, duration, save_page(args, name, doc, duration))
+
+        # only pages with an error answered by the API are sent again
+        todo = []
+        for pno, e in sorted(failed.items()):
+            if isinstance(e, ocr_retry.VisionError):
+                ocr_limits.report_error(e)
+            if ocr_retry.classify(e) == ocr_retry.REQUEST and retry < gcs.MAX_RETRY:
+                todo.append(pno)
+            else:
+                fields = {'pdf': pdf_fn, 'page': pno}
+                if isinstance(e, PageTooLarge):
+                    fields['bytes'] = e.size
+                retrier.dead_letter(page_name(base_fn, pno), getattr(e, 'stage', 'ocr'),
+                                    e, **fields)
+        if todo:
+            retry += 1
+            delay = retrier.delay('request', retry)
+            logging.warn('{:s}: {:d} pages, retry={:d} in {:0.1f}s'.format(
+                pdf_fn, len(todo), retry, delay))
+            time.sleep(delay)
+
+    return [(page_name(base_fn, pno), results.get(pno)) for pno in attempted]
+
+
+def add_pdf_arguments(parser):
+    parser.add_argument('--input', default='png', choices=['png', 'pdf'],
+                        help='"png" OCRs the PNG tiles of split_elex_rolls.py, "pdf" '
+                             'sends the PDFs of the directory as they are (no overlay, '
+                             'one result per page) (Default: png)')
+    parser.add_argument('--pdf-pages', type=int, default=MAX_PAGES,
+                        help='Max pages of a PDF sent in one request, larger PDFs '
+                             'are sliced (Default: {:d})'.format(MAX_PAGES))
+    parser.add_argument('--pdf-batch-size', type=int, default=20,
+                        help='Pages per JSON output file of a PDF request, up to '
+                             '{:d} (Default: 20)'.format(MAX_BATCH_SIZE))
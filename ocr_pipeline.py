@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_pipeline.py: asyncio pipeline for google_vision_ocr_gcs.py.
+
+Instead of tying one process to a tile for the whole
+convert -> upload -> wait -> download -> render cycle, every step is a stage
+with its own workers, connected by bounded queues:
+
+    convert (processes) -> upload (threads) -> OCR operation (coroutines)
+        -> download (threads) -> render (processes)
+
+The OCR stage only submits an operation and hands it to a single poller
+(ocr_poller.py), which polls all the pending operations on a shared,
+adaptive interval and passes the finished tiles on to download, so
+thousands of operations can be pending (`--in-flight`) from a single
+process. CPU-bound stages run in a process pool of `-p` workers, network
+calls in `--io-threads` threads.
+"""
+
+import os
+import io
+import time
+import asyncio
+import logging
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from logutils.queue import QueueHandler
+
+import ocr_encode
+import ocr_limits
+import ocr_manifest
+import ocr_metrics
+import ocr_poller
+import ocr_retry
+import google_vision_ocr_gcs as gcs
+
+
+# returned by a stage handler that passes the tile on later by itself
+HELD = False
+
+
+def cpu_worker_init(q, level=logging.INFO, metrics=False, encoding=None):
+    # the CPU workers only log, they never talk to the backend
+    if q is not None:
+        logger = logging.getLogger()
+        logger.setLevel(level)
+        logger.addHandler(QueueHandler(q))
+    ocr_metrics.set_metrics(metrics and q is not None)
+    ocr_encode.set_encoding(encoding)
+
+
+class Tile(object):
+    """A tile moving through the pipeline: either a PNG file (filein) or,
+    when streamed from the PDF splitter, TIFF bytes already encoded
+    (image), which are kept for retries and the overlay."""
+
+    def __init__(self, index, name, output, filein=None, image=None):
+        self.index = index
+        self.name = name
+        self.filein = filein
+        self.image = image
+        self.fileout = os.path.join(output, name + '.png')
+        self.textfile = os.path.join(output, name + '.txt')
+        self.jsonfile = os.path.join(output, name + '.json')
+        self.tif_fn = name + '.tif'
+        self.tif_data = None
+        self.cache_key = None
+        self.request = None
+        self.operation_name = None
+        self.submitted = None
+        self.document = None
+        self.retry = 0
+        self.attempts = {}
+        self.start = None
+
+
+class Pipeline(object):
+
+    def __init__(self, args, log_queue=None):
+        self.args = args
+        self.bucket_name = args.bucket_name
+        self.cpu = ProcessPoolExecutor(args.processes, initializer=cpu_worker_init,
+                                       initargs=(log_queue, args.log_level,
+                                                 ocr_metrics.get_metrics(),
+                                                 ocr_encode.get_encoding()))
+        self.io = ThreadPoolExecutor(args.io_threads)
+        self.results = {}
+        self.remaining = 0
+        self.fed = False
+        self.finished = None
+        self.poller = None
+
+    def call_cpu(self, fn, *args):
+        return asyncio.get_event_loop().run_in_executor(self.cpu, fn, *args)
+
+    def call_io(self, fn, *args):
+        return asyncio.get_event_loop().run_in_executor(self.io, fn, *args)
+
+    def done(self, tile, conf):
+        if conf is None:
+            logging.error('Gave up... {!s}'.format(tile.name))
+            conf = 0
+        duration = time.time() - tile.start
+        logging.info('Done... {!s}'.format(tile.name))
+        logging.info(" - Duration: %0.1f" % (duration))
+        logging.info(" - Confidence: %0.4f" % (conf))
+        ocr_metrics.emit('tile', tile.name, duration, confidence=conf)
+        tile.image = None
+        tile.tif_data = None
+        tile.document = None
+        self.results[tile.index] = (tile.fileout, duration, conf)
+        self.remaining -= 1
+        if self.fed and self.remaining == 0:
+            self.finished.set()
+
+    def fail(self, tile, stage, e):
+        """Retries the failing stage after a backoff if the error is
+        transient, sends a new OCR request if the Vision API answered an
+        error, otherwise puts the tile on the dead-letter list."""
+        logging.error('{!s} {!s}: {!s}'.format(stage, tile.name, e))
+        retrier = ocr_retry.get_retrier()
+        kind = ocr_retry.classify(e)
+        if stage == 'annotate':
+            # once submitted, a retry waits again on the same operation
+            policy = 'wait' if tile.operation_name else 'submit'
+        else:
+            policy = stage
+        attempt = tile.attempts[policy] = tile.attempts.get(policy, 0) + 1
+        if kind == ocr_retry.TRANSIENT and attempt < retrier.policy(policy).attempts:
+            target, delay = stage, retrier.delay(policy, attempt)
+        elif kind == ocr_retry.REQUEST and tile.retry < gcs.MAX_RETRY:
+            tile.retry += 1
+            tile.attempts = {}
+            tile.request = None
+            tile.operation_name = None
+            tile.document = None
+            target, delay = 'convert', retrier.delay('request', tile.retry)
+        else:
+            retrier.dead_letter(tile.name, policy, e)
+            asyncio.ensure_future(self.call_io(gcs.delete_input_blob,
+                                               self.bucket_name, tile.tif_fn))
+            self.done(tile, None)
+            return
+        logging.warn('retry {!s} of {!s} in {:0.1f}s'.format(target, tile.name, delay))
+        # do not block the failing stage while waiting or on a full queue
+        asyncio.ensure_future(self.requeue(tile, target, delay))
+
+    async def limit(self, try_fn, *args):
+        """Waits, without holding a thread, until try_fn (try_token or
+        try_slot of the limiter) succeeds."""
+        while True:
+            wait = try_fn(*args)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def requeue(self, tile, target, delay):
+        await asyncio.sleep(delay)
+        await self.queues[target].put(tile)
+
+    async def stage(self, name, handler, next_name):
+        queue = self.queues[name]
+        while True:
+            tile = await queue.get()
+            try:
+                # a handler may send the tile to another stage than the
+                # next, or hold it
+                target = await handler(tile)
+                if target is None:
+                    target = next_name
+            except Exception as e:
+                self.fail(tile, name, e)
+            else:
+                if target:
+                    await self.queues[target].put(tile)
+            finally:
+                queue.task_done()
+
+    async def convert(self, tile):
+        if tile.cache_key is None:
+            tile.cache_key = await self.call_io(gcs.tile_cache_key, tile.filein, tile.image)
+        tile.document = await self.call_io(gcs.lookup_document, tile.cache_key,
+                                           tile.textfile, tile.jsonfile)
+        if tile.document is not None:
+            return 'render'
+        prefix_fn = os.path.splitext(tile.tif_fn)[0] + '-'
+        tile.request = gcs.make_async_request(self.bucket_name, tile.tif_fn, prefix_fn)
+        stage, row = await self.call_io(gcs.resume_stage, self.bucket_name, tile.name)
+        if stage is not None:
+            logging.info('Resuming {!s} from stage {!s}'.format(tile.name, stage))
+            if stage == ocr_manifest.DONE:
+                return 'download'
+            if stage == ocr_manifest.SUBMITTED:
+                tile.operation_name = row['operation']
+            return 'annotate'
+        if tile.filein is None:
+            tile.tif_data = tile.image
+        else:
+            tile.tif_data = await self.call_cpu(gcs.convert_to_tiff, tile.filein)
+        await self.call_io(lambda: ocr_manifest.checkpoint(
+            tile.name, ocr_manifest.CONVERTED, bucket=self.bucket_name))
+
+    async def upload(self, tile):
+        await self.call_io(gcs.upload_tiff, self.bucket_name, tile.tif_data, tile.tif_fn)
+        tile.tif_data = None
+        await self.call_io(lambda: ocr_manifest.checkpoint(
+            tile.name, ocr_manifest.UPLOADED, tif_blob=tile.tif_fn))
+
+    async def annotate(self, tile):
+        """Submits the operation of a tile, or re-attaches to it, and hands
+        it to the poller; operation_done moves the tile on."""
+        # the slot is held from here, before the submit, so that concurrent
+        # annotate workers cannot all pass a check of the pending count
+        await self.poller.reserve(self.args.in_flight)
+        limiter = ocr_limits.get_limiter()
+        try:
+            if limiter is not None:
+                await self.limit(limiter.try_slot)
+        except BaseException:
+            self.poller.release()
+            raise
+        try:
+            operation = None
+            if tile.operation_name is not None:
+                operation = await self.call_io(gcs.reattach_operation, tile.operation_name)
+            if operation is None:
+                # a new request, also when the re-attach failed
+                if limiter is not None:
+                    await self.limit(limiter.try_token)
+                operation = await self.call_io(gcs.submit_request, tile.name,
+                                               tile.request, None, False)
+        except BaseException as e:
+            self.poller.release()
+            if limiter is not None:
+                limiter.release_slot(error=e)
+            raise
+        tile.operation_name = operation.operation.name
+        tile.submitted = time.time()
+        logging.info('Waiting... {!s}'.format(tile.request.input_config.gcs_source.uri))
+        future = self.poller.add(tile.name, operation, tile.submitted)
+        future.add_done_callback(
+            lambda f: asyncio.ensure_future(self.operation_done(tile, f)))
+        return HELD
+
+    async def operation_done(self, tile, future):
+        limiter = ocr_limits.get_limiter()
+        latency = time.time() - tile.submitted
+        try:
+            result = await self.call_io(future.result().result)
+            logging.debug('{!s}'.format(result))
+        except Exception as e:
+            ocr_metrics.emit('wait', tile.name, latency, e)
+            if limiter is not None:
+                limiter.release_slot(error=e)
+            self.fail(tile, 'annotate', e)
+            return
+        ocr_metrics.emit('wait', tile.name, latency)
+        if limiter is not None:
+            limiter.release_slot(latency)
+        try:
+            await self.call_io(ocr_manifest.checkpoint, tile.name, ocr_manifest.DONE)
+            await self.call_io(gcs.delete_input_blob, self.bucket_name, tile.tif_fn)
+        except Exception as e:
+            self.fail(tile, 'annotate', e)
+            return
+        await self.queues['download'].put(tile)
+
+    async def download(self, tile):
+        gcs_dst_uri = tile.request.output_config.gcs_destination.uri
+        try:
+            tile.document = await self.call_io(gcs.fetch_document, gcs_dst_uri,
+                                               tile.textfile, tile.jsonfile)
+        except ocr_retry.VisionError as e:
+            ocr_limits.report_error(e)
+            await self.call_io(gcs.forget_tile, tile.name)
+            raise
+        await self.call_io(gcs.store_document, tile.cache_key, tile.document)
+
+    async def render(self, tile):
+        source = tile.filein if tile.filein is not None else io.BytesIO(tile.image)
+        conf = await self.call_cpu(gcs.render_overlay, tile.document, source,
+                                   gcs.overlay_file(self.args, tile.fileout), tile.name)
+        tile.document = None
+        await self.call_io(ocr_manifest.checkpoint, tile.name, ocr_manifest.SAVED)
+        self.done(tile, conf)
+
+    async def process(self, source):
+        """Runs every tile of the async iterable source through the stages.
+        Tiles are taken from source only as fast as the convert stage has
+        room for them."""
+        args = self.args
+        self.finished = asyncio.Event()
+        self.poller = ocr_poller.OperationPoller(
+            self.call_io, args.poll_interval, args.max_poll_interval,
+            gcs.GOOGLE_OPERATION_TIMEOUT, args.io_threads)
+
+        stages = [
+            ('convert', self.convert, args.processes),
+            ('upload', self.upload, args.io_threads),
+            # submit only, the poller waits for the operations
+            ('annotate', self.annotate, args.io_threads),
+            ('download', self.download, args.io_threads),
+            ('render', self.render, args.processes),
+        ]
+        self.queues = dict((name, asyncio.Queue(2 * n)) for name, _, n in stages)
+        workers = [asyncio.ensure_future(self.poller.run())]
+        for k, (name, handler, n) in enumerate(stages):
+            next_name = stages[k + 1][0] if k + 1 < len(stages) else None
+            for _ in range(n):
+                workers.append(asyncio.ensure_future(self.stage(name, handler, next_name)))
+
+        async for tile in source:
+            logging.info('Processing...{:s}'.format(tile.name))
+            tile.start = time.time()
+            self.remaining += 1
+            await self.queues['convert'].put(tile)
+        self.fed = True
+
+        if self.remaining > 0:
+            await self.finished.wait()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return self.results
+
+    async def run(self, input_files):
+        async def source():
+            for i, filein in enumerate(input_files):
+                name = os.path.splitext(os.path.basename(filein))[0]
+                tile = Tile(i, name, self.args.output, filein=filein)
+                if gcs.is_done(self.args, name, tile.fileout):
+                    logging.info('Output exists, skip... {!s}'.format(filein))
+                    continue
+                yield tile
+
+        results = await self.process(source())
+        return [results.get(i) for i in range(len(input_files))]
+
+    def close(self):
+        self.cpu.shutdown()
+        self.io.shutdown()
+
+
+def run(args, input_files, log_queue=None):
+    """Runs the async pipeline over the PNG files, returns the same
+    (fileout, duration, conf) results as ocr_worker."""
+    pipeline = Pipeline(args, log_queue)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(pipeline.run(input_files))
+    finally:
+        pipeline.close()
+        loop.close()
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument('--in-flight', type=int, default=100,
+                        help='Async pipeline: max OCR operations pending (Default: 100)')
+    parser.add_argument('--io-threads', type=int, default=16,
+                        help='Async pipeline: threads for uploads/downloads (Default: 16)')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='Async pipeline: min seconds between two polls of an '
+                             'operation (Default: 5)')
+    parser.add_argument('--max-poll-interval', type=float, default=30.0,
+                        help='Async pipeline: max seconds between two polls of an '
+                             'operation, the interval adapts to the OCR latency '
+                             '(Default: 30)')
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_poller.py: one poller for all the pending OCR operations of the async
+pipeline (ocr_pipeline.py).
+
+A worker that blocks in operation.result(), or a coroutine per operation
+polling on its own timer, ties the number of pending operations to the
+number of workers and sends a GetOperation call per operation every few
+seconds however long the API takes. Here the submitting stage only hands
+the operation over (add) and moves on; a single task polls the operations
+that are due, at most `concurrency` calls at a time, and resolves the
+future of each finished one. The poll interval is shared and adapts to
+the latency of the finished operations:
+
+    first poll   after half the mean latency (nothing is done much earlier)
+    then         every tenth of the mean latency, between min_interval and
+                 max_interval
+
+so thousands of operations can be pending for the cost of a few calls per
+second.
+"""
+
+import time
+import asyncio
+import logging
+
+from google.api_core import exceptions
+
+
+# weight of the latest latency in the moving average
+LATENCY_WEIGHT = 0.2
+
+
+class _Pending(object):
+
+    def __init__(self, operation, future, submitted, next_poll):
+        self.operation = operation
+        self.future = future
+        self.submitted = submitted
+        self.next_poll = next_poll
+
+
+class OperationPoller(object):
+    """Pending operations by tile name, polled from run()."""
+
+    def __init__(self, call_io, min_interval=1.0, max_interval=30.0,
+                 timeout=600, concurrency=16):
+        self.call_io = call_io
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.pending = {}
+        # slots taken by reserve() for operations not added yet
+        self.reserved = 0
+        self.latency = None
+        self.changed = asyncio.Event()
+        self.room = asyncio.Event()
+        self.calls = asyncio.Semaphore(concurrency)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def interval(self):
+        """The shared poll interval."""
+        if self.latency is None:
+            return self.min_interval
+        return min(self.max_interval, max(self.min_interval, self.latency / 10.0))
+
+    def add(self, name, operation, submitted=None):
+        """Starts polling an operation, returns a future of the operation
+        once it is done. A future fails with the error of a poll or with
+        DeadlineExceeded after timeout seconds from submitted."""
+        now = time.time()
+        first = self.interval()
+        if self.latency is not None:
+            first = max(first, self.latency / 2.0)
+        future = asyncio.get_event_loop().create_future()
+        # the reservation of the operation becomes its pending entry
+        self.reserved = max(0, self.reserved - 1)
+        self.pending[name] = _Pending(operation, future, submitted or now, now + first)
+        self.changed.set()
+        return future
+
+    async def reserve(self, limit):
+        """Waits until fewer than limit operations are pending or reserved,
+        then reserves a slot for one more: add takes it over, release gives
+        it back when the operation is not added. The check and the
+        reservation are one step, no other task runs in between."""
+        while len(self.pending) + self.reserved >= limit:
+            self.room.clear()
+            await self.room.wait()
+        self.reserved += 1
+
+    def release(self):
+        """Gives back a slot of reserve, for an operation that failed to
+        start."""
+        self.reserved = max(0, self.reserved - 1)
+        self.room.set()
+
+    def _finish(self, name, p, error=None):
+        del self.pending[name]
+        self.room.set()
+        if p.future.done():
+            return
+        if error is not None:
+            p.future.set_exception(error)
+        else:
+            p.future.set_result(p.operation)
+
+    async def check(self, name, p):
+        if time.time() - p.submitted > self.timeout:
+            self._finish(name, p, exceptions.DeadlineExceeded(
+                'Operation timeout: {!s}'.format(name)))
+            return
+        try:
+            async with self.calls:
+                done = await self.call_io(p.operation.done)
+        except Exception as e:
+            self._finish(name, p, e)
+            return
+        if not done:
+            p.next_poll = time.time() + self.interval()
+            return
+        latency = time.time() - p.submitted
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+        self._finish(name, p)
+
+    async def run(self):
+        """Polls the due operations until cancelled."""
+        while True:
+            now = time.time()
+            due = [(name, p) for name, p in self.pending.items() if p.next_poll <= now]
+            if due:
+                logging.debug('Polling {:d}/{:d} operations, interval {:0.1f}s'.format(
+                    len(due), len(self.pending), self.interval()))
+                await asyncio.gather(*[self.check(name, p) for name, p in due])
+            self.changed.clear()
+            wait = None
+            if self.pending:
+                wait = max(0, min(p.next_poll for p in self.pending.values()) - time.time())
+            try:
+                await asyncio.wait_for(self.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_results.py: encodings of the saved OCR results (the TextAnnotation of
+a tile) and the loader of the post-processing scripts.
+
+json_format.MessageToJson of a 10-15 page tile takes seconds of CPU and
+makes files of tens of MB, and json_format.Parse of them is as slow, so a
+pass over the whole corpus is bound by the parsing. --result-format picks
+the encoding of abc_1_15.<ext>:
+
+    json     MessageToJson, as before (the default)
+    pb       the protobuf binary, several times smaller, parsed in C
+    pb.gz    pb, gzip compressed
+    pb.zst   pb, zstd compressed (needs the zstandard package), about as
+             small as pb.gz and much faster to read
+
+The pb encodings are written a page at a time: each page is serialized
+and written with its field tag and length prefix, the same bytes as
+SerializeToString of the whole document, so the files read back with
+ParseFromString and only one page is serialized in memory at a time (json
+is still MessageToJson of the whole document). The compressed files are
+read through a stream, with no second copy of the compressed data.
+render_overlays.py, page_text.py, extract_voters.py and json_to_npz.py
+find the result of a tile in any encoding (find_result, the .npz first)
+and load it with load_bounds / load_columns.
+"""
+
+import io
+import os
+import gzip
+import logging
+
+from google.cloud.vision import types
+from google.protobuf import json_format
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import ocr_bounds
+import ocr_columns
+
+
+FORMATS = ('json', 'pb', 'pb.gz', 'pb.zst')
+# fastest to load first, see find_result
+LOAD_ORDER = ('npz', 'pb', 'pb.zst', 'pb.gz', 'json')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def result_format(filename):
+    """Returns the encoding of a result file from its extension."""
+    for fmt in ('pb.gz', 'pb.zst', 'pb', 'json', 'npz'):
+        if filename.endswith('.' + fmt):
+            return fmt
+    raise ValueError('Unknown result file: {!s}'.format(filename))
+
+
+def result_file(jsonfile, fmt=None):
+    """The file of a result in fmt (Default: --result-format), given its
+    .json name."""
+    return os.path.splitext(jsonfile)[0] + '.' + (fmt or _format)
+
+
+def is_saved(jsonfile, fileout=None):
+    """True when a tile has its outputs: the overlay PNG (fileout), written
+    last, or without overlays the result file in --result-format."""
+    if fileout is not None:
+        return os.path.exists(fileout)
+    return os.path.exists(result_file(jsonfile))
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError('Unknown result format: {!s}'.format(fmt))
+    if fmt == 'pb.zst' and zstandard is None:
+        raise ValueError('pb.zst needs the zstandard package (pip install zstandard)')
+
+
+# wire tags of TextAnnotation.pages (field 1) and .text (field 2), both
+# length-delimited
+PAGES_TAG = b'\x0a'
+TEXT_TAG = b'\x12'
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _fields(document):
+    """Yields the protobuf encoding of a document in pieces, a page at a
+    time, that concatenate to document.SerializeToString()."""
+    for page in document.pages:
+        data = page.SerializeToString()
+        yield PAGES_TAG + _varint(len(data))
+        yield data
+    if document.text:
+        data = document.text.encode('utf-8')
+        yield TEXT_TAG + _varint(len(data))
+        yield data
+
+
+def write_result(document, filename, fmt=None):
+    """Saves a document in fmt (Default: from the extension), returns the
+    number of bytes written. The pb encodings are serialized a page at a
+    time, json is MessageToJson of the whole document."""
+    fmt = fmt or result_format(filename)
+    check_format(fmt)
+    with io.open(filename, 'wb') as f:
+        if fmt == 'json':
+            f.write(json_format.MessageToJson(document).encode('utf-8'))
+        elif fmt == 'pb.gz':
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=GZIP_LEVEL) as gz:
+                for data in _fields(document):
+                    gz.write(data)
+        elif fmt == 'pb.zst':
+            # the size in the frame header lets the reader allocate once,
+            # ByteSize does not serialize
+            writer = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+                f, size=document.ByteSize())
+            for data in _fields(document):
+                writer.write(data)
+            writer.flush(zstandard.FLUSH_FRAME)
+        else:
+            for data in _fields(document):
+                f.write(data)
+        return f.tell()
+
+
+def read_result(filename):
+    """Returns the encoded document of a result file, decompressed."""
+    fmt = result_format(filename)
+    with io.open(filename, 'rb') as f:
+        if fmt == 'pb.gz':
+            with gzip.GzipFile(fileobj=f, mode='rb') as gz:
+                return gz.read()
+        if fmt == 'pb.zst':
+            check_format(fmt)
+            # decoded from the stream into the bytes returned, no bytearray
+            # to copy again
+            with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                return reader.readall()
+        return f.read()
+
+
+def load_document(filename):
+    """Returns the TextAnnotation of a result file in any encoding."""
+    data = read_result(filename)
+    document = types.TextAnnotation()
+    if result_format(filename) == 'json':
+        json_format.Parse(data.decode('utf-8'), document, ignore_unknown_fields=True)
+    else:
+        document.ParseFromString(data)
+    return document
+
+
+def find_result(directory, name, formats=LOAD_ORDER):
+    """Returns the result file of a tile that is fastest to load, None if
+    it has none."""
+    for fmt in formats:
+        filename = os.path.join(directory, name + '.' + fmt)
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def result_names(directory, formats=LOAD_ORDER):
+    """Returns the sorted names of the tiles with a result in directory."""
+    names = set()
+    for fn in os.listdir(directory):
+        for fmt in formats:
+            if fn.endswith('.' + fmt):
+                names.add(fn[:-len(fmt) - 1])
+                break
+    return sorted(names)
+
+
+def load_columns(filename):
+    """Returns the ocr_columns columns of a result file (.npz included)."""
+    fmt = result_format(filename)
+    if fmt == 'npz':
+        return ocr_columns.load_columns(filename)
+    if fmt == 'json':
+        # the dicts of json.loads are faster than json_format.Parse
+        return ocr_columns.load_columns_json(filename)
+    return ocr_columns.extract_columns(load_document(filename))
+
+
+def load_bounds(filename, levels=ocr_bounds.OVERLAY_LEVELS):
+    """Returns the ocr_bounds.DocumentBounds of a result file."""
+    fmt = result_format(filename)
+    if fmt == 'npz':
+        return ocr_columns.to_bounds(ocr_columns.load_columns(filename), levels)
+    if fmt == 'json':
+        return ocr_bounds.load_bounds(filename, levels)
+    return ocr_bounds.extract_bounds(load_document(filename), levels)
+
+
+_format = 'json'
+
+
+def set_format(fmt):
+    global _format
+    fmt = fmt or 'json'
+    check_format(fmt)
+    _format = fmt
+
+
+def get_format():
+    return _format
+
+
+def save_document(document, jsonfile):
+    """Saves a document in --result-format next to its .json name, returns
+    the number of bytes written."""
+    filename = result_file(jsonfile)
+    logging.info('Saving... {!s}'.format(filename))
+    return write_result(document, filename, _format)
+
+
+def add_result_arguments(parser):
+    parser.add_argument('--result-format', default='json', choices=FORMATS,
+                        help='Encoding of the saved OCR results: json, pb (protobuf '
+                             'binary), pb.gz or pb.zst (compressed) (Default: json)')
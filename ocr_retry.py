@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_retry.py: per-stage retries of google_vision_ocr_gcs.py.
+
+Each stage of a tile (convert, upload, submit, wait, download, render) is
+retried on its own, with exponential backoff and full jitter, so a failed
+download or overlay does not re-convert, re-upload and re-bill the OCR
+request. Errors are classified:
+
+    transient  network, 5xx, rate limit, deadline: retry the stage
+    request    the Vision API answered an error for the image (e.g. code 4
+               "Backend deadline exceeded"): send a new OCR request
+    permanent  bad input, e.g. "image file is truncated", 4xx: give up
+
+Tiles that give up are appended to a dead-letter list (JSON lines) with the
+stage and the error, instead of being retried forever, and marked failed
+in the manifest.
+"""
+
+import json
+import time
+import random
+import logging
+
+from google.api_core import exceptions
+from PIL import Image
+
+import ocr_manifest
+
+
+TRANSIENT = 'transient'
+REQUEST = 'request'
+PERMANENT = 'permanent'
+
+# Vision API status codes worth a new request: DEADLINE_EXCEEDED,
+# RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+RETRYABLE_CODES = (4, 8, 10, 13, 14)
+
+# PIL errors of a damaged or unsupported image
+PERMANENT_MESSAGES = ('image file is truncated', 'cannot identify image file',
+                      'decompression bomb')
+
+
+class PermanentError(Exception):
+    """An error no retry can fix, e.g. an input over a limit of the API."""
+
+
+class VisionError(Exception):
+    """Error answered by the Vision API for one image."""
+
+    def __init__(self, code, message):
+        super(VisionError, self).__init__(
+            'Vision API code: {!s}, msg: {!s}'.format(code, message))
+        self.code = code
+
+
+def classify(e):
+    """Returns TRANSIENT, REQUEST or PERMANENT for an exception."""
+    if isinstance(e, VisionError):
+        return REQUEST if e.code in RETRYABLE_CODES else PERMANENT
+    if isinstance(e, PermanentError):
+        return PERMANENT
+    if isinstance(e, (exceptions.BadRequest, exceptions.Unauthorized,
+                      exceptions.Forbidden, exceptions.MethodNotAllowed)):
+        return PERMANENT
+    if isinstance(e, getattr(Image, 'DecompressionBombError', ())):
+        return PERMANENT
+    if isinstance(e, (IOError, OSError)) and \
+            any(m in str(e).lower() for m in PERMANENT_MESSAGES):
+        return PERMANENT
+    return TRANSIENT
+
+
+class RetryPolicy(object):
+    """At most `attempts` tries, the n-th retry after a random delay of up
+    to min(cap, base * 2 ** n) seconds."""
+
+    def __init__(self, attempts, base, cap):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+DEFAULT_POLICIES = {
+    'convert': RetryPolicy(2, 1.0, 10.0),
+    'upload': RetryPolicy(6, 1.0, 60.0),
+    'submit': RetryPolicy(6, 2.0, 120.0),
+    # waiting again on the same operation costs nothing
+    'wait': RetryPolicy(3, 0.0, 0.0),
+    'download': RetryPolicy(6, 1.0, 60.0),
+    'render': RetryPolicy(3, 1.0, 10.0),
+    # a new OCR request, the max attempts are MAX_RETRY of the caller
+    'request': RetryPolicy(None, 5.0, 300.0),
+}
+
+
+class Retrier(object):
+    """Retry policies of the stages and the dead-letter list."""
+
+    def __init__(self, dead_letter=None, backoff_scale=1.0, policies=None):
+        self.dead_letter_file = dead_letter
+        self.backoff_scale = backoff_scale
+        self.policies = policies or DEFAULT_POLICIES
+
+    def policy(self, stage):
+        return self.policies[stage]
+
+    def delay(self, stage, attempt):
+        return self.policy(stage).delay(attempt) * self.backoff_scale
+
+    def call(self, stage, fn, *args, **kwargs):
+        """Calls fn, retrying transient errors as the policy of stage
+        allows. The exception finally raised carries the stage name."""
+        attempts = self.policy(stage).attempts
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if classify(e) != TRANSIENT or attempt >= attempts:
+                    e.stage = stage
+                    raise
+                delay = self.delay(stage, attempt)
+                logging.warn('{!s} failed: {!s}, retry {:d}/{:d} in {:0.1f}s'.format(
+                    stage, e, attempt, attempts - 1, delay))
+                time.sleep(delay)
+
+    def dead_letter(self, name, stage, e, **fields):
+        """Records a tile that gave up (with fields in its record), also as failed in the manifest, so
+        that its bucket is not kept for it."""
+        logging.error('Dead letter {!s} at {!s}: {!s}'.format(name, stage, e))
+        ocr_manifest.fail(name)
+        if self.dead_letter_file is None:
+            return
+        record = {'name': name, 'stage': stage, 'class': classify(e),
+                  'error': type(e).__name__, 'message': str(e),
+                  'time': time.time()}
+        # details of the failure, e.g. the page and bytes of a PDF page
+        record.update(fields)
+        # a single short append, safe across processes
+        with open(self.dead_letter_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+_retrier = Retrier()
+
+
+def set_retrier(retrier):
+    global _retrier
+    _retrier = retrier if retrier is not None else Retrier()
+
+
+def get_retrier():
+    return _retrier
+
+
+def retrier_from_args(args):
+    return Retrier(args.dead_letter, args.backoff_scale)
+
+
+def add_retry_arguments(parser):
+    parser.add_argument('--dead-letter', default=None,
+                        help='JSON lines file listing the tiles that failed '
+                             'for good (Default: log only)')
+    parser.add_argument('--backoff-scale', type=float, default=1.0,
+                        help='Multiplier of the retry backoff delays, 0 '
+                             'retries at once (Default: 1)')
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ocr_templates.py: skips the OCR of pages that repeat across the rolls.
+
+The cover, map and summary pages of the electoral rolls are nearly the
+same in thousands of PDFs, yet every one of them is rendered, uploaded and
+billed. With --templates FILE the splitters (split_elex_rolls.py,
+split_ocr_gcs.py) hash the pages at the --template-pages positions (the
+first two and the last one by default, never the voter pages) before
+tiling, from a small render:
+
+    page_hash   64-bit DCT perceptual hash (the signs of the 8x8 lowest
+                frequencies of a 32x32 grayscale thumbnail against their
+                median)
+
+A page within --template-tolerance bits of a template is left out of its
+tile (a tile around it is split in two), else it becomes a template
+itself and is OCR'd as usual. The index lives in shared memory, so that
+all the render processes of a run match against the same templates, and
+in FILE (JSON lines) for the next runs, with the mapping of every skipped
+page:
+
+    {"template": 0, "hash": "c3e1...", "page": "abc-300-p1"}
+    {"page": "xyz-300-p1", "template": 0, "source": "abc-300-p1", "distance": 3}
+
+page_text.py --templates FILE writes the text of a skipped page from the
+one of its template page, so the page outputs stay complete.
+"""
+
+import io
+import os
+import json
+import ctypes
+import logging
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+import fitz
+
+import ocr_pages
+
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+# width of the page render the hash is computed from
+THUMB_WIDTH = 128
+MAX_TEMPLATES = 10000
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2.0 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def image_hash(im):
+    """Returns the 64-bit perceptual hash of an image."""
+    gray = im.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = _DCT.dot(pixels).dot(_DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the DC term is the mean brightness, keep it out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def page_hash(page):
+    """Returns the perceptual hash of a PDF page."""
+    zoom = THUMB_WIDTH / float(page.rect.width)
+    pix = page.getPixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    im = Image.frombuffer("RGB", (pix.w, pix.h), pix.samples, "raw", "RGB", 0, 1)
+    return image_hash(im)
+
+
+def distances(hashes, h):
+    """Hamming distances between h and an array of uint64 hashes."""
+    x = np.bitwise_xor(hashes, np.uint64(h))
+    return np.unpackbits(x.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def split_tiles(tiles, skipped):
+    """Removes the skipped page numbers from (from, to) tiles, splitting a
+    tile into the runs of pages left."""
+    result = []
+    for from_pno, to_pno in tiles:
+        start = None
+        for pno in range(from_pno, to_pno + 1):
+            if pno in skipped:
+                if start is not None:
+                    result.append((start, pno - 1))
+                    start = None
+            elif start is None:
+                start = pno
+        if start is not None:
+            result.append((start, to_pno))
+    return result
+
+
+class TemplateIndex(object):
+    """Hashes of the template pages, shared by the processes it is passed
+    to at their start and kept in a JSON lines file."""
+
+    def __init__(self, filename, tolerance=4, positions=(1, 2, -1),
+                 capacity=MAX_TEMPLATES):
+        self.filename = filename
+        self.tolerance = tolerance
+        self.positions = positions
+        self.capacity = capacity
+        self.lock = multiprocessing.Lock()
+        self.hashes = multiprocessing.RawArray(ctypes.c_uint64, capacity)
+        self.count = multiprocessing.RawValue(ctypes.c_int, 0)
+        self.sources = {}
+        for record in self.records():
+            if 'hash' in record and record['template'] < capacity:
+                self.hashes[record['template']] = int(record['hash'], 16)
+                self.sources[record['template']] = record['page']
+                self.count.value = max(self.count.value, record['template'] + 1)
+
+    def __len__(self):
+        return self.count.value
+
+    def records(self):
+        if not os.path.exists(self.filename):
+            return []
+        with io.open(self.filename, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _append(self, record):
+        with io.open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def source(self, template):
+        """Page name of a template, read again from the file for the
+        templates added by other processes."""
+        if template not in self.sources:
+            for record in self.records():
+                if 'hash' in record:
+                    self.sources[record['template']] = record['page']
+        return self.sources[template]
+
+    def pages(self, page_count):
+        """Page numbers of a PDF that may be templates."""
+        pnos = set()
+        for pos in self.positions:
+            pno = pos if pos > 0 else page_count + pos + 1
+            if 1 <= pno <= page_count:
+                pnos.add(pno)
+        return sorted(pnos)
+
+    def match(self, h, page):
+        """Returns (template, source page, distance) of the closest template
+        within the tolerance, or None after adding the page as a new
+        template. A template page matches nothing but itself."""
+        with self.lock:
+            n = self.count.value
+            if n:
+                d = distances(np.frombuffer(self.hashes, dtype=np.uint64, count=n), h)
+                i = int(np.argmin(d))
+                if d[i] <= self.tolerance:
+                    source = self.source(i)
+                    if source == page:
+                        return None
+                    self._append({'page': page, 'template': i, 'source': source,
+                                  'distance': int(d[i])})
+                    return i, source, int(d[i])
+            if n >= self.capacity:
+                logging.warn('Template index full, {!s} not added'.format(page))
+                return None
+            self._append({'template': n, 'hash': '{:016x}'.format(h), 'page': page})
+            self.sources[n] = page
+            self.hashes[n] = h
+            self.count.value = n + 1
+        return None
+
+
+_index = None
+
+
+def set_index(index):
+    global _index
+    _index = index
+
+
+def get_index():
+    return _index
+
+
+def skip_template_pages(doc, base_fn, dpi, tiles):
+    """Returns the (from, to) tiles of a PDF without the pages that match a
+    template, the tiles as they are without an index."""
+    index = _index
+    if index is None:
+        return tiles
+    skipped = set()
+    for pno in index.pages(doc.pageCount):
+        if not any(a <= pno <= b for a, b in tiles):
+            continue
+        page = ocr_pages.page_text_name(base_fn, dpi, pno)
+        found = index.match(page_hash(doc[pno - 1]), page)
+        if found is not None:
+            print("- Page {:d} matches template {:s} (distance {:d}), skipped".format(
+                pno, found[1], found[2]))
+            skipped.add(pno)
+    if not skipped:
+        return tiles
+    return split_tiles(tiles, skipped)
+
+
+def load_page_map(filename):
+    """Returns {skipped page: template page} of a templates file."""
+    mapping = {}
+    with io.open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'source' in record:
+                mapping[record['page']] = record['source']
+    return mapping
+
+
+def index_from_args(args):
+    """Returns the TemplateIndex of the options, None when it is off."""
+    if not args.templates:
+        return None
+    positions = tuple(int(p) for p in args.template_pages.split(','))
+    return TemplateIndex(args.templates, args.template_tolerance, positions)
+
+
+def add_template_arguments(parser):
+    parser.add_argument('--templates', default=None,
+                        help='JSON lines index of the template pages; pages that '
+                             'match one are not OCR\'d (Default: off)')
+    parser.add_argument('--template-tolerance', type=int, default=4,
+                        help='Max differing bits (of 64) of the hash of a page '
+                             'matching a template (Default: 4)')
+    parser.add_argument('--template-pages', default='1,2,-1',
+                        help='Comma separated page numbers that may be templates, '
+                             'negative from the end (Default: 1,2,-1)')
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+page_text.py: writes the text of every PDF page from the saved results of
+the tiles in a directory, as --page-text does during OCR. The .npz of a
+tile is used when it exists, else its result in any --result-format (see
+ocr_results.py). So, for instance,
+abc-300-1-10.json produces abc-300-p1.txt to abc-300-p10.txt.
+
+With --pdf-dir the page boundaries come from the page heights of abc.pdf
+instead of an even split of the tile. With --templates the pages left out
+of the tiles as repeats of a template page (see ocr_templates.py) get the
+text of their template page.
+"""
+
+import os
+import time
+import shutil
+import argparse
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import fitz
+
+import ocr_pages
+import ocr_results
+import ocr_templates
+
+
+def pdf_page_heights(args, name):
+    """Heights of the pages of a tile in its PDF, None if there is none."""
+    if args.pdf_dir is None:
+        return None
+    base, _, from_pno, to_pno = ocr_pages.parse_tile_name(name)
+    pdf_fn = os.path.join(args.pdf_dir, base + '.pdf')
+    if not os.path.exists(pdf_fn):
+        return None
+    doc = fitz.open(pdf_fn)
+    heights = [doc[i].rect.height for i in range(from_pno - 1, to_pno)]
+    doc.close()
+    return heights
+
+
+def page_worker(args, name):
+    start = time.time()
+    columns = ocr_results.load_columns(ocr_results.find_result(args.directory, name))
+    outputs = ocr_pages.save_page_texts(columns, name, args.output,
+                                        pdf_page_heights(args, name))
+    return name, len(outputs), time.time() - start
+
+
+def template_pages(args):
+    """Writes the text of the pages skipped as templates from the text of
+    their template page. Returns the number of pages written."""
+    n = 0
+    for page, source in sorted(ocr_templates.load_page_map(args.templates).items()):
+        source_fn = os.path.join(args.output, source + '.txt')
+        if not os.path.exists(source_fn):
+            print("Missing: {:s} (template of {:s})".format(source_fn, page))
+            continue
+        shutil.copyfile(source_fn, os.path.join(args.output, page + '.txt'))
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    title = 'Write the text of every PDF page from saved OCR results'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains NPZ or result files')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Directory for page text files (Default: directory)')
+    parser.add_argument('--pdf-dir', default=None,
+                        help='Directory of the PDF files, for exact page boundaries')
+    parser.add_argument('--templates', default=None,
+                        help='Templates file of the split, to write the text of '
+                             'the skipped pages')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    print(args)
+
+    if args.output is None:
+        args.output = args.directory
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    names = [name for name in ocr_results.result_names(args.directory)
+             if ocr_pages.TILE_NAME.match(name)]
+
+    start = time.time()
+    npage = 0
+    pool = Pool(args.processes)
+    for name, n, duration in pool.imap_unordered(
+            partial(page_worker, args), names, chunksize=4):
+        npage += n
+        print("Done: {:s} pages={:d} duration={:0.2f}s".format(name, n, duration))
+    pool.close()
+    pool.join()
+
+    if args.templates:
+        n = template_pages(args)
+        npage += n
+        print("Templates: pages={:d}".format(n))
+
+    print("Total: tiles={:d} pages={:d} duration={:0.1f}s".format(
+        len(names), npage, time.time() - start))
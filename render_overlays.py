@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+render_overlays.py: draws the bounding box PNGs of an OCR run made with
+--no-overlay. For every PNG file of the input directory with a result in
+the output directory (abc_1_15.png and abc_1_15.npz, or the abc_1_15.json
+or .pb of any --result-format, see ocr_results.py), the block, paragraph
+and word boxes are drawn into abc_1_15.png of the output directory, by a
+pool of worker processes.
+"""
+
+import os
+import time
+import argparse
+from glob import glob
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from PIL import Image
+
+import ocr_bounds
+import ocr_results
+
+
+def render_worker(args, filein):
+    fn = os.path.splitext(os.path.basename(filein))[0]
+    resultfile = ocr_results.find_result(args.output, fn)
+    fileout = os.path.join(args.output, fn + '.png')
+    if resultfile is None:
+        return filein, None, 0
+    if os.path.exists(fileout) and not args.overwritten:
+        return filein, None, 0
+    start = time.time()
+    bounds = ocr_results.load_bounds(resultfile)
+    image = Image.open(filein)
+    ocr_bounds.draw_bounds(image, bounds)
+    image.save(fileout)
+    return filein, bounds.confidence, time.time() - start
+
+
+if __name__ == "__main__":
+    title = 'Draw the bounding boxes of saved OCR results over the PNG files'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains PNG files')
+    parser.add_argument('-o', '--output', default='output',
+                        help='Directory of the result files, where the overlay '
+                             'PNG files are written')
+    parser.add_argument('--overwritten',
+                        help='Overwrite if output file exists',
+                        action='store_true')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    print(args)
+
+    if os.path.abspath(args.directory) == os.path.abspath(args.output):
+        parser.error('the overlays would overwrite the input PNG files')
+
+    input_files = sorted(glob(os.path.join(args.directory, '*.png')))
+
+    start = time.time()
+    n = 0
+    pool = Pool(args.processes)
+    for filein, conf, duration in pool.imap_unordered(
+            partial(render_worker, args), input_files, chunksize=4):
+        if conf is None:
+            continue
+        n += 1
+        print("Done: {:s} confidence={:0.4f} render={:0.1f}s".format(
+            filein, conf, duration))
+    pool.close()
+    pool.join()
+
+    print("Total: overlays={:d} duration={:0.1f}s".format(n, time.time() - start))
@@ -9,69 +9,330 @@ it to pngs/. For instance, for electoral roll file name abc.pdf with a
 resolution of 300 dpi, we generate abc_1_15.png, abc_16_30.png, etc. till all
 the pages in abc are exhausted. Given each file gives data of a polling
 station, we do not merge pages from across electoral rolls.
+
+With --templates the cover, map and summary pages that repeat across the
+rolls are left out of the tiles (see ocr_templates.py).
 """
 import os
+import io
+import time
 import argparse
+import collections
 from glob import glob
+from functools import partial
+from multiprocessing import Pool, cpu_count
 import fitz
 from PIL import Image
-from io import StringIO, BytesIO
 
+import ocr_templates
 
-def pdf_to_tile_png(args, pdf_fn):
-    til = None
-    batch = args.batch
-    dpi = args.resolution
 
-    print("Processing....{:s}".format(pdf_fn))
-    doc = fitz.open(pdf_fn)
-    page_count = doc.pageCount
-    from_pno = 1
-    for i, page in enumerate(doc):
+# Vision API limits, see README.md
+MAX_PIXELS = 89478485
+MAX_BYTES = 20 * 1024 * 1024
+# lowest resolution a page over --max-bytes is downscaled to
+MIN_RESOLUTION = 100
+
+
+def tile_ranges(page_count, batch, from_pno=1):
+    """Splits pages from_pno..page_count into (from, to) tiles of batch pages."""
+    return [(pno, min(pno + batch - 1, page_count))
+            for pno in range(from_pno, page_count + 1, batch)]
+
+
+def page_zoom(page, zoom, max_pixels=None):
+    """Returns zoom, reduced if the page alone would be over max_pixels."""
+    if max_pixels:
+        pixels = page.rect.width * page.rect.height * zoom * zoom
+        if pixels > max_pixels:
+            zoom *= (float(max_pixels) / pixels) ** 0.5
+    return zoom
+
+
+def page_size(page, zoom, max_pixels=None):
+    """Pixel size of the page rendered at zoom, without rendering it."""
+    zoom = page_zoom(page, zoom, max_pixels)
+    irect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return irect.width, irect.height
+
+
+def pack_tiles(sizes, max_pixels, max_bytes, bytes_per_pixel, margin):
+    """Packs consecutive pages of the given (width, height) sizes into tiles
+    as large as the pixel and estimated byte budgets allow, less a safety
+    margin. Returns (from, to) page numbers, 1-based and inclusive."""
+    max_pixels *= (1 - margin)
+    max_bytes *= (1 - margin)
+    tiles = []
+    from_pno = None
+    w = h = 0
+    for i, (pw, ph) in enumerate(sizes):
         pno = i + 1
-        print("- Page: {:d}/{:d}".format(pno, page_count))
-        zoom = dpi / 96.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.getPixmap(matrix=mat, alpha=False)
-        data = pix.getPNGData()
-        im = Image.open(BytesIO(data))
+        nw, nh = max(w, pw), h + ph
+        if from_pno is not None and \
+                (nw * nh > max_pixels or nw * nh * bytes_per_pixel > max_bytes):
+            tiles.append((from_pno, pno - 1))
+            from_pno = None
+            nw, nh = pw, ph
+        if from_pno is None:
+            from_pno = pno
+        w, h = nw, nh
+    if from_pno is not None:
+        tiles.append((from_pno, len(sizes)))
+    return tiles
+
+
+def page_pixel_budget(args):
+    return args.max_pixels * (1 - args.margin) if args.pack else None
+
+
+def plan_tiles(args, doc, from_pno=1, to_pno=None, bytes_per_pixel=None):
+    """Returns the (from, to) page ranges of the tiles of a PDF."""
+    if args.pack:
+        if to_pno is None:
+            to_pno = doc.pageCount
+        zoom = args.resolution / 96.0
+        max_pixels = page_pixel_budget(args)
+        sizes = [page_size(doc[i], zoom, max_pixels) for i in range(from_pno - 1, to_pno)]
+        tiles = pack_tiles(sizes, args.max_pixels, args.max_bytes,
+                           bytes_per_pixel or args.bytes_per_pixel, args.margin)
+        return [(a + from_pno - 1, b + from_pno - 1) for a, b in tiles]
+    return tile_ranges(doc.pageCount, args.batch)
+
+
+def render_page(page, zoom, max_pixels=None):
+    new_zoom = page_zoom(page, zoom, max_pixels)
+    if new_zoom != zoom:
+        # a single page over the budget would be rejected, shrink it to fit
+        print("- Downscaled page {:d} to {:0.0f} dpi".format(page.number + 1, new_zoom * 96))
+        zoom = new_zoom
+    mat = fitz.Matrix(zoom, zoom)
+    pix = page.getPixmap(matrix=mat, alpha=False)
+    # wrap the raw RGB samples, no PNG encode/decode of the page
+    return Image.frombuffer("RGB", (pix.w, pix.h), pix.samples, "raw", "RGB", 0, 1)
+
+
+def render_tile(args, doc, from_pno, to_pno, scale=1.0):
+    """Stacks pages from_pno..to_pno vertically into one image, scale times
+    the resolution."""
+    zoom = args.resolution * scale / 96.0
+    max_pixels = page_pixel_budget(args)
+    sizes = [page_size(doc[i], zoom, max_pixels) for i in range(from_pno - 1, to_pno)]
+    width = max(w for w, h in sizes)
+    height = sum(h for w, h in sizes)
+    til = None
+    y = 0
+    for i in range(from_pno - 1, to_pno):
+        print("- Page: {:d}/{:d}".format(i + 1, doc.pageCount))
+        im = render_page(doc[i], zoom, max_pixels)
         if til is None:
-            npage = page_count - pno + 1
-            ntile = batch if npage > batch else npage
-            til = Image.new("RGB", (pix.w, pix.h * ntile))
-        til.paste(im, (0, pix.h * (i % batch)))
+            til = Image.new("RGB", (width, height), "white")
+        til.paste(im, (0, y))
+        y += im.height
         im.close()
-        if (pno % batch == 0) or (pno == page_count):
-            base_fn = os.path.basename(pdf_fn)
-            fn = os.path.splitext(base_fn)[0]
-            png_fn = "{:s}-{:d}-{:d}-{:d}.png".format(fn, dpi, from_pno, pno)
-            png_fn = os.path.join(args.output, png_fn)
-            print("Output: {:s}".format(png_fn))
-            til.save(png_fn)
-            til.close()
-            til = None
-            from_pno = pno + 1
+    if y != height:
+        til = til.crop((0, 0, width, y))
+    return til
 
 
-if __name__ == "__main__":
+def tile_name(base_fn, dpi, from_pno, to_pno):
+    return "{:s}-{:d}-{:d}-{:d}".format(base_fn, dpi, from_pno, to_pno)
+
+
+def encode_png(args, til):
+    buf = io.BytesIO()
+    til.save(buf, format='PNG', compress_level=args.compress_level)
+    return buf.getvalue()
+
+
+def downscale_page(args, doc, pno, encode, data):
+    """Renders a page whose data goes over --max-bytes again at lower
+    resolutions until it fits. Returns the data, None when the page does
+    not fit even at MIN_RESOLUTION."""
+    scale = 1.0
+    while len(data) > args.max_bytes:
+        # the bytes go about with the pixels, the square of the scale
+        scale *= (args.max_bytes * (1 - args.margin) / float(len(data))) ** 0.5
+        if args.resolution * scale < MIN_RESOLUTION:
+            return None
+        print("- Page {:d} is {:d} bytes, downscale to {:0.0f} dpi".format(
+            pno, len(data), args.resolution * scale))
+        til = render_tile(args, doc, pno, pno, scale)
+        data = encode(til)
+        til.close()
+    return data
+
+
+def iter_tiles(args, doc, base_fn, tiles, encode):
+    """Renders the (from, to) tiles of a PDF one at a time and yields
+    (name, data) where data is the tile encoded by encode(til).
+
+    In pack mode a tile whose data goes over --max-bytes is packed again
+    with the bytes per pixel it actually took, and a single page over it is
+    rendered again at a lower resolution (down to MIN_RESOLUTION, else
+    the page is skipped, so that one page does not fail the PDF)."""
+    for from_pno, to_pno in tiles:
+        til = render_tile(args, doc, from_pno, to_pno)
+        pixels = til.width * til.height
+        data = encode(til)
+        til.close()
+        if args.pack and len(data) > args.max_bytes and to_pno == from_pno:
+            size = len(data)
+            data = downscale_page(args, doc, from_pno, encode, data)
+            if data is None:
+                print("- WARNING: page {:d} is {:d} bytes, over --max-bytes even at "
+                      "{:d} dpi, skipped".format(from_pno, size, MIN_RESOLUTION))
+                continue
+        if args.pack and len(data) > args.max_bytes:
+            bytes_per_pixel = float(len(data)) / pixels
+            print("- Tile {:d}-{:d} is {:d} bytes, repack at {:0.4f} bytes/pixel".format(
+                from_pno, to_pno, len(data), bytes_per_pixel))
+            data = None
+            sub_tiles = plan_tiles(args, doc, from_pno, to_pno, bytes_per_pixel)
+            if len(sub_tiles) < 2:
+                mid = (from_pno + to_pno) // 2
+                sub_tiles = [(from_pno, mid), (mid + 1, to_pno)]
+            for item in iter_tiles(args, doc, base_fn, sub_tiles, encode):
+                yield item
+            continue
+        yield tile_name(base_fn, args.resolution, from_pno, to_pno), data
+
+
+def pdf_to_tile_png(args, pdf_fn, tiles=None):
+    """Renders the (from, to) page ranges of a PDF as tiles, all tiles of
+    the plan by default. Returns the list of PNG files written."""
+    outputs = []
+
+    print("Processing....{:s}".format(pdf_fn))
+    doc = fitz.open(pdf_fn)
+    if tiles is None:
+        tiles = plan_tiles(args, doc)
+    base_fn = os.path.splitext(os.path.basename(pdf_fn))[0]
+    tiles = ocr_templates.skip_template_pages(doc, base_fn, args.resolution, tiles)
+    for name, data in iter_tiles(args, doc, base_fn, tiles, partial(encode_png, args)):
+        png_fn = os.path.join(args.output, name + '.png')
+        print("Output: {:s}".format(png_fn))
+        with io.open(png_fn, 'wb') as f:
+            f.write(data)
+        outputs.append(png_fn)
+    doc.close()
+    return outputs
+
+
+def make_jobs(args, pdf_files):
+    """Splits every PDF into jobs of whole tiles, at most args.pages_per_job
+    pages each, so that a large PDF is rendered by several processes while
+    the tile names stay the same as in a sequential run."""
+    jobs = []
+    for pdf_fn in pdf_files:
+        doc = fitz.open(pdf_fn)
+        tiles = plan_tiles(args, doc)
+        doc.close()
+        group = []
+        for tile in tiles:
+            group.append(tile)
+            if group[-1][1] - group[0][0] + 1 >= args.pages_per_job:
+                jobs.append((pdf_fn, group))
+                group = []
+        if group:
+            jobs.append((pdf_fn, group))
+    return jobs
+
+
+def tile_worker(args, job):
+    pdf_fn, tiles = job
+    start = time.time()
+    outputs = pdf_to_tile_png(args, pdf_fn, tiles)
+    npage = sum(to_pno - from_pno + 1 for from_pno, to_pno in tiles)
+    return pdf_fn, npage, outputs, time.time() - start
+
+
+def add_tile_arguments(parser, short_batch=True):
+    """short_batch=False leaves -b to --bucket-name of the OCR scripts."""
+    parser.add_argument('-r', '--resolution', type=int, default=300,
+                        choices=[100, 150, 200, 300, 400, 500, 600],
+                        help='Output resolution of the tiles')
+    parser.add_argument(*(('-b', '--batch') if short_batch else ('--batch',)),
+                        type=int, default=10,
+                        help='Number of page to be tiled in a PNG file')
+    parser.add_argument('--pack', action='store_true',
+                        help='Ignore --batch, fill each tile up to the pixel '
+                             'and byte budgets below')
+    parser.add_argument('--max-pixels', type=int, default=MAX_PIXELS,
+                        help='Pack mode: pixel budget of a tile '
+                             '(Default: {:d})'.format(MAX_PIXELS))
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES,
+                        help='Pack mode: byte budget of a tile '
+                             '(Default: {:d})'.format(MAX_BYTES))
+    parser.add_argument('--bytes-per-pixel', type=float, default=0.05,
+                        help='Pack mode: estimated compressed bytes per pixel '
+                             '(Default: 0.05)')
+    parser.add_argument('--margin', type=float, default=0.1,
+                        help='Pack mode: safety margin kept below the budgets '
+                             '(Default: 0.1)')
+    parser.add_argument('--pages-per-job', type=int, default=60,
+                        help='Max pages of a PDF rendered by one worker, '
+                             'large PDFs are split across workers (Default: 60)')
+    ocr_templates.add_template_arguments(parser)
+
+
+def make_parser():
     title = 'Split PDF files and create tile of pages as PNG output files'
     parser = argparse.ArgumentParser(description=title)
     parser.add_argument('directory', default=None,
                         help='Directory contains PDF files')
-    parser.add_argument('-r', '--resolution', type=int, default=300,
-                        choices=[100, 150, 200, 300, 400, 500, 600],
-                        help='Output resolution of PNG file')
-    parser.add_argument('-b', '--batch', type=int, default=10,
-                        help='Number of page to be tiled in a PNG file')
+    add_tile_arguments(parser)
     parser.add_argument('-o', '--output', default='pngs',
                         help='Directory of PNG output files')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+    parser.add_argument('--compress-level', type=int, default=6,
+                        choices=range(10), metavar='[0-9]',
+                        help='zlib level of the PNG output, lower is faster '
+                             'and bigger (Default: 6)')
+    return parser
+
 
-    args = parser.parse_args()
+def run(args, pdf_files):
+    """Renders the tiles of the PDFs in a pool of args.processes workers.
+    Returns {pdf: [pages, tiles, render seconds]} and the duration of
+    every job."""
+    jobs = make_jobs(args, pdf_files)
+    njobs = collections.Counter(pdf_fn for pdf_fn, _ in jobs)
+    summary = collections.defaultdict(lambda: [0, 0, 0.0])
+    durations = []
+
+    pool = Pool(args.processes, ocr_templates.set_index,
+                [ocr_templates.index_from_args(args)])
+    for pdf_fn, npage, outputs, duration in pool.imap_unordered(
+            partial(tile_worker, args), jobs):
+        stat = summary[pdf_fn]
+        stat[0] += npage
+        stat[1] += len(outputs)
+        stat[2] += duration
+        durations.append(duration)
+        njobs[pdf_fn] -= 1
+        if njobs[pdf_fn] == 0:
+            print("Done: {:s} pages={:d} tiles={:d} render={:0.1f}s".format(
+                pdf_fn, stat[0], stat[1], stat[2]))
+    pool.close()
+    pool.join()
+    return dict(summary), durations
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
 
     print(args)
 
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    for fn in sorted(glob(os.path.join(args.directory, '*.pdf'))):
-        pdf_to_tile_png(args, fn)
+    pdf_files = sorted(glob(os.path.join(args.directory, '*.pdf')))
+
+    start = time.time()
+    summary, _ = run(args, pdf_files)
+
+    print("Total: pdfs={:d} pages={:d} tiles={:d} duration={:0.1f}s".format(
+        len(summary), sum(v[0] for v in summary.values()),
+        sum(v[1] for v in summary.values()), time.time() - start))
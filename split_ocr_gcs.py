@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+split_ocr_gcs.py: split_elex_rolls.py and google_vision_ocr_gcs.py in one
+streaming pass. PDF pages are rendered into tiles by a pool of render
+processes and each tile is handed, as TIFF bytes, straight to the async OCR
+pipeline, so OCR of the first tiles starts while later PDFs are still
+rendering and no PNG copy of the corpus is written to disk. The render
+processes block once --queue-size tiles are waiting for the pipeline.
+
+Outputs are the same as google_vision_ocr_gcs.py: abc-300-1-10.txt,
+abc-300-1-10.json and abc-300-1-10.png for pages 1 to 10 of abc.pdf.
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import logging
+
+from glob import glob
+from multiprocessing import Process, Queue, cpu_count
+
+import fitz
+
+import ocr_backend
+import ocr_bounds
+import ocr_cache
+import ocr_columns
+import ocr_encode
+import ocr_limits
+import ocr_manifest
+import ocr_metrics
+import ocr_pages
+import ocr_results
+import ocr_retry
+import ocr_templates
+import ocr_pipeline
+import split_elex_rolls
+import google_vision_ocr_gcs as gcs
+
+
+def render_worker(args, job_queue, tile_queue, templates=None, retrier=None):
+    """Renders the jobs of job_queue and puts (name, tiff bytes) on
+    tile_queue, then None when there is no job left, also after an
+    error, so that stream_tiles always counts this process out."""
+    ocr_encode.set_encoding(ocr_encode.encoding_from_args(args))
+    ocr_results.set_format(args.result_format)
+    ocr_templates.set_index(templates)
+    ocr_retry.set_retrier(retrier)
+    try:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            render_job(args, job, tile_queue)
+    finally:
+        tile_queue.put(None)
+
+
+def render_job(args, job, tile_queue):
+    """Renders the tiles of a job, dead-letters those not rendered when the
+    PDF fails (e.g. a corrupt file)."""
+    pdf_fn, tiles = job
+    base_fn = os.path.splitext(os.path.basename(pdf_fn))[0]
+    done = set()
+    doc = None
+    try:
+        doc = fitz.open(pdf_fn)
+        # before the done check, the tiles of a run skip the same pages
+        tiles = ocr_templates.skip_template_pages(doc, base_fn, args.resolution, tiles)
+        names = [split_elex_rolls.tile_name(base_fn, args.resolution, a, b) for a, b in tiles]
+        tiles = [tile for tile, name in zip(tiles, names) if not gcs.is_done(
+            args, name, os.path.join(args.output, name + '.png'))]
+        if not tiles:
+            return
+        print("Processing....{:s}".format(pdf_fn))
+        for name, data in split_elex_rolls.iter_tiles(args, doc, base_fn, tiles,
+                                                      gcs.encode_tiff):
+            tile_queue.put((name, data))
+            done.add(name)
+    except Exception as e:
+        logging.error('{!s}: {!s}'.format(pdf_fn, e))
+        retrier = ocr_retry.get_retrier()
+        for a, b in tiles:
+            name = split_elex_rolls.tile_name(base_fn, args.resolution, a, b)
+            if name not in done:
+                retrier.dead_letter(name, 'render', e)
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+async def stream_tiles(pipeline, args, tile_queue, nworkers):
+    """Yields pipeline tiles as the render processes produce them."""
+    index = 0
+    running = nworkers
+    while running > 0:
+        item = await pipeline.call_io(tile_queue.get)
+        if item is None:
+            running -= 1
+            continue
+        name, data = item
+        yield ocr_pipeline.Tile(index, name, args.output, image=data)
+        index += 1
+
+
+def run(args, pdf_files, log_queue=None):
+    job_queue = Queue()
+    tile_queue = Queue(args.queue_size)
+    templates = ocr_templates.index_from_args(args)
+    for job in split_elex_rolls.make_jobs(args, pdf_files):
+        job_queue.put(job)
+    workers = []
+    for _ in range(args.render_processes):
+        job_queue.put(None)
+        w = Process(target=render_worker, args=(args, job_queue, tile_queue, templates,
+                                                ocr_retry.get_retrier()))
+        w.start()
+        workers.append(w)
+
+    pipeline = ocr_pipeline.Pipeline(args, log_queue)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(pipeline.process(
+            stream_tiles(pipeline, args, tile_queue, len(workers))))
+    except BaseException:
+        # nothing reads tile_queue any more, the render processes may be
+        # blocked on it for good
+        for w in workers:
+            w.terminate()
+        job_queue.cancel_join_thread()
+        raise
+    finally:
+        pipeline.close()
+        loop.close()
+        for w in workers:
+            w.join()
+    return [results[i] for i in sorted(results)]
+
+
+if __name__ == "__main__":
+
+    title = 'Split PDF files into tiles and OCR them using Google Vision API'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains PDF files')
+    split_elex_rolls.add_tile_arguments(parser, short_batch=False)
+    # the same -b/--bucket-name as google_vision_ocr_gcs.py
+    gcs.add_bucket_arguments(parser)
+    parser.add_argument('--overwritten',
+                        help='Overwrite if output file exists',
+                        action='store_true')
+    parser.add_argument('-o', '--output', default='output',
+                        help='Directory for output files')
+    parser.add_argument('-p', '--processes', type=int, default=4,
+                        help='Number of overlay rendering processes (Default: 4)')
+    parser.add_argument('--render-processes', type=int, default=cpu_count(),
+                        help='Number of PDF rendering processes '
+                             '(Default: number of CPUs)')
+    parser.add_argument('--queue-size', type=int, default=20,
+                        help='Max rendered tiles waiting for OCR (Default: 20)')
+    ocr_pipeline.add_pipeline_arguments(parser)
+    ocr_bounds.add_overlay_arguments(parser)
+    ocr_columns.add_columns_arguments(parser)
+    ocr_pages.add_page_arguments(parser)
+    parser.add_argument('--log-level', default='INFO', nargs='?',
+                        type=gcs._log_level_string_to_int,
+                        help='Set the logging output level. {0}'
+                            .format(gcs._LOG_LEVEL_STRINGS))
+    ocr_backend.add_backend_arguments(parser)
+    ocr_cache.add_cache_arguments(parser)
+    ocr_manifest.add_manifest_arguments(parser)
+    ocr_retry.add_retry_arguments(parser)
+    ocr_metrics.add_metrics_arguments(parser)
+    ocr_limits.add_limit_arguments(parser)
+    ocr_encode.add_encoding_arguments(parser)
+    ocr_results.add_result_arguments(parser)
+    args = parser.parse_args()
+
+    backend = ocr_backend.backend_from_args(args)
+    ocr_backend.set_backend(backend)
+    ocr_cache.set_cache(ocr_cache.cache_from_args(args))
+    ocr_manifest.set_manifest(ocr_manifest.manifest_from_args(args))
+    ocr_retry.set_retrier(ocr_retry.retrier_from_args(args))
+    ocr_columns.set_columns(args.npz, args.page_text)
+    metrics_handlers = ocr_metrics.handlers_from_args(args)
+    ocr_metrics.set_metrics(bool(metrics_handlers))
+    ocr_limits.set_limiter(ocr_limits.limiter_from_args(args, args.in_flight))
+    ocr_results.set_format(args.result_format)
+
+    if backend.name == 'gcs' and 'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
+        if args.credentials is None:
+            print("ERROR: Please make sure have a Google credentials file.\n"
+                  "See https://cloud.google.com/docs/authentication/getting-started")
+            sys.exit(-1)
+        else:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.credentials
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    pdf_files = sorted(glob(os.path.join(args.directory, '*.pdf')))
+
+    manifest = ocr_manifest.get_manifest()
+    gcs.work_bucket(args, manifest)
+
+    lq_listener, lq = gcs.logger_init(args.log_level, metrics_handlers)
+
+    logging.info(title)
+    logging.info("Args: {!s}".format(args))
+    logging.info("Working bucket name on the GCS: {!s}".format(args.bucket_name))
+
+    try:
+        results = run(args, pdf_files, lq)
+        for r in results:
+            logging.info('{!s}'.format(r))
+    except Exception as e:
+        logging.error(e)
+    finally:
+        if args.auto_bucket:
+            gcs.release_bucket(args.bucket_name, manifest)
+
+    lq_listener.stop()
+    for h in metrics_handlers:
+        h.close()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+tiff_profiles.py: upload bytes against OCR confidence of the TIFF encoding
+profiles of ocr_encode.py, on a sample of PNG tiles.
+
+Every tile of the sample is encoded with every profile (--profiles) and,
+with --ocr, sent through the async file API like google_vision_ocr_gcs.py
+does. One CSV row per tile and profile has the bytes, the encode time, the
+mean block and word confidence and the word agreement with the text of
+the first profile (rgb by default); the means per profile are printed at
+the end, so a smaller profile can be checked for accuracy before a run.
+"""
+
+import os
+import sys
+import csv
+import time
+import random
+import logging
+import argparse
+import difflib
+from glob import glob
+from functools import partial
+from multiprocessing import Pool, Queue, cpu_count
+
+from PIL import Image
+
+from logutils.queue import QueueHandler, QueueListener
+
+import ocr_backend
+import ocr_bounds
+import ocr_columns
+import ocr_encode
+import google_vision_ocr_gcs as gcs
+
+
+FIELDS = ['tile', 'profile', 'encoding', 'bytes', 'encode_seconds', 'ocr_seconds',
+          'confidence', 'word_confidence', 'agreement']
+
+
+def worker_init(q, level=logging.WARNING):
+    """Initializer of the workers without --ocr: no backend clients, so no
+    credentials are needed."""
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(QueueHandler(q))
+
+
+def ocr_tiff(bucket_name, name, data):
+    """OCR of TIFF bytes through the async file API, returns the document."""
+    tif_fn = name + '.tif'
+    gcs.upload_tiff(bucket_name, data, tif_fn)
+    request = gcs.make_async_request(bucket_name, tif_fn, name + '-')
+    try:
+        operation = gcs.submit_request(name, request)
+        gcs.wait_operation(name, operation)
+    finally:
+        gcs.delete_input_blob(bucket_name, tif_fn)
+    # 0: keep the text and JSON in memory
+    return gcs.fetch_document(request.output_config.gcs_destination.uri, 0, 0)
+
+
+def profile_worker(args, filein):
+    name = gcs.tile_name(filein)
+    rows = []
+    base_words = None
+    with Image.open(filein) as im:
+        im.load()
+        for profile in args.profiles:
+            encoding = ocr_encode.Encoding(profile, args.target_bytes, args.min_scale)
+            start = time.time()
+            data, label = encoding.encode(im)
+            row = {'tile': name, 'profile': profile, 'encoding': label,
+                   'bytes': len(data), 'encode_seconds': time.time() - start}
+            if args.ocr:
+                start = time.time()
+                doc = ocr_tiff(args.bucket_name, '{:s}-{:s}'.format(name, profile), data)
+                row['ocr_seconds'] = time.time() - start
+                row['confidence'] = ocr_bounds.extract_bounds(doc, levels=()).confidence
+                word_conf = ocr_columns.extract_columns(doc)['word_conf']
+                row['word_confidence'] = float(word_conf.mean()) if len(word_conf) else 0.0
+                words = doc.text.split()
+                if base_words is None:
+                    base_words = words
+                row['agreement'] = difflib.SequenceMatcher(
+                    None, base_words, words, autojunk=False).ratio()
+            rows.append(row)
+    return rows
+
+
+def summary(rows, profiles):
+    base = {}
+    for profile in profiles:
+        sel = [r for r in rows if r['profile'] == profile]
+        if not sel:
+            continue
+        mean = lambda k: sum(r.get(k) or 0 for r in sel) / float(len(sel))
+        nbytes = mean('bytes')
+        base.setdefault('bytes', nbytes)
+        line = "{:<6s} tiles={:<4d} bytes={:10.0f} ({:5.1%}) encode={:0.2f}s".format(
+            profile, len(sel), nbytes, nbytes / base['bytes'], mean('encode_seconds'))
+        if 'confidence' in sel[0]:
+            line += " conf={:0.4f} word_conf={:0.4f} agreement={:0.4f}".format(
+                mean('confidence'), mean('word_confidence'), mean('agreement'))
+        print(line)
+
+
+if __name__ == "__main__":
+    title = 'Compare upload bytes and OCR confidence of the TIFF encoding profiles'
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('directory', default=None,
+                        help='Directory contains PNG files')
+    parser.add_argument('--profiles', default='rgb,gray,g4,auto',
+                        help='Comma separated profiles, the first one is the '
+                             'reference of the agreement (Default: rgb,gray,g4,auto)')
+    parser.add_argument('--target-bytes', type=int, default=ocr_encode.TARGET_BYTES,
+                        help='Target size of the auto profile (Default: {:d})'.format(
+                            ocr_encode.TARGET_BYTES))
+    parser.add_argument('--min-scale', type=float, default=0.5,
+                        help='Smallest downscale of the auto profile (Default: 0.5)')
+    parser.add_argument('-n', '--sample', type=int, default=20,
+                        help='Number of PNG files, picked at random (Default: 20)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the sample (Default: 0)')
+    parser.add_argument('--ocr', action='store_true',
+                        help='Also OCR every encoding (billed with --backend gcs)')
+    parser.add_argument('-b', '--bucket-name', default=None,
+                        help='Working bucket name on Google Cloud Storage')
+    parser.add_argument('-c', '--credentials', default=None,
+                        help='Google Applicaiton Credentials file')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of worker process to run '
+                             '(Default: number of CPUs)')
+    parser.add_argument('-o', '--output', default='tiff_profiles.csv',
+                        help='CSV file of the results (Default: tiff_profiles.csv)')
+    ocr_backend.add_backend_arguments(parser)
+    args = parser.parse_args()
+    args.profiles = args.profiles.split(',')
+    for profile in args.profiles:
+        if profile not in ocr_encode.PROFILES:
+            parser.error('unknown profile: {!s}'.format(profile))
+
+    print(args)
+
+    backend = ocr_backend.backend_from_args(args)
+    ocr_backend.set_backend(backend)
+    if args.ocr and backend.name == 'gcs' and \
+            'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
+        if args.credentials is None:
+            print("ERROR: Please make sure have a Google credentials file.\n"
+                  "See https://cloud.google.com/docs/authentication/getting-started")
+            sys.exit(-1)
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.credentials
+
+    input_files = sorted(glob(os.path.join(args.directory, '*.png')))
+    random.Random(args.seed).shuffle(input_files)
+    input_files = sorted(input_files[:args.sample])
+
+    auto_bucket = False
+    if args.ocr and args.bucket_name is None:
+        args.bucket_name = gcs.get_bucket_name()
+        gcs.create_bucket(args.bucket_name)
+        auto_bucket = True
+
+    # warnings and errors of the workers
+    q = Queue()
+    listener = QueueListener(q, logging.StreamHandler())
+    listener.start()
+
+    rows = []
+    try:
+        if args.ocr:
+            pool = Pool(args.processes, gcs.worker_init, [q, logging.WARNING, backend])
+        else:
+            pool = Pool(args.processes, worker_init, [q])
+        for tile_rows in pool.imap_unordered(partial(profile_worker, args), input_files):
+            print("Done: {:s}".format(tile_rows[0]['tile']))
+            rows.extend(tile_rows)
+        pool.close()
+        pool.join()
+    finally:
+        if auto_bucket:
+            gcs.delete_bucket(args.bucket_name)
+        listener.stop()
+
+    with open(args.output, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in sorted(rows, key=lambda r: (r['tile'], args.profiles.index(r['profile']))):
+            writer.writerow(row)
+
+    summary(rows, args.profiles)